@@ -0,0 +1,202 @@
+"""
+Cancellable, preemptible action tasks for the device simulators.
+
+Every command becomes an ``ActionTask`` keyed by the actuator it drives
+(``open_roof`` and ``close_roof`` both drive ``roof``; a second ``restart``
+drives ``restart``). When a newer command for the same actuator arrives, the
+in-flight task is cancelled: its next ``task_sleep`` raises ``Preempted``, the
+handler stops before touching device state, and the executor sends a
+``PREEMPTED`` ack instead of finishing a command the user has already
+overridden.
+
+With a coalescing window, a command for the same action (the same target
+state) that arrives while an equivalent task is still pending or running,
+within the window of that task's arrival, is not executed: it joins the
+task as a follower and gets its own ack with the shared result. Threshold
+storms, where the backend repeats ``ventilator_on`` with new actionIds, then
+cost one execution instead of one per command.
+
+Task states:
+    pending    received, waiting out the command latency
+    running    inside the action handler
+    cancelled  preempted by a newer command for the same actuator
+    coalesced  merged into an equivalent pending or running task
+    done       finished (successfully or not)
+
+Handlers keep calling a plain sleep function; ``task_sleep`` looks up the
+task of the calling thread, so a handler is cancellable without being passed
+the task.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+PENDING, RUNNING, CANCELLED, COALESCED, DONE = "pending", "running", "cancelled", "coalesced", "done"
+
+_current = threading.local()
+
+
+class Preempted(BaseException):
+    """Raised inside a task whose command was superseded
+
+    A BaseException (like asyncio.CancelledError) so the handlers' broad
+    ``except Exception`` blocks don't turn it into an EXECUTION_ERROR.
+    """
+
+    def __init__(self, task: 'ActionTask'):
+        super().__init__(f"{task.action} preempted by {task.preempted_by}")
+        self.task = task
+
+
+class ActionTask:
+    """One command being executed"""
+
+    def __init__(self, key: Tuple[str, str], action: str, action_id: str):
+        self.key = key
+        self.action = action
+        self.action_id = action_id
+        self.state = PENDING
+        self.preempted_by = None  # actionId of the command that replaced this one
+        self.coalesced_into = None  # task executing this command on its behalf
+        self.followers = []  # actionIds of commands coalesced into this one
+        self.sealed = False  # acks are being sent; no more followers
+        self.created = time.time()
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self, by: str = None):
+        self.preempted_by = by
+        self._cancelled.set()
+
+    def sleep(self, seconds: float):
+        """Sleep, waking up early with Preempted if the task is cancelled"""
+        if self._cancelled.wait(seconds):
+            raise Preempted(self)
+
+    def check(self):
+        """Raise Preempted if the task was cancelled"""
+        if self._cancelled.is_set():
+            raise Preempted(self)
+
+    def __enter__(self) -> 'ActionTask':
+        _current.task = self
+        return self
+
+    def __exit__(self, *exc):
+        _current.task = None
+        return False
+
+
+def current_task() -> Optional[ActionTask]:
+    """The task executing on this thread, if any"""
+    return getattr(_current, 'task', None)
+
+
+def task_sleep(seconds: float):
+    """``time.sleep`` that a newer command can interrupt"""
+    task = current_task()
+    if task is None:
+        time.sleep(seconds)
+    else:
+        task.sleep(seconds)
+
+
+def actuator_of(action: str) -> str:
+    """Conflict key of an action: ``fan_on``/``fan_off`` -> ``fan``, ``open_roof`` -> ``roof``"""
+    for prefix in ("open_", "close_"):
+        if action.startswith(prefix):
+            return action[len(prefix):]
+    for suffix in ("_on", "_off"):
+        if action.endswith(suffix):
+            return action[:-len(suffix)]
+    return action
+
+
+class TaskRegistry:
+    """The in-flight task per (device, actuator); a newer command preempts the older one"""
+
+    def __init__(self, key_fn: Callable[[str], str] = actuator_of, preempt: bool = True,
+                 coalesce_window: float = 0.0):
+        self.key_fn = key_fn
+        self.preempt = preempt
+        self.coalesce_window = coalesce_window  # seconds; 0 disables coalescing
+        self._active: Dict[Tuple[str, str], ActionTask] = {}
+        self._lock = threading.Lock()
+        self.counts = {"submitted": 0, "preempted": 0, "coalesced": 0, "done": 0, "savedSeconds": 0.0}
+
+    def submit(self, device_id: str, action: str, action_id: str) -> ActionTask:
+        """Register a new command, cancelling the one it supersedes
+
+        Returns a task in state ``coalesced`` (with ``coalesced_into`` set) when
+        the command was merged into an equivalent one; it must not be executed.
+        """
+        task = ActionTask((device_id, self.key_fn(action)), action, action_id)
+        with self._lock:
+            self.counts["submitted"] += 1
+            previous = self._active.get(task.key)
+            if (self.coalesce_window > 0 and previous is not None and previous.action == action
+                    and previous.state in (PENDING, RUNNING) and not previous.sealed
+                    and task.created - previous.created <= self.coalesce_window):
+                previous.followers.append(action_id)
+                task.state = COALESCED
+                task.coalesced_into = previous
+                self.counts["coalesced"] += 1
+                return task
+            self._active[task.key] = task
+            if previous is not None and self.preempt and previous.state in (PENDING, RUNNING):
+                previous.state = CANCELLED
+                previous.cancel(action_id)
+                self.counts["preempted"] += 1
+        return task
+
+    def start(self, task: ActionTask):
+        """Mark a task running; raises Preempted if it was superseded while pending"""
+        with self._lock:
+            task.check()
+            task.state = RUNNING
+
+    def seal(self, task: ActionTask) -> List[str]:
+        """Close a task to new followers; returns its actionId and its followers' to acknowledge"""
+        with self._lock:
+            task.sealed = True
+            return [task.action_id] + task.followers
+
+    def finish(self, task: ActionTask):
+        """Mark a task done (or leave it cancelled) and forget it"""
+        with self._lock:
+            if task.followers:
+                # Each follower would have taken as long as the execution it shared
+                self.counts["savedSeconds"] += len(task.followers) * (time.time() - task.created)
+            if task.state != CANCELLED:
+                task.state = DONE
+                self.counts["done"] += 1
+            if self._active.get(task.key) is task:
+                del self._active[task.key]
+
+    def in_flight(self) -> Dict[str, Any]:
+        """Tasks currently pending or running, for status and debugging"""
+        with self._lock:
+            return {f"{device_id}/{key}": {"action": task.action, "actionId": task.action_id, "state": task.state,
+                                           "followers": list(task.followers)}
+                    for (device_id, key), task in self._active.items()}
+
+
+def format_counts(counts: Dict[str, float]) -> str:
+    """One-line coalescing summary of (possibly summed) TaskRegistry counts"""
+    submitted = counts["submitted"]
+    ratio = counts["coalesced"] / submitted if submitted else 0.0
+    executed = submitted - counts["coalesced"]
+    return (f"{submitted} commands, {counts['coalesced']} coalesced ({ratio:.1%}, "
+            f"{submitted / executed if executed else 1:.2f} commands per execution), "
+            f"{counts['preempted']} preempted, {counts['savedSeconds']:.1f}s of executor time saved")
+
+
+def format_in_flight(tasks: Dict[str, Any], limit: int = 5) -> str:
+    """Tasks from TaskRegistry.in_flight() as one log line, at most ``limit`` listed"""
+    listed = [f"{key} {task['action']} ({task['state']}, {task['actionId']})" for key, task in list(tasks.items())[:limit]]
+    more = len(tasks) - len(listed)
+    return ", ".join(listed) + (f" and {more} more" if more > 0 else "")
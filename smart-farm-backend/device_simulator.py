@@ -27,7 +27,7 @@ import random
 import argparse
 import logging
 from datetime import datetime, timezone
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 import threading
 import signal
 import sys
@@ -39,6 +39,11 @@ except ImportError:
     print("❌ Error: paho-mqtt not installed. Run: pip install paho-mqtt")
     sys.exit(1)
 
+import mqtt_transport
+import mqtt_wire
+from action_tasks import Preempted, TaskRegistry, format_counts, format_in_flight, task_sleep
+from event_recorder import RECEIVED, QUEUED, STARTED, HANDLER_DONE
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -50,19 +55,40 @@ logger = logging.getLogger(__name__)
 class SmartFarmDeviceSimulator:
     """Simulates a Smart Farm IoT device with realistic behavior"""
     
-    def __init__(self, device_id: str, broker_url: str = None, username: str = None, password: str = None):
+    def __init__(self, device_id: str, broker_url: str = None, username: str = None, password: str = None,
+                 install_signal_handlers: bool = True, ssl_context: ssl.SSLContext = None,
+                 ca_file: str = None, tls_insecure: bool = False, latency_model=None,
+                 cluster: mqtt_transport.BrokerCluster = None):
         self.device_id = device_id
         self.broker_url = broker_url or "wss://i37c1733.ala.us-east-1.emqxsl.com:8084/mqtt"
         self.username = username or "oussama2255"
         self.password = password or "Oussama2255"
         
+        # TLS settings; by default all simulators in a process share one context
+        self.ssl_context = ssl_context
+        self.ca_file = ca_file or mqtt_transport.DEFAULT_CA_FILE
+        self.tls_insecure = tls_insecure
+        
+        # Several comma-separated broker URLs: consistent-hash this device onto one
+        # (fleets pass one shared cluster so endpoint health is shared too)
+        self.cluster = cluster or (mqtt_transport.BrokerCluster.from_urls(self.broker_url)
+                                   if ',' in self.broker_url else None)
+        if self.cluster is not None:
+            self.broker_url = self.cluster.assign(self.device_id)
+        self._cluster_connected = False
+        
         # Parse broker URL
         self.parse_broker_url()
         
-        # Create MQTT client with WebSocket support
-        self.client = mqtt.Client(transport="websockets")
+        # Create MQTT client for the transport selected by the URL scheme
+        self.client = mqtt_transport.create_mqtt_client(self.endpoint)
         self.is_running = False
         self.device_status = "online"
+        self.status_topic = f"smartfarm/devices/{self.device_id}/status"
+        self._stop_event = threading.Event()
+        
+        # QoS 1 publishes still waiting for their PUBACK
+        self._inflight = mqtt_transport.InflightTracker()
         
         # Device capabilities and current state
         self.device_state = {
@@ -77,11 +103,20 @@ class SmartFarmDeviceSimulator:
             "humidifier": False,
             "water_pump": False
         }
+        # Guards device_state between action handlers and the environment model's auto-offs
+        self.state_lock = threading.RLock()
         
         # Simulation settings
         self.success_rate = 0.85  # 85% success rate
         self.execution_delay_range = (0.5, 3.0)  # 0.5-3 seconds
         self.heartbeat_interval = 1800  # 30 minutes (30 * 60 seconds)
+        self.drain_timeout = 5.0  # Max seconds to wait for in-flight acks on shutdown
+        self.latency_model = latency_model  # Optional latency_model.LatencyModel replacing the flat draws above
+        self.tasks = TaskRegistry()  # In-flight command per actuator; a newer command preempts the older one
+        self.rate_limiter = None  # Optional rate_limit.RateLimiter modelling the device's uplink
+        self.loop_watchdog = None  # Optional loop_watchdog.LoopWatchdog timing network-thread callbacks
+        self.event_recorder = None  # Optional event_recorder.EventRecorder timing every command's stages
+        self.state_checkpoint = None  # Optional state_checkpoint.StateCheckpoint persisting device_state
         
         # Action mapping - only your real actions from sensors table
         self.action_handlers = {
@@ -101,34 +136,60 @@ class SmartFarmDeviceSimulator:
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.client.on_connect_fail = self.on_connect_fail
         
-        # Setup graceful shutdown
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
+        # Setup graceful shutdown (fleets install their own handlers instead)
+        if install_signal_handlers:
+            signal.signal(signal.SIGINT, self.signal_handler)
+            signal.signal(signal.SIGTERM, self.signal_handler)
     
     def parse_broker_url(self):
         """Parse the broker URL to extract host, port, and protocol"""
-        import urllib.parse
-        
-        parsed = urllib.parse.urlparse(self.broker_url)
-        self.broker_host = parsed.hostname
-        self.broker_port = parsed.port
-        self.use_ssl = parsed.scheme in ['wss', 'ssl', 'mqtts']
+        self.endpoint = mqtt_transport.parse_broker_url(self.broker_url)
+        self.broker_host = self.endpoint.host
+        self.broker_port = self.endpoint.port
+        self.use_ssl = self.endpoint.use_ssl
         
-        logger.info(f"🔗 Parsed broker: {self.broker_host}:{self.broker_port} (SSL: {self.use_ssl})")
+        logger.info(f"🔗 Parsed broker: {self.broker_host}:{self.broker_port} "
+                    f"({self.endpoint.transport}, SSL: {self.use_ssl})")
     
     def on_connect(self, client, userdata, flags, rc):
         """Callback for when the client receives a CONNACK response from the server"""
         if rc == 0:
             logger.info(f"🔗 Device {self.device_id} connected to MQTT broker")
+            if self.cluster is not None:
+                self.cluster.record_connect(self.broker_url)
+                self._cluster_connected = True
             self.subscribe_to_action_topics()
             self.publish_device_status("online")
         else:
             logger.error(f"❌ Failed to connect to MQTT broker. Return code: {rc}")
+            self.on_connect_fail(client, userdata)
     
     def on_disconnect(self, client, userdata, rc):
         """Callback for when the client disconnects from the server"""
         logger.warning(f"🔌 Device {self.device_id} disconnected from MQTT broker")
+        if self._cluster_connected:
+            self.cluster.record_disconnect(self.broker_url)
+            self._cluster_connected = False
+    
+    def on_connect_fail(self, client, userdata):
+        """Callback for a failed connection attempt: fail over if the endpoint is down"""
+        if self.cluster is None:
+            return
+        url = self.cluster.record_failure(self.broker_url, self.device_id)
+        if url != self.broker_url:
+            logger.warning(f"🔀 Device {self.device_id} failing over from {self.broker_url} to {url}")
+            self.broker_url = url
+            self.parse_broker_url()
+            mqtt_transport.retarget_client(self.client, self.endpoint)
+    
+    def on_publish(self, client, userdata, mid):
+        """Callback for when a QoS 1 publish has been acknowledged by the broker"""
+        self._inflight.acked(mid)
+        if self.event_recorder is not None:
+            self.event_recorder.puback(self.device_id, mid)
     
     def on_message(self, client, userdata, msg):
         """Callback for when a PUBLISH message is received from the server"""
@@ -174,18 +235,30 @@ class SmartFarmDeviceSimulator:
     
     def process_action(self, action: str, payload_str: str):
         """Process incoming action request"""
+        received = time.time_ns()
         try:
             # Parse payload
             payload = json.loads(payload_str)
             action_id = payload.get('actionId', 'unknown')
+            if self.event_recorder is not None:
+                self.event_recorder.record(RECEIVED, action_id, self.device_id, action, received)
             
             logger.info(f"🔧 Processing action: {action} (ID: {action_id})")
             logger.info(f"📋 Action payload: {payload_str}")
             
+            # Register in arrival order, so the newest command is the one that survives
+            task = self.tasks.submit(self.device_id, action, action_id)
+            if self.event_recorder is not None:
+                self.event_recorder.record(QUEUED, action_id, self.device_id, action)
+            if task.coalesced_into is not None:
+                # An identical command is already in flight; its ack covers this one
+                logger.info(f"🧮 Action {action} ({action_id}) coalesced into {task.coalesced_into.action_id}")
+                return
+            
             # Execute action in a separate thread to avoid blocking
             threading.Thread(
                 target=self.execute_action,
-                args=(action, action_id, payload),
+                args=(action, action_id, payload, task),
                 daemon=True
             ).start()
             
@@ -194,67 +267,98 @@ class SmartFarmDeviceSimulator:
         except Exception as e:
             logger.error(f"❌ Error processing action: {e}")
     
-    def execute_action(self, action: str, action_id: str, payload: Dict[str, Any]):
+    def execute_action(self, action: str, action_id: str, payload: Dict[str, Any], task=None):
         """Execute the hardware action (simulated)"""
         start_time = time.time()
+        if self.event_recorder is not None:
+            self.event_recorder.record(STARTED, action_id, self.device_id, action)
+        if task is None:
+            task = self.tasks.submit(self.device_id, action, action_id)
+            if task.coalesced_into is not None:
+                return
         
         try:
-            # Simulate execution delay
-            execution_time = random.uniform(*self.execution_delay_range)
-            time.sleep(execution_time)
-            
-            # Simulate success/failure
-            success = random.random() < self.success_rate
-            
-            if success and action in self.action_handlers:
-                # Execute the action handler
-                result = self.action_handlers[action]()
+            with task:
+                # Simulate execution delay and success/failure
+                failure = None
+                if self.latency_model is not None:
+                    execution_time, failure = self.latency_model.for_device(self.device_id).draw(action)
+                    success = failure is None
+                else:
+                    execution_time = random.uniform(*self.execution_delay_range)
+                    success = random.random() < self.success_rate
+                task.sleep(execution_time)
                 
-                if result["success"]:
-                    # Send success acknowledgment
-                    self.send_acknowledgment(action_id, "success", {
-                        "message": result["message"],
-                        "executionTime": round(time.time() - start_time, 2),
-                        "action": action,
-                        "deviceState": self.device_state.copy()
-                    })
-                    logger.info(f"✅ Action {action} completed successfully")
+                if success and action in self.action_handlers:
+                    # Execute the action handler
+                    self.tasks.start(task)
+                    result = self.action_handlers[action]()
+                
+                    if result["success"]:
+                        # Send success acknowledgment
+                        self.acknowledge_task(task, "success", {
+                            "message": result["message"],
+                            "executionTime": round(time.time() - start_time, 2),
+                            "action": action,
+                            "deviceState": self.device_state.copy()
+                        })
+                        logger.info(f"✅ Action {action} completed successfully")
+                    else:
+                        # Send failure acknowledgment
+                        self.acknowledge_task(task, "error", {
+                            "error": result["error"],
+                            "errorCode": result.get("errorCode", "EXECUTION_ERROR"),
+                            "action": action
+                        })
+                        logger.error(f"❌ Action {action} failed: {result['error']}")
                 else:
-                    # Send failure acknowledgment
-                    self.send_acknowledgment(action_id, "error", {
-                        "error": result["error"],
-                        "errorCode": result.get("errorCode", "EXECUTION_ERROR"),
+                    # Simulate random failure
+                    error_messages = [
+                        "Hardware component not responding",
+                        "GPIO pin malfunction",
+                        "Power supply insufficient",
+                        "Sensor calibration required",
+                        "Communication timeout with actuator"
+                    ]
+                
+                    self.acknowledge_task(task, "error", {
+                        "error": failure["error"] if failure else random.choice(error_messages),
+                        "errorCode": failure["errorCode"] if failure else "HARDWARE_ERROR",
                         "action": action
                     })
-                    logger.error(f"❌ Action {action} failed: {result['error']}")
-            else:
-                # Simulate random failure
-                error_messages = [
-                    "Hardware component not responding",
-                    "GPIO pin malfunction",
-                    "Power supply insufficient",
-                    "Sensor calibration required",
-                    "Communication timeout with actuator"
-                ]
-                
-                self.send_acknowledgment(action_id, "error", {
-                    "error": random.choice(error_messages),
-                    "errorCode": "HARDWARE_ERROR",
-                    "action": action
-                })
-                logger.error(f"❌ Action {action} failed (simulated failure)")
+                    logger.error(f"❌ Action {action} failed (simulated failure)")
                 
+        except Preempted:
+            # A newer command for the same actuator took over; report it and free the worker
+            self.acknowledge_task(task, "error", {
+                "error": f"Preempted by newer command {task.preempted_by}",
+                "errorCode": "PREEMPTED",
+                "preemptedBy": task.preempted_by,
+                "action": action
+            })
+            logger.info(f"⏭️ Action {action} preempted by {task.preempted_by}")
         except Exception as e:
             # Send error acknowledgment
-            self.send_acknowledgment(action_id, "error", {
+            self.acknowledge_task(task, "error", {
                 "error": f"Unexpected error: {str(e)}",
                 "errorCode": "SYSTEM_ERROR",
                 "action": action
             })
             logger.error(f"❌ Unexpected error executing {action}: {e}")
+        finally:
+            self.tasks.finish(task)
+    
+    def acknowledge_task(self, task, status: str, data: Dict[str, Any]):
+        """Acknowledge a task's command and every command coalesced into it"""
+        action_ids = self.tasks.seal(task)
+        self.send_acknowledgment(action_ids[0], status, data)
+        for action_id in action_ids[1:]:
+            self.send_acknowledgment(action_id, status, {**data, "coalescedInto": task.action_id})
     
     def send_acknowledgment(self, action_id: str, status: str, data: Dict[str, Any]):
         """Send acknowledgment back to the backend"""
+        if self.event_recorder is not None:
+            self.event_recorder.record(HANDLER_DONE, action_id, self.device_id, data.get("action", "unknown"))
         ack_topic = f"smartfarm/devices/{self.device_id}/ack"
         
         ack_payload = {
@@ -266,7 +370,8 @@ class SmartFarmDeviceSimulator:
         }
         
         try:
-            self.client.publish(ack_topic, json.dumps(ack_payload), qos=1)
+            self.publish(ack_topic, json.dumps(ack_payload), qos=1,
+                         ack=(action_id, self.device_id, data.get("action", "unknown")))
             logger.info(f"📤 Sent {status} acknowledgment for action {action_id}")
         except Exception as e:
             logger.error(f"❌ Failed to send acknowledgment: {e}")
@@ -276,8 +381,6 @@ class SmartFarmDeviceSimulator:
         if status:
             self.device_status = status
             
-        status_topic = f"smartfarm/devices/{self.device_id}/status"
-        
         status_payload = {
             "deviceId": self.device_id,
             "status": self.device_status,
@@ -289,23 +392,74 @@ class SmartFarmDeviceSimulator:
         }
         
         try:
-            self.client.publish(status_topic, json.dumps(status_payload), qos=1, retain=True)
+            self.publish(self.status_topic, json.dumps(status_payload), qos=1, retain=True)
             logger.debug(f"📊 Published device status: {self.device_status}")
         except Exception as e:
             logger.error(f"❌ Failed to publish device status: {e}")
     
+    def switch_off(self, actuator: str) -> bool:
+        """Switch an actuator off outside of any command (a relay timer) and publish the new state"""
+        off = "closed" if actuator == "roof" else False
+        with self.state_lock:
+            if self.device_state.get(actuator, off) == off:
+                return False
+            self.device_state[actuator] = off
+        logger.info(f"⏲️ {actuator} on {self.device_id} switched itself off")
+        self.publish_device_status()
+        return True
+    
+    def build_last_will_payload(self) -> Dict[str, Any]:
+        """Build the offline status the broker publishes if the connection is lost"""
+        return {
+            "deviceId": self.device_id,
+            "status": "offline",
+            "reason": "connection_lost",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "capabilities": list(self.action_handlers.keys())
+        }
+    
+    def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False,
+                ack: Tuple[str, str, str] = None) -> mqtt.MQTTMessageInfo:
+        """Publish a message, tracking QoS 1 publishes until the broker acknowledges them
+
+        ``ack`` is the (actionId, deviceId, action) of an acknowledgment, recorded
+        in the event recorder as handed to paho once the rate limiter let it through.
+        """
+        if self.rate_limiter is not None:
+            size = mqtt_wire.publish_packet_size(len(topic), len(payload.encode('utf-8')), qos, False)
+            self.rate_limiter.acquire(size, block=not mqtt_transport.on_network_thread(self.client))
+        published_at = time.time_ns()
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        self._inflight.sent(info, qos)
+        if ack is not None and self.event_recorder is not None:
+            self.event_recorder.ack_published(self.device_id, info, *ack, ts=published_at)
+        if self.cluster is not None:
+            self.cluster.record_publish(self.broker_url)
+        return info
+    
+    def drain(self, deadline: float) -> bool:
+        """Wait until every in-flight publish is acknowledged or the deadline passes"""
+        pending = self._inflight.wait(deadline)
+        if pending:
+            logger.warning(f"⚠️ {pending} message(s) still in flight for {self.device_id} at shutdown")
+        return pending == 0
+    
     def start_heartbeat(self):
         """Start periodic heartbeat/status updates"""
         def heartbeat_loop():
             while self.is_running:
                 self.publish_device_status()
-                time.sleep(self.heartbeat_interval)
+                self._stop_event.wait(self.heartbeat_interval)
         
         threading.Thread(target=heartbeat_loop, daemon=True).start()
         logger.info(f"💓 Started heartbeat every {self.heartbeat_interval} seconds")
     
-    def start(self):
-        """Start the device simulator"""
+    def start(self, blocking: bool = True):
+        """Start the device simulator
+        
+        With ``blocking=False`` the connection is made in the background and
+        control returns immediately, which is how fleets start many devices.
+        """
         try:
             logger.info(f"🚀 Starting Smart Farm Device Simulator")
             logger.info(f"📱 Device ID: {self.device_id}")
@@ -324,29 +478,42 @@ class SmartFarmDeviceSimulator:
             
             self.start_time = time.time()
             self.is_running = True
+            self._stop_event.clear()
             
             # Set up authentication
             if self.username and self.password:
                 self.client.username_pw_set(self.username, self.password)
                 logger.info(f"🔐 Authentication configured")
             
-            # Set up SSL/TLS for WSS connections
+            # Set up SSL/TLS for mqtts/wss connections
             if self.use_ssl:
-                context = ssl.create_default_context()
-                context.check_hostname = False
-                context.verify_mode = ssl.CERT_NONE
+                context = self.ssl_context or mqtt_transport.get_shared_ssl_context(self.ca_file, self.tls_insecure)
                 self.client.tls_set_context(context)
                 logger.info(f"🔒 SSL/TLS configured for secure connection")
             
+            # Let the broker mark us offline if we vanish without a clean shutdown
+            self.client.will_set(self.status_topic, json.dumps(self.build_last_will_payload()), qos=1, retain=True)
+            
+            if self.loop_watchdog is not None:
+                self.loop_watchdog.instrument(self.client, self.device_id)
+            
             # Connect to MQTT broker
             logger.info(f"🔌 Connecting to {self.broker_host}:{self.broker_port}...")
-            self.client.connect(self.broker_host, self.broker_port, 60)
+            # A cluster connects in the background so failed endpoints can fail over
+            if blocking and self.cluster is None:
+                self.client.connect(self.broker_host, self.broker_port, 60)
+            else:
+                self.client.connect_async(self.broker_host, self.broker_port, 60)
+            
+            # Run the network loop in the background so shutdown can drain acks
+            self.client.loop_start()
             
             # Start heartbeat
             self.start_heartbeat()
             
-            # Start MQTT loop
-            self.client.loop_forever()
+            if blocking:
+                while not self._stop_event.wait(1.0):
+                    pass
             
         except Exception as e:
             logger.error(f"❌ Failed to start device simulator: {e}")
@@ -355,18 +522,46 @@ class SmartFarmDeviceSimulator:
     def stop(self):
         """Stop the device simulator"""
         logger.info(f"🛑 Stopping device simulator...")
+        in_flight = self.tasks.in_flight()
+        if in_flight:
+            logger.warning(f"⏳ {len(in_flight)} command(s) still executing at shutdown: {format_in_flight(in_flight)}")
+        self.begin_shutdown()
+        self.drain(time.time() + self.drain_timeout)
+        self.finish_shutdown()
+        if self.cluster is not None:
+            logger.info(f"🕸️ Brokers: {self.cluster.format_summary()}")
+        if self.rate_limiter is not None:
+            logger.info(f"🚦 Uplink {self.rate_limiter.stats.format_summary()}")
+        if self.loop_watchdog is not None:
+            self.loop_watchdog.stop()
+            logger.info(f"🩺 Network loop: {self.loop_watchdog.format_summary()}")
+        if self.event_recorder is not None:
+            self.event_recorder.close()
+            logger.info(f"🧾 Events: {self.event_recorder.format_summary()}")
+        if self.tasks.coalesce_window > 0:
+            logger.info(f"🧮 Coalescing: {format_counts(self.tasks.counts)}")
+        if self.state_checkpoint is not None:
+            self.state_checkpoint.stop()
+            logger.info(f"💾 State: {self.state_checkpoint.format_summary()}")
+        logger.info(f"✅ Device simulator stopped")
+    
+    def begin_shutdown(self):
+        """Stop background work and publish the final offline status"""
         self.is_running = False
+        self._stop_event.set()
         
-        # Publish offline status
+        # A clean disconnect suppresses the Last Will, so announce offline ourselves
         self.publish_device_status("offline")
-        time.sleep(1)  # Give time for message to be sent
-        
-        # Disconnect from MQTT
+    
+    def finish_shutdown(self):
+        """Disconnect from MQTT and stop the network loop"""
         self.client.disconnect()
-        logger.info(f"✅ Device simulator stopped")
+        self.client.loop_stop()
     
     def signal_handler(self, signum, frame):
         """Handle shutdown signals"""
+        if self._stop_event.is_set():
+            return  # Shutdown already in progress
         logger.info(f"📡 Received signal {signum}, shutting down...")
         self.stop()
         sys.exit(0)
@@ -381,8 +576,9 @@ class SmartFarmDeviceSimulator:
             return {"success": False, "error": "Fan is already running", "errorCode": "ALREADY_ON"}
         
         # Simulate GPIO control
-        time.sleep(0.1)  # GPIO switching delay
-        self.device_state["fan"] = True
+        task_sleep(0.1)  # GPIO switching delay
+        with self.state_lock:
+            self.device_state["fan"] = True
         return {"success": True, "message": "Fan turned on successfully"}
     
     def handle_fan_off(self) -> Dict[str, Any]:
@@ -390,8 +586,9 @@ class SmartFarmDeviceSimulator:
         if not self.device_state["fan"]:
             return {"success": False, "error": "Fan is already off", "errorCode": "ALREADY_OFF"}
         
-        time.sleep(0.1)
-        self.device_state["fan"] = False
+        task_sleep(0.1)
+        with self.state_lock:
+            self.device_state["fan"] = False
         return {"success": True, "message": "Fan turned off successfully"}
     
     def handle_irrigation_on(self) -> Dict[str, Any]:
@@ -400,8 +597,9 @@ class SmartFarmDeviceSimulator:
             return {"success": False, "error": "Irrigation is already running", "errorCode": "ALREADY_ON"}
         
         # Simulate water pump startup
-        time.sleep(0.5)  # Pump startup delay
-        self.device_state["irrigation"] = True
+        task_sleep(0.5)  # Pump startup delay
+        with self.state_lock:
+            self.device_state["irrigation"] = True
         return {"success": True, "message": "Irrigation system activated"}
     
     def handle_irrigation_off(self) -> Dict[str, Any]:
@@ -409,8 +607,9 @@ class SmartFarmDeviceSimulator:
         if not self.device_state["irrigation"]:
             return {"success": False, "error": "Irrigation is already off", "errorCode": "ALREADY_OFF"}
         
-        time.sleep(0.3)
-        self.device_state["irrigation"] = False
+        task_sleep(0.3)
+        with self.state_lock:
+            self.device_state["irrigation"] = False
         return {"success": True, "message": "Irrigation system deactivated"}
     
     def handle_heater_on(self) -> Dict[str, Any]:
@@ -418,8 +617,9 @@ class SmartFarmDeviceSimulator:
         if self.device_state["heater"]:
             return {"success": False, "error": "Heater is already on", "errorCode": "ALREADY_ON"}
         
-        time.sleep(0.2)
-        self.device_state["heater"] = True
+        task_sleep(0.2)
+        with self.state_lock:
+            self.device_state["heater"] = True
         return {"success": True, "message": "Heater activated"}
     
     def handle_heater_off(self) -> Dict[str, Any]:
@@ -427,8 +627,9 @@ class SmartFarmDeviceSimulator:
         if not self.device_state["heater"]:
             return {"success": False, "error": "Heater is already off", "errorCode": "ALREADY_OFF"}
         
-        time.sleep(0.2)
-        self.device_state["heater"] = False
+        task_sleep(0.2)
+        with self.state_lock:
+            self.device_state["heater"] = False
         return {"success": True, "message": "Heater deactivated"}
     
     def handle_lights_on(self) -> Dict[str, Any]:
@@ -436,8 +637,9 @@ class SmartFarmDeviceSimulator:
         if self.device_state["lights"]:
             return {"success": False, "error": "Lights are already on", "errorCode": "ALREADY_ON"}
         
-        time.sleep(0.1)
-        self.device_state["lights"] = True
+        task_sleep(0.1)
+        with self.state_lock:
+            self.device_state["lights"] = True
         return {"success": True, "message": "Lights turned on"}
     
     def handle_lights_off(self) -> Dict[str, Any]:
@@ -445,8 +647,9 @@ class SmartFarmDeviceSimulator:
         if not self.device_state["lights"]:
             return {"success": False, "error": "Lights are already off", "errorCode": "ALREADY_OFF"}
         
-        time.sleep(0.1)
-        self.device_state["lights"] = False
+        task_sleep(0.1)
+        with self.state_lock:
+            self.device_state["lights"] = False
         return {"success": True, "message": "Lights turned off"}
     
     def handle_open_roof(self) -> Dict[str, Any]:
@@ -455,8 +658,9 @@ class SmartFarmDeviceSimulator:
             return {"success": False, "error": "Roof is already open", "errorCode": "ALREADY_OPEN"}
         
         # Simulate motor operation
-        time.sleep(2.0)  # Roof opening takes time
-        self.device_state["roof"] = "open"
+        task_sleep(2.0)  # Roof opening takes time
+        with self.state_lock:
+            self.device_state["roof"] = "open"
         return {"success": True, "message": "Roof opened successfully"}
     
     def handle_close_roof(self) -> Dict[str, Any]:
@@ -464,8 +668,9 @@ class SmartFarmDeviceSimulator:
         if self.device_state["roof"] == "closed":
             return {"success": False, "error": "Roof is already closed", "errorCode": "ALREADY_CLOSED"}
         
-        time.sleep(2.0)
-        self.device_state["roof"] = "closed"
+        task_sleep(2.0)
+        with self.state_lock:
+            self.device_state["roof"] = "closed"
         return {"success": True, "message": "Roof closed successfully"}
     
     def handle_alarm_on(self) -> Dict[str, Any]:
@@ -473,8 +678,9 @@ class SmartFarmDeviceSimulator:
         if self.device_state["alarm"]:
             return {"success": False, "error": "Alarm is already active", "errorCode": "ALREADY_ON"}
         
-        time.sleep(0.1)
-        self.device_state["alarm"] = True
+        task_sleep(0.1)
+        with self.state_lock:
+            self.device_state["alarm"] = True
         return {"success": True, "message": "Alarm activated"}
     
     def handle_alarm_off(self) -> Dict[str, Any]:
@@ -482,8 +688,9 @@ class SmartFarmDeviceSimulator:
         if not self.device_state["alarm"]:
             return {"success": False, "error": "Alarm is already off", "errorCode": "ALREADY_OFF"}
         
-        time.sleep(0.1)
-        self.device_state["alarm"] = False
+        task_sleep(0.1)
+        with self.state_lock:
+            self.device_state["alarm"] = False
         return {"success": True, "message": "Alarm deactivated"}
     
     def handle_restart(self) -> Dict[str, Any]:
@@ -491,23 +698,14 @@ class SmartFarmDeviceSimulator:
         logger.info("🔄 Simulating device restart...")
         
         # Simulate restart sequence
-        time.sleep(1.0)  # Shutdown delay
+        task_sleep(1.0)  # Shutdown delay
         
-        # Reset all states
-        self.device_state = {
-            "fan": False,
-            "irrigation": False,
-            "heater": False,
-            "lights": False,
-            "roof": "closed",
-            "alarm": False,
-            # New actuators from your sensors table
-            "ventilator": False,
-            "humidifier": False,
-            "water_pump": False
-        }
+        # Reset all states in place: the environment model and checkpoints hold this dict
+        with self.state_lock:
+            for key in self.device_state:
+                self.device_state[key] = "closed" if key == "roof" else False
         
-        time.sleep(2.0)  # Boot delay
+        task_sleep(2.0)  # Boot delay
         return {"success": True, "message": "Device restarted successfully"}
     
     def handle_calibrate(self) -> Dict[str, Any]:
@@ -515,7 +713,7 @@ class SmartFarmDeviceSimulator:
         logger.info("📏 Simulating sensor calibration...")
         
         # Simulate calibration process
-        time.sleep(3.0)  # Calibration takes time
+        task_sleep(3.0)  # Calibration takes time
         
         # Random calibration success/failure
         if random.random() < 0.9:  # 90% success rate for calibration
@@ -537,8 +735,9 @@ class SmartFarmDeviceSimulator:
             return {"success": False, "error": "Ventilator is already running", "errorCode": "ALREADY_ON"}
         
         logger.info("🌪️ Turning ventilator ON for temperature control...")
-        time.sleep(0.2)  # Simulate motor startup
-        self.device_state["ventilator"] = True
+        task_sleep(0.2)  # Simulate motor startup
+        with self.state_lock:
+            self.device_state["ventilator"] = True
         return {"success": True, "message": "Ventilator turned on successfully"}
     
     def handle_ventilator_off(self) -> Dict[str, Any]:
@@ -547,8 +746,9 @@ class SmartFarmDeviceSimulator:
             return {"success": False, "error": "Ventilator is already off", "errorCode": "ALREADY_OFF"}
         
         logger.info("🌪️ Turning ventilator OFF...")
-        time.sleep(0.1)
-        self.device_state["ventilator"] = False
+        task_sleep(0.1)
+        with self.state_lock:
+            self.device_state["ventilator"] = False
         return {"success": True, "message": "Ventilator turned off successfully"}
     
     def handle_humidifier_on(self) -> Dict[str, Any]:
@@ -557,8 +757,9 @@ class SmartFarmDeviceSimulator:
             return {"success": False, "error": "Humidifier is already running", "errorCode": "ALREADY_ON"}
         
         logger.info("💨 Turning humidifier ON for humidity control...")
-        time.sleep(0.3)  # Simulate water pump startup
-        self.device_state["humidifier"] = True
+        task_sleep(0.3)  # Simulate water pump startup
+        with self.state_lock:
+            self.device_state["humidifier"] = True
         return {"success": True, "message": "Humidifier turned on successfully"}
     
     def handle_water_pump_on(self) -> Dict[str, Any]:
@@ -567,8 +768,9 @@ class SmartFarmDeviceSimulator:
             return {"success": False, "error": "Water pump is already running", "errorCode": "ALREADY_ON"}
         
         logger.info("💧 Turning water pump ON for soil irrigation...")
-        time.sleep(0.5)  # Simulate pump startup and pressure build
-        self.device_state["water_pump"] = True
+        task_sleep(0.5)  # Simulate pump startup and pressure build
+        with self.state_lock:
+            self.device_state["water_pump"] = True
         return {"success": True, "message": "Water pump turned on successfully"}
     
     def handle_light_on(self) -> Dict[str, Any]:
@@ -577,8 +779,9 @@ class SmartFarmDeviceSimulator:
             return {"success": False, "error": "Lights are already on", "errorCode": "ALREADY_ON"}
         
         logger.info("💡 Turning lights ON for supplemental lighting...")
-        time.sleep(0.1)  # LED startup is instant
-        self.device_state["lights"] = True
+        task_sleep(0.1)  # LED startup is instant
+        with self.state_lock:
+            self.device_state["lights"] = True
         return {"success": True, "message": "Lights turned on successfully"}
 
 
@@ -589,13 +792,41 @@ def main():
                        help='Device ID (default: dht11h)')
     parser.add_argument('--broker-url', '-b', 
                        default='wss://i37c1733.ala.us-east-1.emqxsl.com:8084/mqtt',
-                       help='MQTT broker URL (default: EMQX Cloud WSS)')
+                       help='MQTT broker URL: mqtt://, mqtts://, ws:// or wss:// (default: EMQX Cloud WSS); '
+                            'several comma-separated URLs spread devices over a cluster')
     parser.add_argument('--username', '-u', default='oussama2255',
                        help='MQTT username (default: oussama2255)')
     parser.add_argument('--password', '-p', default='Oussama2255',
                        help='MQTT password (default: Oussama2255)')
     parser.add_argument('--success-rate', '-s', type=float, default=0.85,
                        help='Action success rate 0.0-1.0 (default: 0.85)')
+    parser.add_argument('--drain-timeout', type=float, default=5.0,
+                       help='Max seconds to wait for in-flight acks on shutdown (default: 5.0)')
+    parser.add_argument('--ca-file', default=mqtt_transport.DEFAULT_CA_FILE,
+                       help='CA certificate for mqtts/wss brokers (default: certs/emqxsl-ca.crt)')
+    parser.add_argument('--insecure', action='store_true',
+                       help='Skip TLS certificate verification')
+    parser.add_argument('--latency-model', default=None,
+                       help='JSON latency/failure model file (see latency_model.py); replaces --success-rate')
+    parser.add_argument('--seed', type=int, default=None,
+                       help='Random seed for the latency model')
+    parser.add_argument('--rate-profile', default=None,
+                       help='Throttle outbound messages like a constrained uplink: esp32-2g, esp32-lte-m, '
+                            'esp32-wifi, pi-wifi, pi-fibre or MSGS:BYTES per second (default: unlimited)')
+    parser.add_argument('--loop-watchdog', type=float, default=0, metavar='MS',
+                       help='Warn with a stack sample when a network-loop callback runs over MS milliseconds, '
+                            'and track keepalive margin (default: off)')
+    parser.add_argument('--record-events', default=None, metavar='PATH',
+                       help='Record every command\'s stage timestamps to PATH for event_recorder.py (default: off)')
+    parser.add_argument('--checkpoint', default=None, metavar='PATH',
+                       help='Restore actuator state from PATH on start and checkpoint it there (default: off)')
+    parser.add_argument('--checkpoint-interval', type=float, default=5.0, metavar='SECONDS',
+                       help='With --checkpoint, seconds between incremental checkpoints (default: 5)')
+    parser.add_argument('--no-preemption', action='store_true',
+                       help='Let every command run to completion instead of preempting older ones per actuator')
+    parser.add_argument('--coalesce-window', type=float, default=0, metavar='SECONDS',
+                       help='Merge a repeated command into the identical one still in flight if it arrives within '
+                            'SECONDS of it; every command still gets its own ack (default: off)')
     parser.add_argument('--verbose', '-v', action='store_true',
                        help='Enable verbose logging')
     
@@ -609,11 +840,34 @@ def main():
         device_id=args.device_id,
         broker_url=args.broker_url,
         username=args.username,
-        password=args.password
+        password=args.password,
+        ca_file=args.ca_file,
+        tls_insecure=args.insecure
     )
     
+    if args.latency_model:
+        from latency_model import LatencyModel
+        device.latency_model = LatencyModel.from_file(args.latency_model, seed=args.seed)
+    
     # Set success rate
     device.success_rate = max(0.0, min(1.0, args.success_rate))
+    device.drain_timeout = max(0.0, args.drain_timeout)
+    device.tasks.preempt = not args.no_preemption
+    device.tasks.coalesce_window = max(0.0, args.coalesce_window)
+    if args.rate_profile:
+        from rate_limit import RateLimiter, parse_rate_profile
+        device.rate_limiter = RateLimiter(parse_rate_profile(args.rate_profile))
+    if args.loop_watchdog > 0:
+        from loop_watchdog import LoopWatchdog
+        device.loop_watchdog = LoopWatchdog(args.loop_watchdog / 1000.0)
+    if args.record_events:
+        from event_recorder import EventRecorder
+        device.event_recorder = EventRecorder(args.record_events)
+    if args.checkpoint:
+        from state_checkpoint import StateCheckpoint
+        device.state_checkpoint = StateCheckpoint(args.checkpoint, max(0.1, args.checkpoint_interval))
+        device.state_checkpoint.restore({device.device_id: device.device_state})
+        device.state_checkpoint.start(lambda: {device.device_id: device.device_state})
     
     try:
         device.start()
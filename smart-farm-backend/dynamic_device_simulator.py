@@ -14,12 +14,16 @@ import ssl
 import argparse
 import logging
 from datetime import datetime, timezone
-from typing import Dict, Any, List
-from urllib.parse import urlparse
+from typing import Dict, Any, List, Tuple
 import requests
 
 import paho.mqtt.client as mqtt
 
+import mqtt_transport
+import mqtt_wire
+from action_tasks import ActionTask, Preempted, TaskRegistry, format_counts, format_in_flight, task_sleep
+from event_recorder import RECEIVED, QUEUED, STARTED, HANDLER_DONE
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -31,57 +35,136 @@ logger = logging.getLogger(__name__)
 class DynamicSmartFarmDeviceSimulator:
     """Dynamic Smart Farm IoT device simulator that fetches actions from the database"""
     
-    def __init__(self, device_id: str, broker_url: str = None, username: str = None, password: str = None, backend_url: str = None):
+    def __init__(self, device_id: str, broker_url: str = None, username: str = None, password: str = None, backend_url: str = None,
+                 install_signal_handlers: bool = True, share_group: str = None, use_mqtt5: bool = False,
+                 ssl_context: ssl.SSLContext = None, ca_file: str = None, tls_insecure: bool = False,
+                 topic_aliases: bool = False, payload_profile: str = "verbose", latency_model=None,
+                 cluster: mqtt_transport.BrokerCluster = None):
         self.device_id = device_id
         self.broker_url = broker_url or "wss://i37c1733.ala.us-east-1.emqxsl.com:8084/mqtt"
         self.username = username or "oussama2255"
         self.password = password or "Oussama2255"
         self.backend_url = backend_url or "http://localhost:3000/api"
         
+        # TLS settings; by default all simulators in a process share one context
+        self.ssl_context = ssl_context
+        self.ca_file = ca_file or mqtt_transport.DEFAULT_CA_FILE
+        self.tls_insecure = tls_insecure
+        
+        # Shared subscriptions ($share/<group>/...) load-balance commands across
+        # a pool of simulator nodes and require MQTT 5
+        self.share_group = share_group
+        self.use_mqtt5 = use_mqtt5 or bool(share_group) or topic_aliases
+        
+        # Wire-size options for high-rate traffic (see mqtt_wire)
+        self.topic_aliases = mqtt_wire.TopicAliasTable() if topic_aliases else None
+        self.payload_profile = payload_profile
+        self.wire_stats = mqtt_wire.WireStats()
+        self._published_capabilities = None
+        self._capabilities_bytes = 0  # json.dumps size of the capabilities last sent in a compact status
+        
+        # Several comma-separated broker URLs: consistent-hash this device onto one
+        # (fleets pass one shared cluster so endpoint health is shared too)
+        self.cluster = cluster or (mqtt_transport.BrokerCluster.from_urls(self.broker_url)
+                                   if ',' in self.broker_url else None)
+        if self.cluster is not None:
+            self.broker_url = self.cluster.assign(self.device_id)
+        self._cluster_connected = False
+        
         # Parse broker URL
         self.parse_broker_url()
         
-        # Create MQTT client with WebSocket support
-        self.client = mqtt.Client(transport="websockets")
+        # Create MQTT client for the transport selected by the URL scheme
+        protocol = mqtt.MQTTv5 if self.use_mqtt5 else mqtt.MQTTv311
+        self.client = mqtt_transport.create_mqtt_client(self.endpoint, protocol=protocol)
         self.is_running = False
         self.device_status = "online"
+        self.status_topic = f"smartfarm/devices/{self.device_id}/status"
+        self._stop_event = threading.Event()
+        
+        # QoS 1 publishes still waiting for their PUBACK
+        self._inflight = mqtt_transport.InflightTracker()
         
         # Dynamic device state (will be populated from database)
         self.device_state = {}
         
+        # Per-device state partitions; in a share group this node executes
+        # commands for any device, so each one gets its own copy of device_state
+        self.device_states = {self.device_id: self.device_state}
+        self._partition_lock = threading.Lock()
+        # Guards device state between action handlers and the environment model's auto-offs
+        self.state_lock = threading.RLock()
+        
         # Dynamic action handlers (will be populated from database)
         self.action_handlers = {}
         self.supported_actions = []
+        self._action_catalog: Dict[str, tuple] = {}
+        self._catalog_etag = None
+        self.reload_stats = {"reloads": 0, "changes": 0, "lastLatencyMs": 0.0, "maxLatencyMs": 0.0}
+        # In-flight command per (device, actuator); a newer command preempts the older one
+        self.tasks = TaskRegistry(lambda action: self.get_state_key_from_action(action) or action)
         
         # Simulation settings
         self.success_rate = 0.85  # 85% success rate
         self.execution_delay_range = (0.5, 3.0)  # 0.5-3 seconds
         self.heartbeat_interval = 1800  # 30 minutes (30 * 60 seconds)
+        self.drain_timeout = 5.0  # Max seconds to wait for in-flight acks on shutdown
+        self.latency_model = latency_model  # Optional latency_model.LatencyModel replacing the flat draws above
+        self.telemetry = None  # Optional environment_model.TelemetryPublisher for sensor readings
+        self.rate_limiter = None  # Optional rate_limit.RateLimiter modelling the device's uplink
+        self.loop_watchdog = None  # Optional loop_watchdog.LoopWatchdog timing network-thread callbacks
+        self.event_recorder = None  # Optional event_recorder.EventRecorder timing every command's stages
+        self.state_checkpoint = None  # Optional state_checkpoint.StateCheckpoint persisting device_state
+        self.action_catalog = None  # Optional action list used instead of the backend (e.g. from a scenario)
+        self.catalog_refresh_interval = 0  # Seconds between action catalog reloads; 0 disables
         
         # Setup MQTT callbacks
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.client.on_connect_fail = self.on_connect_fail
         
-        # Setup signal handlers
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
+        # Setup signal handlers (fleets install their own handlers instead)
+        if install_signal_handlers:
+            signal.signal(signal.SIGINT, self.signal_handler)
+            signal.signal(signal.SIGTERM, self.signal_handler)
+            if hasattr(signal, 'SIGHUP'):
+                signal.signal(signal.SIGHUP, self.reload_signal_handler)
     
     def parse_broker_url(self):
         """Parse broker URL to extract connection details"""
-        parsed = urlparse(self.broker_url)
-        self.broker_host = parsed.hostname
-        self.broker_port = parsed.port or (8084 if parsed.scheme == 'wss' else 1883)
-        self.use_ssl = parsed.scheme in ['wss', 'ssl']
+        self.endpoint = mqtt_transport.parse_broker_url(self.broker_url)
+        self.broker_host = self.endpoint.host
+        self.broker_port = self.endpoint.port
+        self.use_ssl = self.endpoint.use_ssl
     
-    def fetch_device_actions(self) -> List[Dict[str, Any]]:
-        """Fetch device actions from the backend API"""
+    def fetch_device_actions(self, conditional: bool = False) -> List[Dict[str, Any]]:
+        """Fetch device actions from the backend API
+        
+        With ``conditional=True`` (catalog reloads) the request carries the
+        previous ETag and returns None when the catalog is unchanged; errors
+        are raised instead of falling back to the basic actions.
+        """
+        if self.action_catalog is not None:
+            return self.action_catalog
+        
+        url = f"{self.backend_url}/devices/{self.device_id}/actions"
+        if conditional:
+            headers = {"If-None-Match": self._catalog_etag} if self._catalog_etag else {}
+            response = requests.get(url, headers=headers, timeout=10)
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+            self._catalog_etag = response.headers.get('ETag')
+            return response.json()
+        
         try:
-            url = f"{self.backend_url}/devices/{self.device_id}/actions"
             logger.info(f"🔍 Fetching actions from: {url}")
             
             response = requests.get(url, timeout=10)
             response.raise_for_status()
+            self._catalog_etag = response.headers.get('ETag')
             
             actions = response.json()
             logger.info(f"✅ Fetched {len(actions)} actions from database")
@@ -120,8 +203,14 @@ class DynamicSmartFarmDeviceSimulator:
         
         # Fetch actions from database
         actions = self.fetch_device_actions()
+        self.apply_action_catalog(actions)
         
-        # Process each action
+        logger.info(f"🎯 Configured {len(self.supported_actions)} dynamic actions")
+        logger.info(f"📊 Device state initialized: {self.device_state}")
+    
+    def parse_action_catalog(self, actions: List[Dict[str, Any]]) -> Dict[str, tuple]:
+        """Map action name -> (display name, category, action type) for the mqtt: actions of a catalog"""
+        catalog = {}
         for action in actions:
             try:
                 action_uri = action.get('actionUri', '')
@@ -133,69 +222,143 @@ class DynamicSmartFarmDeviceSimulator:
                 action_name = action_uri.split('/')[-1]
                 
                 if action_name:
-                    self.supported_actions.append(action_name)
-                    
-                    # Create dynamic handler
-                    self.action_handlers[action_name] = self.create_dynamic_handler(
-                        action_name, 
+                    catalog[action_name] = (
                         action.get('name', action_name),
                         action.get('category', 'system'),
                         action.get('actionType', 'normal')
                     )
-                    
-                    # Initialize device state
-                    state_key = self.get_state_key_from_action(action_name)
-                    if state_key and state_key not in self.device_state:
-                        self.device_state[state_key] = self.get_initial_state_value(action_name)
-                    
-                    logger.info(f"✅ Configured action: {action_name} ({action.get('actionType', 'normal')})")
-                    
             except Exception as e:
                 logger.error(f"❌ Error processing action {action}: {e}")
+        return catalog
+    
+    def apply_action_catalog(self, actions: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+        """Install a catalog, changing only what differs from the current one
         
-        logger.info(f"🎯 Configured {len(self.supported_actions)} dynamic actions")
-        logger.info(f"📊 Device state initialized: {self.device_state}")
+        Handlers are built for new or changed actions and swapped in as one
+        dict, so a command never sees a half-updated catalog. Only new
+        device_state keys are initialized, and only the topics that changed are
+        (un)subscribed. Returns the added, removed and changed action names.
+        """
+        catalog = self.parse_action_catalog(actions)
+        previous = self._action_catalog
+        added = [name for name in catalog if name not in previous]
+        removed = [name for name in previous if name not in catalog]
+        changed = [name for name in catalog if name in previous and catalog[name] != previous[name]]
+        
+        handlers = {name: handler for name, handler in self.action_handlers.items() if name in catalog}
+        for name in added + changed:
+            display_name, category, action_type = catalog[name]
+            handlers[name] = self.create_dynamic_handler(name, display_name, category, action_type)
+            if name in added:
+                logger.info(f"✅ Configured action: {name} ({action_type})")
+        
+        # Initialize device state for new keys only, in every partition
+        for name in added:
+            state_key = self.get_state_key_from_action(name)
+            if state_key:
+                with self._partition_lock:
+                    for device_state in self.device_states.values():
+                        if state_key not in device_state:
+                            device_state[state_key] = self.get_initial_state_value(name)
+        
+        # Atomic swap: readers take one reference to the dict
+        self.action_handlers = handlers
+        self.supported_actions = list(catalog)
+        self._action_catalog = catalog
+        
+        if self.is_running and not self.share_group and (added or removed):
+            base_topic = f"smartfarm/actuators/{self.device_id}"
+            if added:
+                self.client.subscribe([(f"{base_topic}/{name}", 0) for name in added])
+            if removed:
+                self.client.unsubscribe([f"{base_topic}/{name}" for name in removed])
+        
+        return {"added": added, "removed": removed, "changed": changed}
+    
+    def reload_actions(self) -> Dict[str, Any]:
+        """Re-fetch the catalog and apply the difference without reconnecting"""
+        started = time.perf_counter()
+        try:
+            actions = self.fetch_device_actions(conditional=True)
+        except Exception as e:
+            logger.warning(f"⚠️ Catalog reload failed, keeping {len(self.supported_actions)} actions: {e}")
+            return None
+        
+        if actions is None:
+            diff = {"added": [], "removed": [], "changed": []}
+        else:
+            diff = self.apply_action_catalog(actions)
+        
+        latency_ms = (time.perf_counter() - started) * 1000
+        changes = sum(len(names) for names in diff.values())
+        stats = self.reload_stats
+        stats["reloads"] += 1
+        stats["changes"] += changes
+        stats["lastLatencyMs"] = round(latency_ms, 1)
+        stats["maxLatencyMs"] = round(max(stats["maxLatencyMs"], latency_ms), 1)
+        
+        if changes:
+            logger.info(f"🔁 Catalog reloaded in {latency_ms:.1f} ms: +{len(diff['added'])} "
+                        f"-{len(diff['removed'])} ~{len(diff['changed'])} "
+                        f"({', '.join(diff['added'] + diff['removed'] + diff['changed'])})")
+            # Let the backend see the new capabilities right away
+            self.publish_device_status()
+        else:
+            logger.debug(f"🔁 Catalog unchanged ({latency_ms:.1f} ms)")
+        return dict(diff, latencyMs=round(latency_ms, 1))
+    
+    def start_catalog_refresh(self):
+        """Periodically reload the action catalog"""
+        def refresh_loop():
+            while not self._stop_event.wait(self.catalog_refresh_interval):
+                self.reload_actions()
+        
+        threading.Thread(target=refresh_loop, daemon=True).start()
+        logger.info(f"🔁 Refreshing action catalog every {self.catalog_refresh_interval} seconds")
     
     def create_dynamic_handler(self, action_name: str, display_name: str, category: str, action_type: str):
         """Create a dynamic action handler"""
-        def handler() -> Dict[str, Any]:
+        def handler(device_state: Dict[str, Any] = None) -> Dict[str, Any]:
+            if device_state is None:
+                device_state = self.device_state
             try:
                 logger.info(f"🔧 Executing {display_name} ({action_name})")
                 
                 # Simulate execution delay
                 execution_time = random.uniform(0.1, 0.5)
-                time.sleep(execution_time)
+                task_sleep(execution_time)
                 
                 # Get state key and determine action
                 state_key = self.get_state_key_from_action(action_name)
                 is_on_action = action_name.endswith('_on') or action_name in ['open_roof', 'calibrate', 'restart']
                 
                 if state_key:
-                    current_state = self.device_state.get(state_key, False)
-                    
-                    # Check if action is valid
-                    if is_on_action and current_state:
-                        return {
-                            "success": False,
-                            "error": f"{display_name} is already running",
-                            "errorCode": "ALREADY_ON"
-                        }
-                    elif not is_on_action and not current_state:
-                        return {
-                            "success": False,
-                            "error": f"{display_name} is already off",
-                            "errorCode": "ALREADY_OFF"
-                        }
-                    
-                    # Update state
-                    if state_key in ['roof']:
-                        self.device_state[state_key] = "open" if is_on_action else "closed"
-                    else:
-                        self.device_state[state_key] = is_on_action
+                    with self.state_lock:
+                        current_state = device_state.get(state_key, False)
+                        
+                        # Check if action is valid
+                        if is_on_action and current_state:
+                            return {
+                                "success": False,
+                                "error": f"{display_name} is already running",
+                                "errorCode": "ALREADY_ON"
+                            }
+                        elif not is_on_action and not current_state:
+                            return {
+                                "success": False,
+                                "error": f"{display_name} is already off",
+                                "errorCode": "ALREADY_OFF"
+                            }
+                        
+                        # Update state
+                        if state_key in ['roof']:
+                            device_state[state_key] = "open" if is_on_action else "closed"
+                        else:
+                            device_state[state_key] = is_on_action
                 
                 # Special handling for specific actions
                 if action_name == 'restart':
-                    return self.handle_restart()
+                    return self.handle_restart(device_state)
                 elif action_name == 'calibrate':
                     return self.handle_calibrate()
                 
@@ -238,24 +401,27 @@ class DynamicSmartFarmDeviceSimulator:
             return 'closed'
         return False
     
-    def handle_restart(self) -> Dict[str, Any]:
+    def handle_restart(self, device_state: Dict[str, Any] = None) -> Dict[str, Any]:
         """Handle device restart"""
+        if device_state is None:
+            device_state = self.device_state
         logger.info("🔄 Simulating device restart...")
-        time.sleep(2.0)  # Restart delay
+        task_sleep(2.0)  # Restart delay
         
         # Reset all states
-        for key in self.device_state:
-            if key == 'roof':
-                self.device_state[key] = 'closed'
-            else:
-                self.device_state[key] = False
+        with self.state_lock:
+            for key in device_state:
+                if key == 'roof':
+                    device_state[key] = 'closed'
+                else:
+                    device_state[key] = False
         
         return {"success": True, "message": "Device restarted successfully"}
     
     def handle_calibrate(self) -> Dict[str, Any]:
         """Handle sensor calibration"""
         logger.info("📏 Simulating sensor calibration...")
-        time.sleep(3.0)  # Calibration takes time
+        task_sleep(3.0)  # Calibration takes time
         
         if random.random() < 0.9:  # 90% success rate
             return {"success": True, "message": "Sensors calibrated successfully"}
@@ -266,22 +432,68 @@ class DynamicSmartFarmDeviceSimulator:
                 "errorCode": "CALIBRATION_ERROR"
             }
     
-    def on_connect(self, client, userdata, flags, rc):
+    def get_device_state(self, device_id: str) -> Dict[str, Any]:
+        """Get the state partition for a device, creating it from defaults on first use"""
+        device_state = self.device_states.get(device_id)
+        if device_state is not None:
+            return device_state
+        
+        with self._partition_lock:
+            if device_id not in self.device_states:
+                self.device_states[device_id] = {
+                    key: self.get_initial_state_value(key) for key in self.device_state
+                }
+                logger.info(f"🧩 Adopted state partition for device {device_id} "
+                            f"({len(self.device_states)} partitions)")
+            return self.device_states[device_id]
+    
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         """Callback for MQTT connection"""
         if rc == 0:
             logger.info("🔌 Connected to MQTT broker successfully")
+            if self.topic_aliases is not None:
+                maximum = getattr(properties, 'TopicAliasMaximum', 0) if properties else 0
+                self.topic_aliases.reset(maximum)
+                logger.info(f"🏷️ Broker allows {maximum} topic aliases")
+            self._published_capabilities = None
+            if self.cluster is not None:
+                self.cluster.record_connect(self.broker_url)
+                self._cluster_connected = True
             self.subscribe_to_action_topics()
             self.publish_device_status("online")
         else:
             logger.error(f"❌ Failed to connect to MQTT broker: {rc}")
+            self.on_connect_fail(client, userdata)
     
-    def on_disconnect(self, client, userdata, rc):
+    def on_disconnect(self, client, userdata, rc, properties=None):
         """Callback for MQTT disconnection"""
+        if self.topic_aliases is not None:
+            self.topic_aliases.reset(0)
+        if self._cluster_connected:
+            self.cluster.record_disconnect(self.broker_url)
+            self._cluster_connected = False
         if rc != 0:
             logger.warning(f"⚠️ Unexpected MQTT disconnection: {rc}")
         else:
             logger.info("🔌 Disconnected from MQTT broker")
     
+    def on_connect_fail(self, client, userdata):
+        """Callback for a failed connection attempt: fail over if the endpoint is down"""
+        if self.cluster is None:
+            return
+        url = self.cluster.record_failure(self.broker_url, self.device_id)
+        if url != self.broker_url:
+            logger.warning(f"🔀 Device {self.device_id} failing over from {self.broker_url} to {url}")
+            self.broker_url = url
+            self.parse_broker_url()
+            mqtt_transport.retarget_client(self.client, self.endpoint)
+    
+    def on_publish(self, client, userdata, mid):
+        """Callback for MQTT publish acknowledgment (PUBACK for QoS 1)"""
+        self._inflight.acked(mid)
+        if self.event_recorder is not None:
+            self.event_recorder.puback(self.device_id, mid)
+    
     def on_message(self, client, userdata, msg):
         """Callback for MQTT message reception"""
         try:
@@ -295,7 +507,7 @@ class DynamicSmartFarmDeviceSimulator:
             topic_parts = topic.split('/')
             if len(topic_parts) >= 4 and topic_parts[0] == 'smartfarm' and topic_parts[1] == 'actuators':
                 action = topic_parts[3]
-                self.process_action(action, payload)
+                self.process_action(action, payload, topic_parts[2])
             else:
                 logger.warning(f"⚠️ Invalid topic format: {topic}")
                 
@@ -304,6 +516,14 @@ class DynamicSmartFarmDeviceSimulator:
     
     def subscribe_to_action_topics(self):
         """Subscribe to action topics for this device"""
+        if self.share_group:
+            # One shared subscription covers every device; the broker hands each
+            # command to exactly one node in the group
+            topic = f"$share/{self.share_group}/smartfarm/actuators/+/+"
+            self.client.subscribe(topic)
+            logger.info(f"🎯 Subscribed to shared group '{self.share_group}': {topic}")
+            return
+        
         base_topic = f"smartfarm/actuators/{self.device_id}"
         
         logger.info(f"🎯 Subscribing to actions for device: {self.device_id}")
@@ -316,20 +536,33 @@ class DynamicSmartFarmDeviceSimulator:
         if not self.supported_actions:
             logger.warning("⚠️ No actions to subscribe to!")
     
-    def process_action(self, action: str, payload_str: str):
+    def process_action(self, action: str, payload_str: str, device_id: str = None):
         """Process incoming action request"""
+        received = time.time_ns()
         try:
             # Parse payload
             payload = json.loads(payload_str)
             action_id = payload.get('actionId', 'unknown')
+            device_id = device_id or self.device_id
+            if self.event_recorder is not None:
+                self.event_recorder.record(RECEIVED, action_id, device_id, action, received)
             
             logger.info(f"🔧 Processing action: {action} (ID: {action_id})")
             logger.info(f"📋 Action payload: {payload_str}")
             
+            # Register in arrival order, so the newest command is the one that survives
+            task = self.tasks.submit(device_id, action, action_id)
+            if self.event_recorder is not None:
+                self.event_recorder.record(QUEUED, action_id, device_id, action)
+            if task.coalesced_into is not None:
+                # An identical command is already in flight; its ack covers this one
+                logger.info(f"🧮 Action {action} ({action_id}) coalesced into {task.coalesced_into.action_id}")
+                return
+            
             # Execute action in a separate thread to avoid blocking
             threading.Thread(
                 target=self.execute_action,
-                args=(action, action_id, payload),
+                args=(action, action_id, payload, device_id, task),
                 daemon=True
             ).start()
             
@@ -338,72 +571,118 @@ class DynamicSmartFarmDeviceSimulator:
         except Exception as e:
             logger.error(f"❌ Error processing action: {e}")
     
-    def execute_action(self, action: str, action_id: str, payload: Dict[str, Any]):
+    def execute_action(self, action: str, action_id: str, payload: Dict[str, Any], device_id: str = None,
+                       task: ActionTask = None):
         """Execute the hardware action (simulated)"""
         start_time = time.time()
+        device_id = device_id or self.device_id
+        if self.event_recorder is not None:
+            self.event_recorder.record(STARTED, action_id, device_id, action)
+        device_state = self.get_device_state(device_id)
+        if task is None:
+            task = self.tasks.submit(device_id, action, action_id)
+            if task.coalesced_into is not None:
+                return
         
         try:
-            # Simulate execution delay
-            execution_time = random.uniform(*self.execution_delay_range)
-            time.sleep(execution_time)
-            
-            # Simulate success/failure
-            success = random.random() < self.success_rate
-            
-            if success and action in self.action_handlers:
-                # Execute the action handler
-                result = self.action_handlers[action]()
+            with task:
+                # Simulate execution delay and success/failure
+                failure = None
+                if self.latency_model is not None:
+                    execution_time, failure = self.latency_model.for_device(device_id).draw(action)
+                    success = failure is None
+                else:
+                    execution_time = random.uniform(*self.execution_delay_range)
+                    success = random.random() < self.success_rate
+                task.sleep(execution_time)
                 
-                if result["success"]:
-                    # Send success acknowledgment
-                    self.send_acknowledgment(action_id, "success", {
-                        "message": result["message"],
-                        "executionTime": round(time.time() - start_time, 2),
-                        "action": action,
-                        "deviceState": self.device_state.copy()
-                    })
+                # One reference for the whole command; reloads swap in a new dict
+                handlers = self.action_handlers
+                if success and action in handlers:
+                    # Execute the action handler
+                    self.tasks.start(task)
+                    result = handlers[action](device_state)
+                
+                    if result["success"]:
+                        # Send success acknowledgment
+                        self.acknowledge_task(task, "success", {
+                            "message": result["message"],
+                            "executionTime": round(time.time() - start_time, 2),
+                            "action": action,
+                            "deviceState": device_state.copy()
+                        }, device_id)
+                    else:
+                        # Send failure acknowledgment
+                        self.acknowledge_task(task, "error", {
+                            "error": result["error"],
+                            "errorCode": result.get("errorCode", "UNKNOWN_ERROR"),
+                            "executionTime": round(time.time() - start_time, 2),
+                            "action": action
+                        }, device_id)
                 else:
                     # Send failure acknowledgment
-                    self.send_acknowledgment(action_id, "error", {
-                        "error": result["error"],
-                        "errorCode": result.get("errorCode", "UNKNOWN_ERROR"),
+                    error_msg = f"Action {action} not supported" if action not in handlers else "Simulated failure"
+                    self.acknowledge_task(task, "error", {
+                        "error": failure["error"] if failure else error_msg,
+                        "errorCode": failure["errorCode"] if failure else "ACTION_FAILED",
                         "executionTime": round(time.time() - start_time, 2),
                         "action": action
-                    })
-            else:
-                # Send failure acknowledgment
-                error_msg = f"Action {action} not supported" if action not in self.action_handlers else "Simulated failure"
-                self.send_acknowledgment(action_id, "error", {
-                    "error": error_msg,
-                    "errorCode": "ACTION_FAILED",
-                    "executionTime": round(time.time() - start_time, 2),
-                    "action": action
-                })
+                    }, device_id)
                 
+        except Preempted:
+            # A newer command for the same actuator took over; report it and free the worker
+            logger.info(f"⏭️ Action {action} ({action_id}) preempted by {task.preempted_by}")
+            self.acknowledge_task(task, "error", {
+                "error": f"Preempted by newer command {task.preempted_by}",
+                "errorCode": "PREEMPTED",
+                "preemptedBy": task.preempted_by,
+                "executionTime": round(time.time() - start_time, 2),
+                "action": action
+            }, device_id)
         except Exception as e:
             logger.error(f"❌ Error executing action {action}: {e}")
-            self.send_acknowledgment(action_id, "error", {
+            self.acknowledge_task(task, "error", {
                 "error": f"Execution error: {str(e)}",
                 "errorCode": "EXECUTION_ERROR",
                 "executionTime": round(time.time() - start_time, 2),
                 "action": action
-            })
+            }, device_id)
+        finally:
+            self.tasks.finish(task)
+    
+    def acknowledge_task(self, task: ActionTask, status: str, details: Dict[str, Any], device_id: str = None):
+        """Acknowledge a task's command and every command coalesced into it"""
+        action_ids = self.tasks.seal(task)
+        self.send_acknowledgment(action_ids[0], status, details, device_id)
+        for action_id in action_ids[1:]:
+            self.send_acknowledgment(action_id, status, {**details, "coalescedInto": task.action_id}, device_id)
     
-    def send_acknowledgment(self, action_id: str, status: str, details: Dict[str, Any]):
+    def send_acknowledgment(self, action_id: str, status: str, details: Dict[str, Any], device_id: str = None):
         """Send action acknowledgment back to the backend"""
-        ack_topic = f"smartfarm/devices/{self.device_id}/ack"
+        device_id = device_id or self.device_id
+        if self.event_recorder is not None:
+            self.event_recorder.record(HANDLER_DONE, action_id, device_id, details.get("action", "unknown"))
+        ack_topic = f"smartfarm/devices/{device_id}/ack"
+        compact = self.payload_profile == "compact"
         
         ack_payload = {
             "actionId": action_id,
             "status": status,
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "deviceId": self.device_id,
+            "timestamp": int(time.time() * 1000) if compact else datetime.now(timezone.utc).isoformat(),
+            "deviceId": device_id,
             "action": details.get("action", "unknown"),
             **details
         }
         
         try:
-            self.client.publish(ack_topic, json.dumps(ack_payload), qos=1, retain=False)
+            if compact:
+                compact_payload = mqtt_wire.compact_ack(ack_payload)
+                payload = mqtt_wire.dumps_compact(compact_payload)
+                verbose_bytes = mqtt_wire.verbose_size(compact_payload, len(payload), "ack")
+            else:
+                payload, verbose_bytes = json.dumps(ack_payload), None
+            self.publish(ack_topic, payload, qos=1, retain=False, kind="ack", verbose_bytes=verbose_bytes,
+                         ack=(action_id, device_id, ack_payload["action"]))
             logger.info(f"📤 Sent {status} acknowledgment for action {action_id}")
         except Exception as e:
             logger.error(f"❌ Failed to send acknowledgment: {e}")
@@ -412,37 +691,131 @@ class DynamicSmartFarmDeviceSimulator:
         """Publish device status"""
         if status:
             self.device_status = status
-            
-        status_topic = f"smartfarm/devices/{self.device_id}/status"
         
+        compact = self.payload_profile == "compact"
+        now = int(time.time() * 1000) if compact else datetime.now(timezone.utc).isoformat()
         status_payload = {
             "deviceId": self.device_id,
             "status": self.device_status,
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "lastSeen": datetime.now(timezone.utc).isoformat(),
+            "timestamp": now,
+            "lastSeen": now,
             "capabilities": list(self.action_handlers.keys()),
             "deviceState": self.device_state.copy(),
             "uptime": time.time() - getattr(self, 'start_time', time.time())
         }
         
         try:
-            self.client.publish(status_topic, json.dumps(status_payload), qos=1, retain=True)
+            if compact:
+                capabilities = status_payload["capabilities"]
+                include_capabilities = capabilities != self._published_capabilities
+                compact_payload = mqtt_wire.compact_status(status_payload, include_capabilities)
+                payload = mqtt_wire.dumps_compact(compact_payload)
+                if include_capabilities:
+                    self._capabilities_bytes = len(json.dumps(capabilities))
+                # lastSeen and, when unchanged, capabilities are left out; uptime is sent as whole seconds
+                dropped = (len('"lastSeen": , ') + mqtt_wire.ISO_TIMESTAMP_BYTES
+                           + len(repr(status_payload["uptime"])) - len(str(compact_payload["u"])))
+                if not include_capabilities:
+                    dropped += len('"capabilities": , ') + self._capabilities_bytes
+                self.publish(self.status_topic, payload, qos=1, retain=True, kind="status",
+                             verbose_bytes=mqtt_wire.verbose_size(compact_payload, len(payload), "status", dropped))
+                self._published_capabilities = capabilities
+            else:
+                self.publish(self.status_topic, json.dumps(status_payload), qos=1, retain=True, kind="status")
             logger.debug(f"📊 Published device status: {self.device_status}")
         except Exception as e:
             logger.error(f"❌ Failed to publish device status: {e}")
     
+    def switch_off(self, actuator: str) -> bool:
+        """Switch an actuator off outside of any command (a relay timer) and publish the new state"""
+        off = "closed" if actuator == "roof" else False
+        with self.state_lock:
+            if self.device_state.get(actuator, off) == off:
+                return False
+            self.device_state[actuator] = off
+        logger.info(f"⏲️ {actuator} on {self.device_id} switched itself off")
+        self.publish_device_status()
+        return True
+    
+    def build_last_will_payload(self) -> Dict[str, Any]:
+        """Build the offline status the broker publishes if the connection is lost"""
+        return {
+            "deviceId": self.device_id,
+            "status": "offline",
+            "reason": "connection_lost",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "capabilities": list(self.action_handlers.keys())
+        }
+    
+    def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False,
+                kind: str = "other", verbose_bytes: int = None,
+                ack: Tuple[str, str, str] = None) -> mqtt.MQTTMessageInfo:
+        """Publish a message, tracking QoS 1 publishes until the broker acknowledges them
+        
+        ``kind`` groups the message in ``wire_stats``; ``verbose_bytes`` is the
+        verbose payload size when a compact payload is sent instead. With a
+        rate limiter, returns None for telemetry shed by a saturated uplink.
+        ``ack`` is the (actionId, deviceId, action) of an acknowledgment, recorded
+        in the event recorder as handed to paho once the rate limiter let it through.
+        """
+        data = payload.encode('utf-8')
+        if self.rate_limiter is not None:
+            size = mqtt_wire.publish_packet_size(len(topic), len(data), qos, self.use_mqtt5)
+            if qos == 0 and kind == "telemetry":
+                # A full radio queue drops the reading rather than stalling the telemetry tick
+                if not self.rate_limiter.try_acquire(size):
+                    return None
+            else:
+                self.rate_limiter.acquire(size, block=not mqtt_transport.on_network_thread(self.client))
+        
+        if self.topic_aliases is not None:
+            with self.topic_aliases.lock:
+                wire_topic, properties, alias = self.topic_aliases.resolve(topic, qos)
+                published_at = time.time_ns()
+                info = self.client.publish(wire_topic, data, qos=qos, retain=retain, properties=properties)
+                self.topic_aliases.sent(topic, alias, info.rc)
+        else:
+            wire_topic, alias = topic, None
+            published_at = time.time_ns()
+            info = self.client.publish(topic, data, qos=qos, retain=retain)
+        
+        self._inflight.sent(info, qos)
+        if ack is not None and self.event_recorder is not None:
+            self.event_recorder.ack_published(self.device_id, info, *ack, ts=published_at)
+        if self.cluster is not None:
+            self.cluster.record_publish(self.broker_url)
+        
+        self.wire_stats.record(
+            kind,
+            len(data),
+            mqtt_wire.publish_packet_size(len(wire_topic), len(data), qos, self.use_mqtt5, alias is not None),
+            mqtt_wire.publish_packet_size(len(topic), verbose_bytes or len(data), qos, self.use_mqtt5)
+        )
+        return info
+    
+    def drain(self, deadline: float) -> bool:
+        """Wait until every in-flight publish is acknowledged or the deadline passes"""
+        pending = self._inflight.wait(deadline)
+        if pending:
+            logger.warning(f"⚠️ {pending} message(s) still in flight for {self.device_id} at shutdown")
+        return pending == 0
+    
     def start_heartbeat(self):
         """Start periodic heartbeat/status updates"""
         def heartbeat_loop():
             while self.is_running:
                 self.publish_device_status()
-                time.sleep(self.heartbeat_interval)
+                self._stop_event.wait(self.heartbeat_interval)
         
         threading.Thread(target=heartbeat_loop, daemon=True).start()
         logger.info(f"💓 Started heartbeat every {self.heartbeat_interval} seconds")
     
-    def start(self):
-        """Start the device simulator"""
+    def start(self, blocking: bool = True):
+        """Start the device simulator
+        
+        With ``blocking=False`` the connection is made in the background and
+        control returns immediately, which is how fleets start many devices.
+        """
         try:
             logger.info(f"🚀 Starting Dynamic Smart Farm Device Simulator")
             logger.info(f"📱 Device ID: {self.device_id}")
@@ -450,35 +823,57 @@ class DynamicSmartFarmDeviceSimulator:
             logger.info(f"🔗 Backend: {self.backend_url}")
             logger.info(f"👤 Username: {self.username}")
             logger.info(f"📊 Success Rate: {self.success_rate*100}%")
+            if self.share_group:
+                logger.info(f"🤝 Share group: {self.share_group} (MQTT 5)")
             
-            # Setup dynamic actions from database
-            self.setup_dynamic_actions()
+            # Setup dynamic actions from database (zygote workers inherit them already loaded)
+            if not self._action_catalog:
+                self.setup_dynamic_actions()
             
             self.start_time = time.time()
             self.is_running = True
+            self._stop_event.clear()
             
             # Set up authentication
             if self.username and self.password:
                 self.client.username_pw_set(self.username, self.password)
                 logger.info(f"🔐 Authentication configured")
             
-            # Set up SSL/TLS for WSS connections
+            # Set up SSL/TLS for mqtts/wss connections
             if self.use_ssl:
-                context = ssl.create_default_context()
-                context.check_hostname = False
-                context.verify_mode = ssl.CERT_NONE
+                context = self.ssl_context or mqtt_transport.get_shared_ssl_context(self.ca_file, self.tls_insecure)
                 self.client.tls_set_context(context)
                 logger.info(f"🔒 SSL/TLS configured for secure connection")
             
+            # Let the broker mark us offline if we vanish without a clean shutdown
+            self.client.will_set(self.status_topic, json.dumps(self.build_last_will_payload()), qos=1, retain=True)
+            
+            if self.loop_watchdog is not None:
+                self.loop_watchdog.instrument(self.client, self.device_id)
+            
             # Connect to MQTT broker
             logger.info(f"🔌 Connecting to {self.broker_host}:{self.broker_port}...")
-            self.client.connect(self.broker_host, self.broker_port, 60)
+            # A cluster connects in the background so failed endpoints can fail over
+            if blocking and self.cluster is None:
+                self.client.connect(self.broker_host, self.broker_port, 60)
+            else:
+                self.client.connect_async(self.broker_host, self.broker_port, 60)
+            
+            # Run the network loop in the background so shutdown can drain acks
+            self.client.loop_start()
             
             # Start heartbeat
             self.start_heartbeat()
             
-            # Start MQTT loop
-            self.client.loop_forever()
+            if self.catalog_refresh_interval > 0:
+                self.start_catalog_refresh()
+            
+            if self.telemetry is not None:
+                self.telemetry.start()
+            
+            if blocking:
+                while not self._stop_event.wait(1.0):
+                    pass
             
         except Exception as e:
             logger.error(f"❌ Failed to start device simulator: {e}")
@@ -487,18 +882,54 @@ class DynamicSmartFarmDeviceSimulator:
     def stop(self):
         """Stop the device simulator"""
         logger.info(f"🛑 Stopping device simulator...")
+        in_flight = self.tasks.in_flight()
+        if in_flight:
+            logger.warning(f"⏳ {len(in_flight)} command(s) still executing at shutdown: {format_in_flight(in_flight)}")
+        self.begin_shutdown()
+        self.drain(time.time() + self.drain_timeout)
+        self.finish_shutdown()
+        logger.info(f"📦 Egress: {self.wire_stats.format_summary()}")
+        if self.cluster is not None:
+            logger.info(f"🕸️ Brokers: {self.cluster.format_summary()}")
+        if self.rate_limiter is not None:
+            logger.info(f"🚦 Uplink {self.rate_limiter.stats.format_summary()}")
+        if self.loop_watchdog is not None:
+            self.loop_watchdog.stop()
+            logger.info(f"🩺 Network loop: {self.loop_watchdog.format_summary()}")
+        if self.event_recorder is not None:
+            self.event_recorder.close()
+            logger.info(f"🧾 Events: {self.event_recorder.format_summary()}")
+        if self.tasks.coalesce_window > 0:
+            logger.info(f"🧮 Coalescing: {format_counts(self.tasks.counts)}")
+        if self.state_checkpoint is not None:
+            self.state_checkpoint.stop()
+            logger.info(f"💾 State: {self.state_checkpoint.format_summary()}")
+        logger.info(f"✅ Device simulator stopped")
+    
+    def begin_shutdown(self):
+        """Stop background work and publish the final offline status"""
         self.is_running = False
+        self._stop_event.set()
+        if self.telemetry is not None:
+            self.telemetry.stop()
         
-        # Publish offline status
+        # A clean disconnect suppresses the Last Will, so announce offline ourselves
         self.publish_device_status("offline")
-        time.sleep(1)  # Give time for message to be sent
-        
-        # Disconnect from MQTT
+    
+    def finish_shutdown(self):
+        """Disconnect from MQTT and stop the network loop"""
         self.client.disconnect()
-        logger.info(f"✅ Device simulator stopped")
+        self.client.loop_stop()
+    
+    def reload_signal_handler(self, signum, frame):
+        """Reload the action catalog on SIGHUP"""
+        logger.info(f"📡 Received signal {signum}, reloading action catalog...")
+        threading.Thread(target=self.reload_actions, daemon=True).start()
     
     def signal_handler(self, signum, frame):
         """Handle shutdown signals"""
+        if self._stop_event.is_set():
+            return  # Shutdown already in progress
         logger.info(f"📡 Received signal {signum}, shutting down...")
         self.stop()
         sys.exit(0)
@@ -511,7 +942,8 @@ def main():
                        help='Device ID (default: dht11h)')
     parser.add_argument('--broker-url', '-b', 
                        default='wss://i37c1733.ala.us-east-1.emqxsl.com:8084/mqtt',
-                       help='MQTT broker URL (default: EMQX Cloud WSS)')
+                       help='MQTT broker URL: mqtt://, mqtts://, ws:// or wss:// (default: EMQX Cloud WSS); '
+                            'several comma-separated URLs spread devices over a cluster')
     parser.add_argument('--backend-url', '-u', default='http://localhost:3000/api',
                        help='Backend API URL (default: http://localhost:3000/api)')
     parser.add_argument('--username', '-n', default='oussama2255',
@@ -520,6 +952,55 @@ def main():
                        help='MQTT password (default: Oussama2255)')
     parser.add_argument('--success-rate', '-s', type=float, default=0.85,
                        help='Action success rate 0.0-1.0 (default: 0.85)')
+    parser.add_argument('--drain-timeout', type=float, default=5.0,
+                       help='Max seconds to wait for in-flight acks on shutdown (default: 5.0)')
+    parser.add_argument('--ca-file', default=mqtt_transport.DEFAULT_CA_FILE,
+                       help='CA certificate for mqtts/wss brokers (default: certs/emqxsl-ca.crt)')
+    parser.add_argument('--insecure', action='store_true',
+                       help='Skip TLS certificate verification')
+    parser.add_argument('--latency-model', default=None,
+                       help='JSON latency/failure model file (see latency_model.py); replaces --success-rate')
+    parser.add_argument('--seed', type=int, default=None,
+                       help='Random seed for the latency model')
+    parser.add_argument('--share-group', '-g', default=None,
+                       help='Handle commands for all devices via MQTT 5 shared subscription $share/<group>/...')
+    parser.add_argument('--mqtt5', action='store_true',
+                       help='Connect using MQTT 5 (implied by --share-group and --topic-aliases)')
+    parser.add_argument('--topic-aliases', action='store_true',
+                       help='Use MQTT 5 topic aliases for QoS 0 publishes')
+    parser.add_argument('--payload-profile', choices=['verbose', 'compact'], default='verbose',
+                       help='Status/ack payload format (default: verbose)')
+    parser.add_argument('--telemetry-interval', type=float, default=0,
+                       help='Publish simulated sensor readings every N seconds; 0 disables (default: 0)')
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                       help='Simulated seconds of greenhouse physics per real second (default: 1.0)')
+    parser.add_argument('--rate-profile', default=None,
+                       help='Throttle outbound messages like a constrained uplink: esp32-2g, esp32-lte-m, '
+                            'esp32-wifi, pi-wifi, pi-fibre or MSGS:BYTES per second (default: unlimited)')
+    parser.add_argument('--loop-watchdog', type=float, default=0, metavar='MS',
+                       help='Warn with a stack sample when a network-loop callback runs over MS milliseconds, '
+                            'and track keepalive margin (default: off)')
+    parser.add_argument('--record-events', default=None, metavar='PATH',
+                       help='Record every command\'s stage timestamps to PATH for event_recorder.py (default: off)')
+    parser.add_argument('--checkpoint', default=None, metavar='PATH',
+                       help='Restore actuator state from PATH on start and checkpoint it there (default: off)')
+    parser.add_argument('--checkpoint-interval', type=float, default=5.0, metavar='SECONDS',
+                       help='With --checkpoint, seconds between incremental checkpoints (default: 5)')
+    parser.add_argument('--no-preemption', action='store_true',
+                       help='Let every command run to completion instead of preempting older ones per actuator')
+    parser.add_argument('--coalesce-window', type=float, default=0, metavar='SECONDS',
+                       help='Merge a repeated command into the identical one still in flight if it arrives within '
+                            'SECONDS of it; every command still gets its own ack (default: off)')
+    parser.add_argument('--catalog-refresh', type=float, default=0,
+                       help='Re-fetch the action catalog every N seconds (SIGHUP reloads on demand; default: off)')
+    parser.add_argument('--report-by-exception', action='store_true',
+                       help='Only publish telemetry on deadband moves, threshold crossings or --max-silence')
+    parser.add_argument('--max-silence', type=float, default=900.0,
+                       help='With --report-by-exception, publish at least every N simulated seconds (default: 900)')
+    parser.add_argument('--aggregate-window', type=float, default=0.0,
+                       help='With --report-by-exception, aggregate samples over N simulated seconds (default: off)')
+    parser.add_argument('--aggregate-json', action='store_true',
+                       help='Send aggregated single-value readings as {"value","min","max","n"} JSON')
     parser.add_argument('--verbose', '-v', action='store_true',
                        help='Enable verbose logging')
     
@@ -534,11 +1015,52 @@ def main():
         broker_url=args.broker_url,
         backend_url=args.backend_url,
         username=args.username,
-        password=args.password
+        password=args.password,
+        ca_file=args.ca_file,
+        tls_insecure=args.insecure,
+        share_group=args.share_group,
+        use_mqtt5=args.mqtt5,
+        topic_aliases=args.topic_aliases,
+        payload_profile=args.payload_profile
     )
     
+    if args.latency_model:
+        from latency_model import LatencyModel
+        device.latency_model = LatencyModel.from_file(args.latency_model, seed=args.seed)
+    
+    if args.telemetry_interval > 0:
+        from environment_model import EnvironmentModel, TelemetryPublisher
+        model = EnvironmentModel([device.device_id], seed=args.seed)
+        model.bind(device.device_id, device.device_state, device.switch_off)
+        edge = None
+        if args.report_by_exception:
+            from edge_processing import EdgeProcessor
+            edge = EdgeProcessor(model, args.max_silence, args.aggregate_window, args.aggregate_json)
+        device.telemetry = TelemetryPublisher(model, [device.publish], args.telemetry_interval, args.time_scale,
+                                              edge=edge)
+    
     # Set success rate
     device.success_rate = max(0.0, min(1.0, args.success_rate))
+    device.drain_timeout = max(0.0, args.drain_timeout)
+    device.catalog_refresh_interval = max(0.0, args.catalog_refresh)
+    device.tasks.preempt = not args.no_preemption
+    device.tasks.coalesce_window = max(0.0, args.coalesce_window)
+    if args.rate_profile:
+        from rate_limit import RateLimiter, parse_rate_profile
+        device.rate_limiter = RateLimiter(parse_rate_profile(args.rate_profile))
+    if args.loop_watchdog > 0:
+        from loop_watchdog import LoopWatchdog
+        device.loop_watchdog = LoopWatchdog(args.loop_watchdog / 1000.0)
+    if args.record_events:
+        from event_recorder import EventRecorder
+        device.event_recorder = EventRecorder(args.record_events)
+    if args.checkpoint:
+        from state_checkpoint import StateCheckpoint
+        device.state_checkpoint = StateCheckpoint(args.checkpoint, max(0.1, args.checkpoint_interval))
+        # A shared-subscription node gets back the partitions it had adopted
+        adopt = (lambda device_id: device.device_states.setdefault(device_id, {})) if device.share_group else None
+        device.state_checkpoint.restore(device.device_states, adopt)
+        device.state_checkpoint.start(lambda: device.device_states)
     
     try:
         device.start()
@@ -0,0 +1,185 @@
+"""
+Report-by-exception telemetry: the edge processing a real sensor node does.
+
+Every tick the environment model is sampled, but a sensor message is only
+published when:
+    crossing  a reading moved into another threshold band (critical-low,
+              warning-low, normal, warning-high, critical-high from the
+              sensors table) by more than half a deadband - sent at once
+              with the raw sample
+    deadband  the value moved more than the sensor's deadband since it was
+              last published
+    silence   nothing was published for ``max_silence`` seconds, so the
+              backend still sees the node alive
+    first     nothing was published yet
+
+With an aggregation window, samples are accumulated and the deadband and
+silence checks run on the window mean when the window closes. Single-value
+sensors can then carry the window's min/max as well
+(``{"value": mean, "min": .., "max": .., "n": ..}``, which the backend reads
+as ``value``); composite DHT11 messages stay ``T°C,H%`` with the means.
+
+Deadbands default per quantity (``DEFAULT_DEADBANDS``) and can be set per
+sensor with a ``deadband`` key (e.g. in a scenario's sensor rows). All checks
+are vectorized over the fleet; only the messages that pass are formatted.
+"""
+
+import threading
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+# Per quantity, in the units the sensors report
+DEFAULT_DEADBANDS = {
+    "temperature": 0.5,   # °C
+    "humidity": 2.0,      # %
+    "soil": 0.05,         # fraction
+    "light": 50.0,        # lux
+}
+
+REASONS = ("crossing", "first", "deadband", "silence")
+
+
+class EdgeProcessor:
+    """Decides which sensor messages of an EnvironmentModel get published"""
+
+    def __init__(self, model, max_silence: float = 900.0, window: float = 0.0, aggregate_json: bool = False):
+        self.model = model
+        self.max_silence = max_silence
+        self.window = window
+        self.aggregate_json = aggregate_json and window > 0
+
+        n = len(model.device_ids)
+        self.sensors = model.sensors
+        self.groups = model.sensor_groups()
+        self.deadbands = [sensor.get("deadband") or DEFAULT_DEADBANDS[sensor["quantity"]] for sensor in self.sensors]
+        self.limits = [
+            np.array(sorted(sensor[key] for key in ("minCritical", "minWarning", "maxWarning", "maxCritical")
+                            if sensor.get(key) is not None), dtype=float)
+            for sensor in self.sensors
+        ]
+
+        self.last_sent = [np.full(n, np.nan) for _ in self.sensors]
+        self.last_band = [np.full(n, -1, dtype=np.int64) for _ in self.sensors]
+        self.last_time = {sensor_id: np.full(n, -np.inf) for sensor_id, _ in self.groups}
+
+        # Window accumulators
+        self.window_start = None
+        self._sum = [np.zeros(n) for _ in self.sensors]
+        self._min = [np.full(n, np.inf) for _ in self.sensors]
+        self._max = [np.full(n, -np.inf) for _ in self.sensors]
+        self._count = 0
+
+        # Counters
+        self.samples = 0      # messages that would have been sent without edge processing
+        self.published = 0
+        self.reasons = {reason: 0 for reason in REASONS}
+        self._lock = threading.Lock()
+
+    def _band(self, k: int, values: np.ndarray) -> np.ndarray:
+        """Threshold band per device, with half a deadband of hysteresis around each limit"""
+        limits, hysteresis = self.limits[k], self.deadbands[k] / 2.0
+        band = np.searchsorted(limits, values, side='right')
+        last = self.last_band[k]
+        # Keep the previous band unless the value is clearly past the boundary
+        low = np.searchsorted(limits + hysteresis, values, side='right')
+        high = np.searchsorted(limits - hysteresis, values, side='right')
+        return np.where(last >= 0, np.clip(last, low, high), band)
+
+    def process(self) -> Tuple[List[np.ndarray], Dict[str, np.ndarray], Dict[int, Dict[str, Any]]]:
+        """Sample the model; return readings, selected device indices per sensorId and aggregates
+
+        The result is passed straight to ``EnvironmentModel.format_messages``.
+        """
+        model = self.model
+        t = model.sim_time
+        raw = [np.array(model.values(sensor["quantity"]), dtype=float) for sensor in self.sensors]
+        bands = [self._band(k, values) for k, values in enumerate(raw)]
+
+        # Accumulate the window; without one every tick closes a "window" of one sample
+        if self.window > 0:
+            if self.window_start is None:
+                self.window_start = t
+            for k, values in enumerate(raw):
+                self._sum[k] += values
+                np.minimum(self._min[k], values, out=self._min[k])
+                np.maximum(self._max[k], values, out=self._max[k])
+            self._count += 1
+            closed = t - self.window_start >= self.window
+            candidates = [total / self._count for total in self._sum] if closed else raw
+        else:
+            closed = True
+            candidates = raw
+
+        readings = [None] * len(self.sensors)
+        selected = {}
+        aggregates = {}
+        counts = {reason: 0 for reason in REASONS}
+
+        for sensor_id, members in self.groups:
+            crossing = np.zeros(len(model.device_ids), dtype=bool)
+            moved = np.zeros(len(model.device_ids), dtype=bool)
+            for k, _ in members:
+                crossing |= (bands[k] != self.last_band[k]) & (self.last_band[k] >= 0)
+                if closed:
+                    moved |= np.abs(candidates[k] - self.last_sent[k]) >= self.deadbands[k]
+            first = np.isnan(self.last_sent[members[0][0]])
+            silent = (t - self.last_time[sensor_id] >= self.max_silence) if closed else np.zeros_like(crossing)
+
+            publish = crossing | first | moved | silent
+            indices = np.flatnonzero(publish)
+            selected[sensor_id] = indices
+
+            counts["crossing"] += int(crossing.sum())
+            counts["first"] += int((first & ~crossing).sum())
+            counts["deadband"] += int((moved & ~crossing & ~first).sum())
+            counts["silence"] += int((silent & ~moved & ~crossing & ~first).sum())
+
+            for k, _ in members:
+                # A crossing is reported with the sample that crossed, not a window mean
+                readings[k] = np.where(crossing, raw[k], candidates[k])
+                self.last_sent[k][indices] = readings[k][indices]
+                self.last_band[k] = bands[k]
+            self.last_time[sensor_id][indices] = t
+
+            if self.aggregate_json and closed and len(members) == 1:
+                k = members[0][0]
+                aggregates[k] = {"min": np.where(crossing, raw[k], self._min[k]),
+                                 "max": np.where(crossing, raw[k], self._max[k]),
+                                 "n": self._count}
+
+        if closed and self.window > 0:
+            self.window_start = t
+            self._count = 0
+            for k in range(len(self.sensors)):
+                self._sum[k][:] = 0.0
+                self._min[k][:] = np.inf
+                self._max[k][:] = -np.inf
+
+        with self._lock:
+            self.samples += len(model.device_ids) * len(self.groups)
+            self.published += sum(len(indices) for indices in selected.values())
+            for reason, count in counts.items():
+                self.reasons[reason] += count
+
+        return readings, selected, aggregates
+
+    def summary(self) -> Dict[str, Any]:
+        """Sampled vs published message counts and the reduction ratio"""
+        with self._lock:
+            summary = {"samples": self.samples, "published": self.published, "reasons": dict(self.reasons)}
+        if summary["published"]:
+            summary["reductionRatio"] = round(summary["samples"] / summary["published"], 2)
+        if summary["samples"]:
+            summary["suppressedPercent"] = round(100.0 * (1 - summary["published"] / summary["samples"]), 1)
+        return summary
+
+    def format_summary(self) -> str:
+        """One line for logs"""
+        summary = self.summary()
+        if not summary["samples"]:
+            return "Edge filter: no samples"
+        reasons = ", ".join(f"{reason} {count}" for reason, count in summary["reasons"].items())
+        return (f"Edge filter: {summary['published']} of {summary['samples']} readings published "
+                f"({summary.get('reductionRatio', '-')}x reduction, {summary['suppressedPercent']}% suppressed; "
+                f"{reasons})")
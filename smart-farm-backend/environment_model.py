@@ -0,0 +1,385 @@
+"""
+Closed-loop greenhouse environment model for the device simulators.
+
+Actuator state in each simulator's ``device_state`` (ventilator, heater,
+humidifier, water_pump, lights, roof) drives the temperature, humidity, soil moisture and
+light seen by that device's sensors, and the readings are published on
+``smartfarm/sensors/{sensorId}`` in the formats the backend parses. This lets
+the backend's threshold -> action -> ack loop run against a plant that reacts.
+
+The whole fleet is one set of NumPy arrays stepped together each tick; the
+only per-device Python work is reading actuator flags and publishing.
+
+Physics per tick (dt seconds of simulated time):
+    temperature  relaxes towards ambient plus solar gain under the roof and
+                 the heater; a running ventilator or open roof pulls it down
+                 to ambient
+    humidity     humidifier adds moisture, soil evaporation adds some, air
+                 exchange (ventilator, open roof) pulls it to outside humidity
+    soil         the water pump raises moisture, evaporation lowers it faster
+                 when hot and sunny
+    light        daylight (less under a closed roof) plus grow lights
+
+Actuators without an "off" action in the sensors table (humidifier, water
+pump, lights, roof) switch themselves off after ``ACTUATOR_TIMEOUTS`` seconds,
+as the relay timers on the real nodes do; otherwise every loop would latch on.
+A simulator bound with a ``switch_off`` callback makes that change itself,
+under its own state lock and with a status publish, after the model's lock
+is released.
+"""
+
+import math
+import time
+import threading
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Mirrors the seed rows of the sensors table for one greenhouse node
+DEFAULT_SENSORS = [
+    {"sensorId": "dht11", "type": "temperature", "unit": "°C", "quantity": "temperature",
+     "minCritical": 15.0, "minWarning": 17.0, "maxWarning": 28.0, "maxCritical": 50.0,
+     "actionLow": "ventilator_off", "actionHigh": "ventilator_on"},
+    {"sensorId": "dht11", "type": "humidity", "unit": "%", "quantity": "humidity",
+     "minCritical": 60.0, "minWarning": 62.0, "maxWarning": 73.0, "maxCritical": 75.0,
+     "actionLow": "humidifier_on", "actionHigh": "open_roof"},
+    {"sensorId": "YL-69", "type": "humidity", "unit": "%", "quantity": "soil",
+     "minCritical": 0.0, "minWarning": 0.0, "maxWarning": 0.8, "maxCritical": 1.0,
+     "actionLow": "water_pump_on", "actionHigh": None},
+    {"sensorId": "BH1750", "type": "light", "unit": "lux", "quantity": "light",
+     "minCritical": 200.0, "minWarning": 300.0, "maxWarning": 900.0, "maxCritical": 1000.0,
+     "actionLow": "light_on", "actionHigh": None},
+]
+
+QUANTITIES = ("temperature", "humidity", "soil", "light")
+
+# Seconds of simulated time before a latching actuator switches itself off
+ACTUATOR_TIMEOUTS = {
+    "humidifier": 300.0,
+    "water_pump": 90.0,
+    "lights": 3600.0,
+    "roof": 1800.0,
+}
+
+# Actuator (device_state key) switched by each backend action
+ACTION_ACTUATORS = {
+    "ventilator_on": ("ventilator", True),
+    "ventilator_off": ("ventilator", False),
+    "heater_on": ("heater", True),
+    "heater_off": ("heater", False),
+    "humidifier_on": ("humidifier", True),
+    "humidifier_off": ("humidifier", False),
+    "water_pump_on": ("water_pump", True),
+    "water_pump_off": ("water_pump", False),
+    "light_on": ("lights", True),
+    "light_off": ("lights", False),
+    "open_roof": ("roof", True),
+    "close_roof": ("roof", False),
+}
+
+# Printf formats for published values
+VALUE_FORMATS = {
+    "temperature": "%.1f",
+    "humidity": "%.1f",
+    "soil": "%.2f",
+    "light": "%.0f",
+}
+
+
+class EnvironmentModel:
+    """Vectorized greenhouse state for a whole fleet of devices"""
+
+    def __init__(self, device_ids: List[str], sensors: List[Dict[str, Any]] = None,
+                 seed: int = None, start_time: float = None):
+        self.device_ids = list(device_ids)
+        self.sensors = sensors or DEFAULT_SENSORS
+        self.sim_time = start_time if start_time is not None else time.time()
+        self.device_states: List[Optional[Dict[str, Any]]] = [None] * len(self.device_ids)
+        self.switch_offs: List[Optional[Callable[[str], Any]]] = [None] * len(self.device_ids)
+        self.bound = False
+        self._index = {device_id: i for i, device_id in enumerate(self.device_ids)}
+
+        n = len(self.device_ids)
+        rng = self.rng = np.random.default_rng(seed)
+
+        # Weather shared by the fleet; scenarios may override these
+        self.ambient_mean = 22.0      # °C
+        self.ambient_swing = 5.0      # °C, half of the day/night range
+        self.ambient_offset = 0.0     # °C, e.g. a heat wave
+        self.outside_humidity = 58.0  # %
+        self.daylight_lux = 1100.0    # lux at noon with the roof open
+
+        # Per-device plant parameters so devices do not move in lockstep
+        self.insulation = rng.uniform(0.0006, 0.0014, n)      # 1/s exchange through walls
+        self.vent_rate = rng.uniform(0.003, 0.006, n)         # 1/s exchange with ventilator on
+        self.roof_rate = rng.uniform(0.004, 0.008, n)         # 1/s exchange with roof open
+        self.solar_gain = rng.uniform(6.0, 12.0, n)           # °C above ambient at noon, roof closed
+        self.heater_gain = rng.uniform(6.0, 10.0, n)          # °C above ambient with the heater on
+        self.humidifier_rate = rng.uniform(0.02, 0.05, n)     # %/s
+        self.transpiration = rng.uniform(0.006, 0.012, n)     # %/s at full soil moisture
+        self.pump_rate = rng.uniform(0.003, 0.006, n)         # soil fraction/s
+        self.evaporation = rng.uniform(1.5e-5, 4e-5, n)       # soil fraction/s
+        self.lamp_lux = rng.uniform(400.0, 700.0, n)
+        self.phase = rng.uniform(-1800.0, 1800.0, n)          # s, local solar time offset
+
+        # Current readings
+        self.temperature = rng.normal(24.0, 2.0, n)
+        self.humidity = rng.normal(66.0, 4.0, n)
+        self.soil = rng.uniform(0.3, 0.7, n)
+        self.light = np.zeros(n)
+
+        # Actuator flags gathered from device_state each tick
+        self.actuators = {name: np.zeros(n, dtype=bool)
+                          for name in ("ventilator", "heater", "humidifier", "water_pump", "lights", "roof")}
+        self.on_since = {name: np.full(n, np.nan) for name in ACTUATOR_TIMEOUTS}
+        self.auto_offs = 0
+
+        self._noise = rng.standard_normal
+        self._lock = threading.Lock()
+
+    def bind(self, device_id: str, device_state: Dict[str, Any], switch_off: Callable[[str], Any] = None):
+        """Attach a simulator's device_state so its actuators drive the model
+
+        ``switch_off(actuator)`` is called for auto-offs instead of writing
+        to ``device_state`` from the telemetry thread.
+        """
+        index = self._index[device_id]
+        self.device_states[index] = device_state
+        self.switch_offs[index] = switch_off
+        self.bound = True
+
+    def _gather_actuators(self):
+        """Copy actuator flags from the bound device_state dicts into arrays"""
+        for name, flags in self.actuators.items():
+            if name == "roof":
+                values = [state is not None and state.get("roof") == "open" for state in self.device_states]
+            else:
+                values = [state is not None and bool(state.get(name, False)) for state in self.device_states]
+            flags[:] = values
+
+    def _apply_timeouts(self) -> List[tuple]:
+        """Switch off latching actuators that have run past their timeout
+
+        Returns the (device index, actuator) pairs whose simulator still has
+        to be told, once the model's lock is released.
+        """
+        pending = []
+        for name, timeout in ACTUATOR_TIMEOUTS.items():
+            flags, since = self.actuators[name], self.on_since[name]
+            since[flags & np.isnan(since)] = self.sim_time
+            since[~flags] = np.nan
+            expired = np.flatnonzero(self.sim_time - since >= timeout)
+            for i in expired:
+                state = self.device_states[i]
+                if self.switch_offs[i] is not None:
+                    pending.append((i, name))
+                elif state is not None:
+                    state[name] = "closed" if name == "roof" else False
+                flags[i] = False
+                since[i] = np.nan
+            self.auto_offs += len(expired)
+        return pending
+
+    def control(self):
+        """Switch actuators from the sensors' critical thresholds, as the backend's rules would
+
+        For runs without simulators (e.g. generating history), where no
+        device_state is bound and nothing else drives the actuators.
+        """
+        with self._lock:
+            for sensor in self.sensors:
+                values = self.values(sensor["quantity"])
+                for limit_key, action_key, compare in (("minCritical", "actionLow", np.less),
+                                                       ("maxCritical", "actionHigh", np.greater)):
+                    limit, action = sensor.get(limit_key), ACTION_ACTUATORS.get(sensor.get(action_key))
+                    if limit is None or action is None:
+                        continue
+                    name, on = action
+                    self.actuators[name][compare(values, limit)] = on
+
+    def sunlight(self) -> np.ndarray:
+        """Relative sun intensity 0..1 per device"""
+        local = (self.sim_time + self.phase) % 86400.0
+        return np.clip(np.sin(math.pi * (local / 3600.0 - 6.0) / 12.0), 0.0, None)
+
+    def step(self, dt: float):
+        """Advance the whole fleet by ``dt`` seconds of simulated time"""
+        with self._lock:
+            self.sim_time += dt
+            if self.bound:
+                self._gather_actuators()
+            switch_offs = self._apply_timeouts()
+
+            vent = self.actuators["ventilator"]
+            roof = self.actuators["roof"]
+            sun = self.sunlight()
+            ambient = (self.ambient_mean + self.ambient_offset
+                       + self.ambient_swing * (2.0 * sun - 1.0))
+            shade = np.where(roof, 1.0, 0.7)
+
+            # Temperature: exact exponential relaxation towards a weighted target
+            k_walls = self.insulation
+            k_vent = vent * self.vent_rate
+            k_roof = roof * self.roof_rate
+            k = k_walls + k_vent + k_roof
+            greenhouse = (ambient + self.solar_gain * sun * np.where(roof, 0.4, 1.0)
+                          + self.actuators["heater"] * self.heater_gain)
+            target = (k_walls * greenhouse + k_vent * (ambient - 1.0) + k_roof * ambient) / k
+            self.temperature = target + (self.temperature - target) * np.exp(-k * dt)
+            self.temperature += 0.05 * math.sqrt(dt) * self._noise(len(k))
+
+            # Humidity: sources, then exchange with outside air
+            k_air = k_walls + k_vent + k_roof
+            source = self.actuators["humidifier"] * self.humidifier_rate + self.soil * self.transpiration
+            target = self.outside_humidity + source / k_air
+            self.humidity = target + (self.humidity - target) * np.exp(-k_air * dt)
+            self.humidity = np.clip(self.humidity + 0.1 * math.sqrt(dt) * self._noise(len(k)), 0.0, 100.0)
+
+            # Soil moisture: pump in, evaporation out (faster when hot and sunny)
+            heat = 1.0 + 0.05 * np.clip(self.temperature - 20.0, 0.0, None) + sun
+            self.soil = np.clip(
+                self.soil + dt * (self.actuators["water_pump"] * self.pump_rate - self.evaporation * heat),
+                0.0, 1.0
+            )
+
+            # Light: daylight through the roof plus grow lights
+            self.light = (sun * self.daylight_lux * shade + self.actuators["lights"] * self.lamp_lux
+                          + 5.0 * np.abs(self._noise(len(k))))
+
+        for i, name in switch_offs:
+            self.switch_offs[i](name)
+
+    def values(self, quantity: str) -> np.ndarray:
+        """Current readings for one quantity"""
+        return getattr(self, quantity)
+
+    def critical_counts(self) -> Dict[str, int]:
+        """Number of devices outside each sensor's critical range right now"""
+        counts = {}
+        for sensor in self.sensors:
+            values = self.values(sensor["quantity"])
+            low, high = sensor.get("minCritical"), sensor.get("maxCritical")
+            outside = np.zeros(len(values), dtype=bool)
+            if low is not None and sensor.get("actionLow"):
+                outside |= values < low
+            if high is not None and sensor.get("actionHigh"):
+                outside |= values > high
+            counts[f"{sensor['sensorId']}:{sensor['type']}"] = int(outside.sum())
+        return counts
+
+    def sensor_groups(self) -> List[tuple]:
+        """(sensorId, [(sensor index, sensor), ...]) for each published message"""
+        groups: Dict[str, List[tuple]] = {}
+        for k, sensor in enumerate(self.sensors):
+            groups.setdefault(sensor["sensorId"], []).append((k, sensor))
+        return list(groups.items())
+
+    def format_messages(self, sensor_id_format: str = "{sensor}", readings: List[np.ndarray] = None,
+                        selected: Dict[str, np.ndarray] = None,
+                        aggregates: Dict[int, Dict[str, Any]] = None) -> List[List[tuple]]:
+        """Build (topic, payload) pairs per device for the current readings
+
+        Sensors sharing a sensorId (the DHT11) are sent as one composite
+        message such as ``25.5°C,60.0%``; others as a bare number.
+        ``readings`` (one array per sensor) replaces the model's current
+        values, ``selected`` limits each sensorId to some device indices and
+        ``aggregates`` (sensor index -> min/max arrays and sample count) sends
+        single-value sensors as ``{"value": mean, "min": .., "max": .., "n": ..}``.
+        """
+        messages = [[] for _ in self.device_ids]
+        for sensor_id, members in self.sensor_groups():
+            indices = np.arange(len(self.device_ids)) if selected is None else selected[sensor_id]
+            if not len(indices):
+                continue
+
+            columns = []
+            for k, sensor in members:
+                values = self.values(sensor["quantity"]) if readings is None else readings[k]
+                columns.append(np.char.mod(VALUE_FORMATS[sensor["quantity"]], values[indices]).tolist())
+
+            aggregate = aggregates.get(members[0][0]) if aggregates and len(members) == 1 else None
+            if aggregate is not None:
+                number_format = VALUE_FORMATS[members[0][1]["quantity"]]
+                lows = np.char.mod(number_format, aggregate["min"][indices]).tolist()
+                highs = np.char.mod(number_format, aggregate["max"][indices]).tolist()
+
+            for row, i in enumerate(indices.tolist()):
+                topic = "smartfarm/sensors/" + sensor_id_format.format(sensor=sensor_id, device_id=self.device_ids[i])
+                if aggregate is not None:
+                    payload = (f'{{"value":{columns[0][row]},"min":{lows[row]},"max":{highs[row]},'
+                               f'"n":{aggregate["n"]}}}')
+                elif len(members) == 1:
+                    payload = columns[0][row]
+                else:
+                    payload = ",".join(f"{column[row]}{sensor['unit']}" for column, (_, sensor) in zip(columns, members))
+                messages[i].append((topic, payload))
+        return messages
+
+
+class TelemetryPublisher:
+    """Steps an EnvironmentModel on a fixed tick and publishes sensor readings
+
+    ``publishers`` are the simulators' ``publish`` methods, in the same order
+    as the model's device IDs.
+    """
+
+    def __init__(self, model: EnvironmentModel, publishers: List[Callable], interval: float = 10.0,
+                 time_scale: float = 1.0, sensor_id_format: str = "{sensor}", edge=None):
+        self.model = model
+        self.edge = edge  # Optional edge_processing.EdgeProcessor (report by exception)
+        self.publishers = publishers
+        self.interval = interval
+        self.time_scale = time_scale
+        self.sensor_id_format = sensor_id_format
+        self.ticks = 0
+        self.messages_published = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def tick(self):
+        """Step the model once and publish every device's readings"""
+        started = time.perf_counter()
+        self.model.step(self.interval * self.time_scale)
+
+        if self.edge is not None:
+            messages = self.model.format_messages(self.sensor_id_format, *self.edge.process())
+        else:
+            messages = self.model.format_messages(self.sensor_id_format)
+
+        for publish, device_messages in zip(self.publishers, messages):
+            for topic, payload in device_messages:
+                # None: shed by the device's rate limiter
+                if publish(topic, payload, qos=0, kind="telemetry") is not None:
+                    self.messages_published += 1
+
+        self.ticks += 1
+        logger.debug(f"🌡️ Tick {self.ticks}: {self.model.critical_counts()} outside critical range "
+                     f"({(time.perf_counter() - started) * 1000:.1f} ms)")
+
+    def start(self):
+        """Start ticking in a background thread"""
+        def loop():
+            while not self._stop_event.wait(self.interval):
+                try:
+                    self.tick()
+                except Exception as e:
+                    logger.error(f"❌ Telemetry tick failed: {e}")
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=loop, daemon=True)
+        self._thread.start()
+        logger.info(f"🌡️ Publishing telemetry for {len(self.publishers)} devices every {self.interval}s "
+                    f"(time scale x{self.time_scale})")
+
+    def stop(self):
+        """Stop ticking"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1.0)
+        logger.info(f"🌡️ Telemetry stopped after {self.ticks} ticks, {self.messages_published} readings, "
+                    f"{self.model.auto_offs} actuator auto-offs")
+        if self.edge is not None:
+            logger.info(f"📉 {self.edge.format_summary()}")
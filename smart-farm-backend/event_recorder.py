@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+Per-Action Event Recorder
+Records when every command passes each stage of the simulator and breaks the latency down offline.
+
+Usage:
+    python fleet_simulator.py --devices 300 --record-events run.events
+    python event_recorder.py run.events
+    python event_recorder.py run.w0.events run.w1.events --by device --top 20 --json breakdown.json
+
+Stages, per ``actionId``:
+    received       on_message handed the command to the simulator
+    queued         task registered and its worker thread started
+    started        the worker thread began executing the command
+    handler_done   outcome known (latency drawn, handler run); the ack is built next
+    ack_published  the ack was handed to paho, after any uplink rate limiting
+    puback         the broker acknowledged the ack (QoS 1 PUBACK)
+
+Recording is one lock and five typed-array stores per event: rows go into
+preallocated ``array`` columns (wall-clock ns, actionId, device and action
+as interned string numbers, stage). Every ``chunk_rows`` events the columns
+are copied as one chunk into a memory-mapped file, together with the strings
+first seen in that chunk. Nothing is formatted or allocated per event apart
+from new strings.
+
+File layout (native byte order): an 8-byte file magic, then chunks of
+``<4sII4x`` header (magic, rows, string bytes), ``int64`` timestamps, three
+``uint32`` columns, ``uint8`` stages and the chunk's new strings as a JSON
+list, padded to 8 bytes. A run that was killed leaves zeroed space after its
+last chunk, which the reader stops at.
+
+The analysis maps the file and reads every column with ``numpy.frombuffer``,
+so loading copies nothing; commands are joined on (device, actionId) and
+each stage's first event is used.
+"""
+
+import argparse
+import json
+import logging
+import mmap
+import struct
+import sys
+import threading
+import time
+from array import array
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("received", "queued", "started", "handler_done", "ack_published", "puback")
+RECEIVED, QUEUED, STARTED, HANDLER_DONE, ACK_PUBLISHED, PUBACK = range(len(STAGES))
+# Latency segments reported by the analysis: (name, from stage, to stage)
+SEGMENTS = (
+    ("dispatch", RECEIVED, QUEUED),
+    ("thread start", QUEUED, STARTED),
+    ("execution", STARTED, HANDLER_DONE),
+    ("ack publish", HANDLER_DONE, ACK_PUBLISHED),
+    ("broker ack", ACK_PUBLISHED, PUBACK),
+    ("total", RECEIVED, PUBACK),
+)
+
+FILE_MAGIC = b"SFEVENT1"
+CHUNK_MAGIC = b"EVCK"
+CHUNK_HEADER = struct.Struct("<4sII4x")
+CHUNK_ROWS = 8192
+EARLY_PUBACKS = 4096  # PUBACKs kept while their publish() call hasn't returned yet
+
+
+def _padded(size: int) -> int:
+    return (size + 7) & ~7
+
+
+class EventRecorder:
+    """Appends stage events to typed columns and flushes them to a mapped file in chunks"""
+
+    def __init__(self, path: str, chunk_rows: int = CHUNK_ROWS):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.events = 0
+        self.chunks = 0
+        self._ts = array('q', bytes(8 * chunk_rows))
+        self._action_id = array('I', bytes(4 * chunk_rows))
+        self._device = array('I', bytes(4 * chunk_rows))
+        self._action = array('I', bytes(4 * chunk_rows))
+        self._stage = array('B', bytes(chunk_rows))
+        self._rows = 0
+        self._strings: Dict[str, int] = {}
+        self._new_strings: List[str] = []
+        self._pending: Dict[tuple, Tuple[int, int, int]] = {}  # (client, mid) -> interned ack columns
+        self._early: Dict[tuple, int] = {}  # (client, mid) -> PUBACK time seen before the mid was known
+        self._lock = threading.Lock()
+        self._file = open(path, 'w+b')
+        self._size = len(FILE_MAGIC)
+        self._capacity = _padded(len(FILE_MAGIC)) + 4 * self._chunk_size(chunk_rows, 0)
+        self._file.truncate(self._capacity)
+        self._mm = mmap.mmap(self._file.fileno(), self._capacity)
+        self._mm[:len(FILE_MAGIC)] = FILE_MAGIC
+
+    @staticmethod
+    def _chunk_size(rows: int, string_bytes: int) -> int:
+        return _padded(CHUNK_HEADER.size + rows * 21 + string_bytes)
+
+    def _intern(self, value: str) -> int:
+        number = self._strings.get(value)
+        if number is None:
+            number = self._strings[value] = len(self._strings)
+            self._new_strings.append(value)
+        return number
+
+    def _append(self, ts: int, stage: int, action_id: int, device: int, action: int):
+        row = self._rows
+        self._ts[row] = ts
+        self._action_id[row] = action_id
+        self._device[row] = device
+        self._action[row] = action
+        self._stage[row] = stage
+        self._rows = row + 1
+        self.events += 1
+        if self._rows == self.chunk_rows:
+            self._flush_chunk()
+
+    def record(self, stage: int, action_id: str, device_id: str, action: str, ts: int = None):
+        """Record one stage of a command; ``ts`` defaults to now (``time.time_ns()``)"""
+        ts = ts or time.time_ns()
+        strings = self._strings
+        with self._lock:
+            if self._mm is None:
+                return
+            # Inlined _intern/_append: this runs several times per command
+            command = strings.get(action_id)
+            if command is None:
+                command = self._intern(action_id)
+            device = strings.get(device_id)
+            if device is None:
+                device = self._intern(device_id)
+            name = strings.get(action)
+            if name is None:
+                name = self._intern(action)
+            row = self._rows
+            self._ts[row] = ts
+            self._action_id[row] = command
+            self._device[row] = device
+            self._action[row] = name
+            self._stage[row] = stage
+            self._rows = row + 1
+            self.events += 1
+            if row + 1 == self.chunk_rows:
+                self._flush_chunk()
+
+    def ack_published(self, client_key: str, info, action_id: str, device_id: str, action: str, ts: int = None):
+        """Record an ack handed to paho and remember its mid for the PUBACK
+
+        Pass ``ts`` taken just before ``client.publish()`` (after the rate
+        limiter, so throttling counts as "ack publish", not "broker ack"): the
+        PUBACK can arrive on the network thread before publish() returns, and
+        stamping afterwards would put ack_published after it.
+        """
+        ts = ts or time.time_ns()
+        with self._lock:
+            if self._mm is None:
+                return
+            columns = (self._intern(action_id), self._intern(device_id), self._intern(action))
+            self._append(ts, ACK_PUBLISHED, *columns)
+            if info is None or info.rc != 0:
+                return
+            key = (client_key, info.mid)
+            acked = self._early.pop(key, None)
+            if acked is not None:
+                self._append(acked, PUBACK, *columns)
+            else:
+                self._pending[key] = columns
+
+    def puback(self, client_key: str, mid: int):
+        """Record the broker's PUBACK for an ack (other publishes are ignored)"""
+        ts = time.time_ns()
+        with self._lock:
+            if self._mm is None:
+                return
+            columns = self._pending.pop((client_key, mid), None)
+            if columns is not None:
+                self._append(ts, PUBACK, *columns)
+                return
+            # Either not an ack, or the PUBACK beat publish() returning: keep it briefly
+            self._early[(client_key, mid)] = ts
+            if len(self._early) > EARLY_PUBACKS:
+                del self._early[next(iter(self._early))]
+
+    def _flush_chunk(self):
+        rows = self._rows
+        if not rows and not self._new_strings:
+            return
+        strings = json.dumps(self._new_strings).encode('utf-8') if self._new_strings else b""
+        size = self._chunk_size(rows, len(strings))
+        offset = _padded(self._size)
+        if offset + size > self._capacity:
+            self._capacity = max(2 * self._capacity, offset + size)
+            self._mm.resize(self._capacity)
+        mm = self._mm
+        mm[offset:offset + CHUNK_HEADER.size] = CHUNK_HEADER.pack(CHUNK_MAGIC, rows, len(strings))
+        position = offset + CHUNK_HEADER.size
+        for column, itemsize in ((self._ts, 8), (self._action_id, 4), (self._device, 4),
+                                 (self._action, 4), (self._stage, 1)):
+            mm[position:position + rows * itemsize] = memoryview(column)[:rows].cast('B')
+            position += rows * itemsize
+        mm[position:position + len(strings)] = strings
+        self._size = offset + size
+        self._rows = 0
+        self._new_strings = []
+        self.chunks += 1
+
+    def flush(self):
+        """Write the rows recorded so far as a (possibly short) chunk"""
+        with self._lock:
+            if self._mm is not None:
+                self._flush_chunk()
+                self._mm.flush()
+
+    def close(self):
+        """Flush the last chunk and trim the file to its contents"""
+        with self._lock:
+            if self._mm is None:
+                return
+            self._flush_chunk()
+            self._mm.flush()
+            self._mm.close()
+            self._mm = None
+            self._file.truncate(self._size)
+            self._file.close()
+
+    def format_summary(self) -> str:
+        return (f"{self.events} events ({len(self._strings)} distinct ids) in {self.chunks} chunks "
+                f"to {self.path} ({self._size / 1e6:.1f} MB)")
+
+
+def load_events(path: str) -> Dict[str, Any]:
+    """Map an event file and return its columns (numpy views of the mapping) and string table"""
+    import numpy as np
+
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(FILE_MAGIC)] != FILE_MAGIC:
+        raise ValueError(f"{path} is not an event recorder file")
+    columns = {name: [] for name in ("ts", "actionId", "device", "action", "stage")}
+    strings: List[str] = []
+    offset = _padded(len(FILE_MAGIC))
+    while offset + CHUNK_HEADER.size <= len(mm):
+        magic, rows, string_bytes = CHUNK_HEADER.unpack_from(mm, offset)
+        if magic != CHUNK_MAGIC:
+            break  # zeroed tail of a run that didn't close its recorder
+        position = offset + CHUNK_HEADER.size
+        for name, dtype, itemsize in (("ts", np.int64, 8), ("actionId", np.uint32, 4), ("device", np.uint32, 4),
+                                      ("action", np.uint32, 4), ("stage", np.uint8, 1)):
+            columns[name].append(np.frombuffer(mm, dtype=dtype, count=rows, offset=position))
+            position += rows * itemsize
+        if string_bytes:
+            strings.extend(json.loads(mm[position:position + string_bytes].decode('utf-8')))
+        offset += EventRecorder._chunk_size(rows, string_bytes)
+    return {"columns": columns, "strings": strings}
+
+
+def build_commands(paths: List[str]) -> Dict[str, Any]:
+    """Join the events of one or more files into one row per command with a timestamp per stage"""
+    import numpy as np
+
+    stage_times, devices, actions = [], [], []
+    for path in paths:
+        loaded = load_events(path)
+        columns, strings = loaded["columns"], np.array(loaded["strings"] or [""], dtype=object)
+        if not columns["ts"]:
+            continue
+        # Chunks are views of the mapping; joining needs one array per column
+        ts, action_id, device, action, stage = (np.concatenate(columns[name]) for name in
+                                                ("ts", "actionId", "device", "action", "stage"))
+        keys = (device.astype(np.int64) << 32) | action_id
+        commands, first = np.unique(keys, return_index=True)
+        times = np.full((len(commands), len(STAGES)), np.nan)
+        order = np.argsort(ts, kind='stable')
+        for number in range(len(STAGES)):
+            rows = order[stage[order] == number]
+            stage_keys, first_rows = np.unique(keys[rows], return_index=True)
+            times[np.searchsorted(commands, stage_keys), number] = ts[rows[first_rows]]
+        stage_times.append(times)
+        devices.append(strings[device[first]])
+        actions.append(strings[action[first]])
+    if not stage_times:
+        return {"times": np.empty((0, len(STAGES))), "devices": np.array([], dtype=object),
+                "actions": np.array([], dtype=object)}
+    return {"times": np.concatenate(stage_times), "devices": np.concatenate(devices),
+            "actions": np.concatenate(actions)}
+
+
+def segment_stats(times) -> Dict[str, Dict[str, Any]]:
+    """Count and percentiles (ms) of each latency segment over the given commands"""
+    import numpy as np
+
+    stats = {}
+    for name, start, end in SEGMENTS:
+        values = (times[:, end] - times[:, start]) / 1e6
+        values = values[~np.isnan(values)]
+        if not len(values):
+            stats[name] = {"count": 0}
+            continue
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        stats[name] = {"count": int(len(values)), "meanMs": round(float(values.mean()), 3),
+                       "p50Ms": round(float(p50), 3), "p90Ms": round(float(p90), 3),
+                       "p99Ms": round(float(p99), 3), "maxMs": round(float(values.max()), 3)}
+    return stats
+
+
+def analyze(paths: List[str], by: str = "action", top: int = 10) -> Dict[str, Any]:
+    """Latency breakdown per stage overall, per action and per device"""
+    import numpy as np
+
+    commands = build_commands(paths)
+    times = commands["times"]
+    reached = {stage: int((~np.isnan(times[:, number])).sum()) for number, stage in enumerate(STAGES)}
+    result = {"files": paths, "commands": len(times), "reached": reached, "overall": segment_stats(times)}
+    for group in ("action", "device"):
+        labels = commands[f"{group}s"]
+        groups = {}
+        for label in sorted(set(labels)):
+            groups[label] = segment_stats(times[labels == label])
+        if group == "device":
+            # Only the slowest devices by p99 total, a fleet has too many to list
+            ranked = sorted(groups.items(), key=lambda item: item[1]["total"].get("p99Ms", -1), reverse=True)
+            groups = dict(ranked[:top])
+        result[f"by{group.capitalize()}"] = groups
+    result["by"] = by
+    return result
+
+
+def print_report(result: Dict[str, Any]):
+    """Print the overall stage table and the per-action or per-device totals"""
+    print()
+    print(f"{result['commands']} commands; reached: "
+          + ", ".join(f"{stage} {count}" for stage, count in result["reached"].items()))
+    print()
+    header = f"{'stage':<14} {'count':>8} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}  (ms)"
+    print(header)
+    print("-" * len(header))
+    for name, stats in result["overall"].items():
+        if stats["count"]:
+            print(f"{name:<14} {stats['count']:>8} {stats['meanMs']:>9.2f} {stats['p50Ms']:>9.2f} "
+                  f"{stats['p90Ms']:>9.2f} {stats['p99Ms']:>9.2f} {stats['maxMs']:>9.2f}")
+        else:
+            print(f"{name:<14} {0:>8}")
+
+    groups = result["byAction"] if result["by"] == "action" else result["byDevice"]
+    segments = [name for name, _, _ in SEGMENTS]
+    print()
+    header = f"{result['by']:<24} {'count':>7} " + " ".join(f"{name + ' p99':>16}" for name in segments)
+    print(header)
+    print("-" * len(header))
+    for label, stats in groups.items():
+        count = max(segment["count"] for segment in stats.values())
+        cells = " ".join(f"{stats[name]['p99Ms']:>16.2f}" if stats[name]["count"] else f"{'-':>16}"
+                         for name in segments)
+        print(f"{str(label)[:24]:<24} {count:>7} {cells}")
+    print()
+
+
+def main():
+    """Main entry point"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%H:%M:%S'
+    )
+    parser = argparse.ArgumentParser(description='Per-action latency breakdown from event recorder files')
+    parser.add_argument('files', nargs='+',
+                       help='Event files written with --record-events (one per fleet worker)')
+    parser.add_argument('--by', choices=['action', 'device'], default='action',
+                       help='Second table grouped by action or by device (default: action)')
+    parser.add_argument('--top', type=int, default=10,
+                       help='Devices listed, slowest p99 total first (default: 10)')
+    parser.add_argument('--json', dest='json_path', default=None,
+                       help='Also write the breakdown to this JSON file')
+
+    args = parser.parse_args()
+
+    started = time.time()
+    try:
+        result = analyze(args.files, args.by, args.top)
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ {e}")
+        sys.exit(2)
+    print_report(result)
+    logger.info(f"⏱️ Analyzed {result['commands']} commands from {len(args.files)} file(s) "
+                f"in {time.time() - started:.2f}s")
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(result, f, indent=2)
+        logger.info(f"💾 Breakdown written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
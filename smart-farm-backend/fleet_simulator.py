@@ -0,0 +1,778 @@
+#!/usr/bin/env python3
+"""
+Smart Farm Device Fleet Simulator
+Runs many simulated devices in a single process and manages them as one fleet.
+
+Usage:
+    python fleet_simulator.py --devices 300 --device-prefix greenhouse --simulator dynamic
+    python fleet_simulator.py --scenario scenario.example.yaml --shard 0/4
+    python fleet_simulator.py --devices 1200 --workers 4
+    python fleet_simulator.py --devices 300 --local-backend --backend-latency 40
+    python fleet_simulator.py --scenario storm.yaml --local-backend --link-proxy 3g -b mqtt://127.0.0.1:1883
+
+Shutdown is done in three fleet-wide phases instead of device by device:
+1. every device publishes its retained offline status,
+2. all devices drain their in-flight QoS 1 messages against one shared deadline,
+3. all connections are closed in parallel.
+
+With ``--workers N`` the fleet is split over N processes. By default the
+parent is a zygote: it does the imports, builds the TLS context and every
+device, and loads each dynamic device's catalog and handlers once, then
+forks workers that share that memory copy-on-write (``gc.freeze()`` keeps the
+collector from touching, and so copying, the inherited objects) and only
+open their own connections. ``--spawn cold`` starts each worker as a fresh
+process instead, for comparison. Every worker reports its time to first
+connected device and its memory, and the parent logs them side by side.
+"""
+
+import atexit
+import gc
+import json
+import os
+import time
+import threading
+import signal
+import subprocess
+import sys
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import mqtt_transport
+import mqtt_wire
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+
+def load_simulator_class(kind: str):
+    """Import the simulator class for the given kind (static or dynamic)"""
+    if kind == 'dynamic':
+        from dynamic_device_simulator import DynamicSmartFarmDeviceSimulator
+        return DynamicSmartFarmDeviceSimulator
+    from device_simulator import SmartFarmDeviceSimulator
+    return SmartFarmDeviceSimulator
+
+
+class SimulatorFleet:
+    """A group of device simulators started and stopped together"""
+
+    def __init__(self, devices: List[Any], shutdown_workers: int = 64):
+        self.devices = devices
+        self.shutdown_workers = shutdown_workers
+        self.drain_timeout = 5.0  # Shared deadline for the whole fleet, not per device
+        self.is_running = False
+        self.telemetry = []  # environment_model.TelemetryPublisher per sensor layout
+        self.sensor_layouts = None  # (sensors, sensor ID format, devices) per scenario group
+        self.scenario_runner = None  # Optional scenario.ScenarioRunner driving phases and faults
+        self.catalog_refresh_interval = 0  # Seconds between fleet-wide action catalog reloads; 0 disables
+        self.global_rate_limiter = None  # Optional rate_limit.RateLimiter shared by every device (farm uplink)
+        self.broker_cluster = None  # Optional mqtt_transport.BrokerCluster the devices are spread over
+        self.loop_watchdog = None  # Optional loop_watchdog.LoopWatchdog shared by every device's network loop
+        self.event_recorder = None  # Optional event_recorder.EventRecorder shared by every device
+        self.state_checkpoint = None  # Optional state_checkpoint.StateCheckpoint covering every device
+        self._stop_event = threading.Event()
+
+    @classmethod
+    def create(cls, simulator_class, device_ids: List[str], **simulator_kwargs) -> 'SimulatorFleet':
+        """Build a fleet of simulators that share the same connection settings"""
+        devices = [
+            simulator_class(device_id, install_signal_handlers=False, **simulator_kwargs)
+            for device_id in device_ids
+        ]
+        return cls(devices)
+
+    @classmethod
+    def from_scenario(cls, scenario, simulator_class, shard: int = 0, shards: int = 1, catalogs: bool = True,
+                      **simulator_kwargs) -> 'SimulatorFleet':
+        """Build the devices of one scenario shard, streaming them from the scenario
+
+        With ``catalogs=False`` the groups' action lists are not handed to the
+        devices, which fetch them from the backend (e.g. a local_backend.py
+        serving the same scenario) instead.
+        """
+        devices = []
+        layouts = {}
+        for spec in scenario.iter_devices(shard, shards):
+            device = simulator_class(spec.device_id, install_signal_handlers=False, **simulator_kwargs)
+            if catalogs and spec.actions is not None and hasattr(device, 'action_catalog'):
+                device.action_catalog = spec.actions
+            layouts.setdefault(spec.group, (spec.sensors, spec.sensor_id_format, []))[2].append(device)
+            devices.append(device)
+
+        fleet = cls(devices)
+        fleet.sensor_layouts = list(layouts.values())
+        return fleet
+
+    def enable_telemetry(self, interval: float, time_scale: float = 1.0, seed: int = None,
+                         sensor_id_format: str = "{device_id}-{sensor}", edge: Dict[str, Any] = None):
+        """Publish closed-loop sensor readings for every device from vectorized models
+
+        Devices sharing a sensor layout (one scenario group) share one model.
+        ``edge`` holds EdgeProcessor options to report by exception.
+        """
+        from environment_model import EnvironmentModel, TelemetryPublisher
+        from edge_processing import EdgeProcessor
+
+        layouts = self.sensor_layouts or [(None, sensor_id_format, self.devices)]
+        for number, (sensors, id_format, devices) in enumerate(layouts):
+            model = EnvironmentModel([device.device_id for device in devices], sensors,
+                                     seed=None if seed is None else seed + number)
+            for device in devices:
+                model.bind(device.device_id, device.device_state, device.switch_off)
+            self.telemetry.append(TelemetryPublisher(model, [device.publish for device in devices],
+                                                     interval, time_scale, id_format,
+                                                     EdgeProcessor(model, **edge) if edge is not None else None))
+
+    def start(self):
+        """Start every device without blocking on its connection"""
+        logger.info(f"🚀 Starting fleet of {len(self.devices)} devices")
+        self.is_running = True
+        self._stop_event.clear()
+
+        for device in self.devices:
+            device.start(blocking=False)
+
+        for publisher in self.telemetry:
+            publisher.start()
+        if self.scenario_runner is not None:
+            self.scenario_runner.start()
+        if self.catalog_refresh_interval > 0:
+            threading.Thread(target=self._catalog_refresh_loop, daemon=True).start()
+
+        logger.info(f"✅ Fleet started")
+
+    def wait(self):
+        """Block until the fleet is stopped"""
+        while not self._stop_event.wait(1.0):
+            pass
+
+    def stop(self):
+        """Stop every device concurrently"""
+        if not self.is_running:
+            return
+
+        logger.info(f"🛑 Stopping fleet of {len(self.devices)} devices...")
+        self.is_running = False
+        started = time.time()
+        deadline = started + self.drain_timeout
+
+        if self.scenario_runner is not None:
+            self.scenario_runner.stop()
+        for publisher in self.telemetry:
+            publisher.stop()
+        if self.broker_cluster is not None:
+            # Before disconnecting, while the connection counts are still live
+            logger.info(f"🕸️ Brokers: {self.broker_cluster.format_summary()}")
+
+        in_flight = {}
+        for device in self.devices:
+            in_flight.update(device.tasks.in_flight())
+        if in_flight:
+            from action_tasks import format_in_flight
+            logger.warning(f"⏳ {len(in_flight)} command(s) still executing at shutdown: {format_in_flight(in_flight)}")
+
+        # Phase 1: every device announces offline before anyone waits
+        for device in self.devices:
+            device.begin_shutdown()
+
+        # Phase 2: acks flush in parallel on each device's network thread,
+        # so waiting on them one after another costs at most one deadline
+        undrained = sum(1 for device in self.devices if not device.drain(deadline))
+
+        # Phase 3: disconnect and join network threads in parallel
+        workers = max(1, min(self.shutdown_workers, len(self.devices)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda device: device.finish_shutdown(), self.devices))
+
+        self._stop_event.set()
+        logger.info(f"✅ Fleet stopped in {time.time() - started:.2f}s "
+                    f"({undrained} devices with undelivered messages)")
+        logger.info(f"📦 Fleet egress: {self.wire_stats().format_summary()}")
+        throttle = self.throttle_stats()
+        if throttle is not None:
+            logger.info(f"🚦 Fleet uplink {throttle.format_summary()}")
+        if self.loop_watchdog is not None:
+            self.loop_watchdog.stop()
+            logger.info(f"🩺 Fleet network loops: {self.loop_watchdog.format_summary()}")
+        if self.event_recorder is not None:
+            self.event_recorder.close()
+            logger.info(f"🧾 Fleet events: {self.event_recorder.format_summary()}")
+        if any(device.tasks.coalesce_window > 0 for device in self.devices):
+            from action_tasks import format_counts
+            logger.info(f"🧮 Fleet coalescing: {format_counts(self.task_counts())}")
+        if self.state_checkpoint is not None:
+            self.state_checkpoint.stop()
+            logger.info(f"💾 Fleet state: {self.state_checkpoint.format_summary()}")
+
+    def prepare(self):
+        """Load every dynamic device's catalog and build its handlers now instead of in start()"""
+        devices = [device for device in self.devices if hasattr(device, 'setup_dynamic_actions')]
+        if not devices:
+            return
+        workers = max(1, min(self.shutdown_workers, len(devices)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda device: device.setup_dynamic_actions(), devices))
+
+    def report_startup(self, report_fd: int, launched_at: float, worker: int, timeout: float = 120.0):
+        """Write one JSON line with connect times and memory to the parent of a --workers fleet"""
+        first = None
+        connected = 0
+        deadline = time.time() + timeout
+        while time.time() < deadline and self.is_running:
+            connected = sum(1 for device in self.devices if device.client.is_connected())
+            if connected and first is None:
+                first = time.time() - launched_at
+            if connected >= len(self.devices):
+                break
+            time.sleep(0.02 if first is None else 0.1)
+        report = {"worker": worker, "pid": os.getpid(), "devices": len(self.devices), "connected": connected,
+                  "firstConnectedSeconds": round(first, 3) if first is not None else None,
+                  "allConnectedSeconds": (round(time.time() - launched_at, 3)
+                                          if connected >= len(self.devices) else None),
+                  **memory_usage()}
+        with os.fdopen(report_fd, 'w') as f:
+            f.write(json.dumps(report) + "\n")
+
+    def reload_catalogs(self) -> Dict[str, Any]:
+        """Reload every device's action catalog in parallel and report the changes"""
+        devices = [device for device in self.devices if hasattr(device, 'reload_actions')]
+        if not devices:
+            return {}
+        started = time.perf_counter()
+        workers = max(1, min(self.shutdown_workers, len(devices)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda device: device.reload_actions(), devices))
+
+        reloaded = [result for result in results if result is not None]
+        summary = {
+            "devices": len(devices),
+            "failed": len(devices) - len(reloaded),
+            "changedDevices": sum(1 for result in reloaded if result["added"] or result["removed"] or result["changed"]),
+            "changes": sum(len(result["added"]) + len(result["removed"]) + len(result["changed"]) for result in reloaded),
+            "maxLatencyMs": max((result["latencyMs"] for result in reloaded), default=0.0),
+            "elapsedMs": round((time.perf_counter() - started) * 1000, 1),
+        }
+        logger.info(f"🔁 Fleet catalog reload: {summary['changes']} changes on {summary['changedDevices']}"
+                    f"/{summary['devices']} devices in {summary['elapsedMs']} ms "
+                    f"(slowest device {summary['maxLatencyMs']} ms, {summary['failed']} failed)")
+        return summary
+
+    def _catalog_refresh_loop(self):
+        """Reload all catalogs every catalog_refresh_interval seconds"""
+        while not self._stop_event.wait(self.catalog_refresh_interval):
+            if self.is_running:
+                self.reload_catalogs()
+
+    def reload_signal_handler(self, signum, frame):
+        """Reload all action catalogs on SIGHUP"""
+        logger.info(f"📡 Received signal {signum}, reloading action catalogs...")
+        threading.Thread(target=self.reload_catalogs, daemon=True).start()
+
+    def enable_rate_limits(self, profile: Dict[str, float] = None, global_profile: Dict[str, float] = None):
+        """Give every device its own uplink buckets, optionally all under one global pair"""
+        from rate_limit import RateLimiter
+
+        if global_profile is not None:
+            self.global_rate_limiter = RateLimiter(global_profile)
+        for device in self.devices:
+            # Without a per-device profile, devices only share the global buckets
+            device.rate_limiter = (RateLimiter(profile, parent=self.global_rate_limiter)
+                                   if profile is not None else self.global_rate_limiter)
+
+    def enable_loop_watchdog(self, threshold: float):
+        """Time every device's network-loop callbacks with one shared watchdog"""
+        from loop_watchdog import LoopWatchdog
+
+        self.loop_watchdog = LoopWatchdog(threshold)
+        for device in self.devices:
+            device.loop_watchdog = self.loop_watchdog
+
+    def enable_event_recorder(self, path: str):
+        """Record every device's command stages into one event file"""
+        from event_recorder import EventRecorder
+
+        self.event_recorder = EventRecorder(path)
+        for device in self.devices:
+            device.event_recorder = self.event_recorder
+
+    def enable_state_checkpoint(self, path: str, interval: float):
+        """Restore every device's state from one checkpoint, then keep checkpointing it"""
+        from state_checkpoint import StateCheckpoint
+
+        self.state_checkpoint = StateCheckpoint(path, interval)
+        self.state_checkpoint.restore(self.device_states())
+        self.state_checkpoint.start(self.device_states)
+
+    def device_states(self) -> Dict[str, Dict[str, Any]]:
+        """Every device_state dict in the fleet by device ID, shared-subscription partitions included"""
+        states = {}
+        for device in self.devices:
+            states.update(getattr(device, 'device_states', None) or {device.device_id: device.device_state})
+        return states
+
+    def task_counts(self) -> Dict[str, float]:
+        """Command task counters (submitted, preempted, coalesced, ...) summed over all devices"""
+        total: Dict[str, float] = {}
+        for device in self.devices:
+            for name, value in device.tasks.counts.items():
+                total[name] = total.get(name, 0) + value
+        return total
+
+    def throttle_stats(self):
+        """Rate limiter delay counters summed over all devices, or None without rate limits"""
+        if self.global_rate_limiter is not None:
+            return self.global_rate_limiter.stats
+        limiters = [device.rate_limiter for device in self.devices if getattr(device, 'rate_limiter', None)]
+        if not limiters:
+            return None
+        from rate_limit import ThrottleStats
+        total = ThrottleStats()
+        for limiter in limiters:
+            total.merge(limiter.stats)
+        return total
+
+    def wire_stats(self) -> mqtt_wire.WireStats:
+        """Outbound message and byte counters summed over all devices"""
+        total = mqtt_wire.WireStats()
+        for device in self.devices:
+            if hasattr(device, 'wire_stats'):
+                total.merge(device.wire_stats)
+        return total
+
+    def signal_handler(self, signum, frame):
+        """Handle shutdown signals"""
+        if not self.is_running:
+            return  # Shutdown already in progress
+        logger.info(f"📡 Received signal {signum}, shutting down fleet...")
+        self.stop()
+        sys.exit(0)
+
+
+def memory_usage(pid: str = 'self') -> Dict[str, float]:
+    """RSS, plus PSS and private memory on Linux, in MB
+
+    RSS counts every shared copy-on-write page in full; PSS splits shared
+    pages between the processes mapping them and private (USS) is what the
+    process alone holds, so those two show what forking actually saved.
+    Without /proc only the peak RSS is known, reported as ``peakRssMB`` so it
+    isn't compared with current RSS.
+    """
+    usage = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        kb = {key: int(value.split()[0]) for key, value in fields.items() if value.strip().endswith('kB')}
+        usage["rssMB"] = round(kb.get("Rss", 0) / 1024, 1)
+        usage["pssMB"] = round(kb.get("Pss", 0) / 1024, 1)
+        usage["privateMB"] = round((kb.get("Private_Clean", 0) + kb.get("Private_Dirty", 0)) / 1024, 1)
+    except (OSError, ValueError):
+        import resource
+        usage["peakRssMB"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return usage
+
+
+def worker_range(count: int, worker: int, workers: int) -> range:
+    """Contiguous slice of device indices for one worker (same split as scenario shards)"""
+    return range(count * worker // workers, count * (worker + 1) // workers)
+
+
+class WorkerSupervisor:
+    """Parent side of --workers: forwards signals, collects startup reports and reaps the workers"""
+
+    def __init__(self, mode: str, workers: int, report_fd: int):
+        self.mode = mode
+        self.workers = workers
+        self.pids: Dict[int, int] = {}  # pid -> worker index
+        self.reports: List[Dict[str, Any]] = []
+        self._reports = os.fdopen(report_fd)
+
+    def add(self, pid: int, worker: int):
+        self.pids[pid] = worker
+
+    def forward_signal(self, signum, frame):
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def read_reports(self):
+        for line in self._reports:
+            report = json.loads(line)
+            self.reports.append(report)
+            memory = (f"RSS {report['rssMB']} MB, PSS {report.get('pssMB', '-')} MB, "
+                      f"private {report.get('privateMB', '-')} MB" if 'rssMB' in report
+                      else f"peak RSS {report.get('peakRssMB', '-')} MB")
+            logger.info(f"👷 Worker {report['worker']} (pid {report['pid']}): first device connected after "
+                        f"{report['firstConnectedSeconds']}s, {report['connected']}/{report['devices']} after "
+                        f"{report['allConnectedSeconds']}s; {memory}")
+            if len(self.reports) == self.workers:
+                logger.info(f"🧬 {self.format_summary()}")
+
+    def format_summary(self) -> str:
+        firsts = [r["firstConnectedSeconds"] for r in self.reports if r["firstConnectedSeconds"] is not None]
+        alls = [r["allConnectedSeconds"] for r in self.reports if r["allConnectedSeconds"] is not None]
+
+        def mean(key):
+            values = [r[key] for r in self.reports if key in r]
+            return round(sum(values) / len(values), 1) if values else '-'
+
+        memory = (f"RSS {mean('rssMB')} MB, PSS {mean('pssMB')} MB, private {mean('privateMB')} MB"
+                  if any('rssMB' in r for r in self.reports) else f"peak RSS {mean('peakRssMB')} MB")
+        return (f"{self.mode} start of {self.workers} workers: first device connected after "
+                f"{min(firsts, default=float('nan')):.3f}s (slowest worker {max(firsts, default=float('nan')):.3f}s), "
+                f"all connected after {max(alls, default=float('nan')):.3f}s; per worker {memory}")
+
+    def run(self) -> int:
+        """Wait for every worker to exit; returns the worst exit status"""
+        for signum in (signal.SIGINT, signal.SIGTERM, getattr(signal, 'SIGHUP', None)):
+            if signum is not None:
+                signal.signal(signum, self.forward_signal)
+        threading.Thread(target=self.read_reports, daemon=True).start()
+        status = 0
+        while self.pids:
+            pid, wait_status = os.wait()
+            worker = self.pids.pop(pid, None)
+            code = os.waitstatus_to_exitcode(wait_status)
+            if worker is not None and code not in (0, -signal.SIGINT, -signal.SIGTERM):
+                logger.error(f"❌ Worker {worker} (pid {pid}) exited with {code}")
+                status = 1
+        return status
+
+
+def worker_path(path: str, index: Optional[int]) -> str:
+    """PATH with .w<INDEX> before the extension, or PATH itself outside workers and shards"""
+    if index is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.w{index}{ext}"
+
+
+def spawn_cold_workers(workers: int, extra_args: List[str] = ()) -> int:
+    """Start each worker as a fresh fleet_simulator.py process running one shard"""
+    read_fd, write_fd = os.pipe()
+    supervisor = WorkerSupervisor("cold", workers, read_fd)
+    launched_at = time.time()
+    for worker in range(workers):
+        command = [sys.executable, os.path.abspath(__file__), *sys.argv[1:], *extra_args, '--workers', '1',
+                   '--shard', f"{worker}/{workers}", '--report-fd', str(write_fd), '--launched-at', repr(launched_at)]
+        supervisor.add(subprocess.Popen(command, pass_fds=(write_fd,)).pid, worker)
+    os.close(write_fd)
+    logger.info(f"🚀 Spawned {workers} cold workers")
+    return supervisor.run()
+
+
+def start_local_backend(args) -> str:
+    """Start local_backend.py for this run and return its API URL; it is stopped when we exit"""
+    from local_backend import start_process
+
+    backend_args = ['--latency', str(args.backend_latency), '--error-rate', str(args.backend_error_rate)]
+    if args.scenario:
+        backend_args += ['--scenario', args.scenario]
+    process, url = start_process(backend_args)
+    stop_at_exit(process)
+    logger.info(f"🗂️ Local backend at {url} (pid {process.pid})")
+    return url
+
+
+def start_link_proxy(args) -> str:
+    """Start link_proxy.py in front of the broker and return the broker URL that goes through it"""
+    from link_proxy import start_process
+
+    endpoint = mqtt_transport.parse_broker_url(args.broker_url)
+    proxy_args = ['--upstream', f"{endpoint.host}:{endpoint.port}", '--profile', args.link_proxy]
+    if args.scenario:
+        proxy_args += ['--scenario', args.scenario, '--start-at', repr(args.timeline_start)]
+    process, port = start_process(proxy_args)
+    stop_at_exit(process)
+    if endpoint.use_ssl and not args.insecure:
+        logger.warning(f"⚠️ The broker certificate is for {endpoint.host}, not the proxy at 127.0.0.1; "
+                       f"add --insecure if TLS verification fails")
+    path = endpoint.ws_path if endpoint.transport == 'websockets' else ''
+    url = f"{endpoint.scheme}://127.0.0.1:{port}{path}"
+    logger.info(f"🌩️ Link proxy at {url} -> {endpoint.host}:{endpoint.port} (pid {process.pid})")
+    return url
+
+
+def stop_at_exit(process: subprocess.Popen):
+    """Terminate a helper process when the process that started it exits"""
+    owner = os.getpid()
+
+    def stop():
+        # Forked workers inherit this handler; only the process that started the helper stops it
+        if os.getpid() == owner and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    atexit.register(stop)
+
+
+def fork_workers(fleet: SimulatorFleet, workers: int) -> Tuple[SimulatorFleet, Tuple[int, float, int]]:
+    """Fork workers from a prepared fleet; returns (this worker's fleet, report args) in each child
+
+    The parent never returns: it supervises the workers and exits with their status.
+    """
+    read_fd, write_fd = os.pipe()
+    supervisor = WorkerSupervisor("zygote", workers, read_fd)
+    # Objects built so far move to a permanent generation the collector never
+    # scans, so the workers' collections don't write to (and copy) shared pages
+    gc.freeze()
+    launched_at = time.time()
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            devices = [fleet.devices[index] for index in worker_range(len(fleet.devices), worker, workers)]
+            logger.info(f"👷 Worker {worker} (pid {os.getpid()}) running {len(devices)} devices")
+            child = SimulatorFleet(devices, fleet.shutdown_workers)
+            if fleet.sensor_layouts is not None:
+                mine = {id(device) for device in devices}
+                child.sensor_layouts = [(sensors, id_format, [device for device in group if id(device) in mine])
+                                        for sensors, id_format, group in fleet.sensor_layouts]
+                child.sensor_layouts = [layout for layout in child.sensor_layouts if layout[2]]
+            if fleet.scenario_runner is not None:
+                # A worker's slice is the scenario shard of the same number, so faults hit the same devices
+                from scenario import ScenarioRunner
+                runner = fleet.scenario_runner
+                child.scenario_runner = ScenarioRunner(runner.scenario, child, worker, workers, runner.tick,
+                                                       started=runner.started)
+            return child, (write_fd, launched_at, worker)
+        supervisor.add(pid, worker)
+    os.close(write_fd)
+    usage = memory_usage()
+    rss = f"{usage['rssMB']} MB RSS" if 'rssMB' in usage else f"{usage['peakRssMB']} MB peak RSS"
+    logger.info(f"🧬 Forked {workers} workers from the zygote (pid {os.getpid()}, {rss})")
+    sys.exit(supervisor.run())
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Smart Farm IoT Device Fleet Simulator')
+    parser.add_argument('--devices', '-c', type=int, default=10,
+                       help='Number of simulated devices (default: 10)')
+    parser.add_argument('--device-prefix', '-d', default='sim',
+                       help='Device ID prefix; devices are named <prefix>-<n> (default: sim)')
+    parser.add_argument('--simulator', choices=['static', 'dynamic'], default='dynamic',
+                       help='Simulator implementation to run (default: dynamic)')
+    parser.add_argument('--broker-url', '-b',
+                       default='wss://i37c1733.ala.us-east-1.emqxsl.com:8084/mqtt',
+                       help='MQTT broker URL: mqtt://, mqtts://, ws:// or wss:// (default: EMQX Cloud WSS); '
+                            'several comma-separated URLs spread devices over a cluster')
+    parser.add_argument('--backend-url', default='http://localhost:3000/api',
+                       help='Backend API URL for the dynamic simulator (default: http://localhost:3000/api)')
+    parser.add_argument('--local-backend', action='store_true',
+                       help='Serve catalogs from a local_backend.py started for this run (from the --scenario '
+                            'or the SQL seed data) instead of --backend-url')
+    parser.add_argument('--backend-latency', type=float, default=0, metavar='MS',
+                       help='With --local-backend, delay every catalog response by MS milliseconds (default: 0)')
+    parser.add_argument('--backend-error-rate', type=float, default=0,
+                       help='With --local-backend, fraction of catalog requests that fail with 503 (default: 0)')
+    parser.add_argument('--link-proxy', default=None, metavar='PROFILE',
+                       help='Route every device through a link_proxy.py emulating this link (2g, 3g, lte, '
+                            '"latency=200ms,loss=2%%", ...); plays the --scenario\'s link and partition faults')
+    parser.add_argument('--username', '-n', default='oussama2255',
+                       help='MQTT username (default: oussama2255)')
+    parser.add_argument('--password', '-p', default='Oussama2255',
+                       help='MQTT password (default: Oussama2255)')
+    parser.add_argument('--success-rate', '-s', type=float, default=0.85,
+                       help='Action success rate 0.0-1.0 (default: 0.85)')
+    parser.add_argument('--rate-profile', default=None,
+                       help='Per-device uplink limit: esp32-2g, esp32-lte-m, esp32-wifi, pi-wifi, pi-fibre '
+                            'or MSGS:BYTES per second (default: unlimited)')
+    parser.add_argument('--global-rate', default=None,
+                       help='Limit for the whole fleet, e.g. the farm uplink: profile name or MSGS:BYTES per second')
+    parser.add_argument('--loop-watchdog', type=float, default=0, metavar='MS',
+                       help='Warn with a stack sample when a network-loop callback runs over MS milliseconds, '
+                            'and track keepalive margins (default: off)')
+    parser.add_argument('--record-events', default=None, metavar='PATH',
+                       help='Record every command\'s stage timestamps to PATH for event_recorder.py; workers and '
+                            'shards write PATH with .w<INDEX> before the extension (default: off)')
+    parser.add_argument('--checkpoint', default=None, metavar='PATH',
+                       help='Restore actuator state from PATH on start and checkpoint it there; workers and shards '
+                            'use PATH with .w<INDEX> before the extension (default: off)')
+    parser.add_argument('--checkpoint-interval', type=float, default=5.0, metavar='SECONDS',
+                       help='With --checkpoint, seconds between incremental checkpoints (default: 5)')
+    parser.add_argument('--no-preemption', action='store_true',
+                       help='Let every command run to completion instead of preempting older ones per actuator')
+    parser.add_argument('--coalesce-window', type=float, default=0, metavar='SECONDS',
+                       help='Merge a repeated command into the identical one still in flight if it arrives within '
+                            'SECONDS of it; every command still gets its own ack (default: off)')
+    parser.add_argument('--drain-timeout', type=float, default=5.0,
+                       help='Max seconds the whole fleet waits for in-flight acks on shutdown (default: 5.0)')
+    parser.add_argument('--ca-file', default=mqtt_transport.DEFAULT_CA_FILE,
+                       help='CA certificate for mqtts/wss brokers (default: certs/emqxsl-ca.crt)')
+    parser.add_argument('--insecure', action='store_true',
+                       help='Skip TLS certificate verification')
+    parser.add_argument('--latency-model', default=None,
+                       help='JSON latency/failure model file shared by all devices; replaces --success-rate')
+    parser.add_argument('--seed', type=int, default=None,
+                       help='Random seed for the latency model')
+    parser.add_argument('--share-group', '-g', default=None,
+                       help='Dynamic simulator only: consume commands via MQTT 5 shared subscription group')
+    parser.add_argument('--topic-aliases', action='store_true',
+                       help='Dynamic simulator only: use MQTT 5 topic aliases for QoS 0 publishes')
+    parser.add_argument('--payload-profile', choices=['verbose', 'compact'], default='verbose',
+                       help='Dynamic simulator only: status/ack payload format (default: verbose)')
+    parser.add_argument('--catalog-refresh', type=float, default=0,
+                       help='Dynamic simulator only: re-fetch action catalogs every N seconds; SIGHUP reloads on demand')
+    parser.add_argument('--telemetry-interval', type=float, default=0,
+                       help='Dynamic simulator only: publish simulated sensor readings every N seconds; 0 disables')
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                       help='Simulated seconds of greenhouse physics per real second (default: 1.0)')
+    parser.add_argument('--sensor-id-format', default='{device_id}-{sensor}',
+                       help='Sensor ID template for telemetry topics (default: {device_id}-{sensor})')
+    parser.add_argument('--report-by-exception', action='store_true',
+                       help='Only publish telemetry on deadband moves, threshold crossings or --max-silence')
+    parser.add_argument('--max-silence', type=float, default=900.0,
+                       help='With --report-by-exception, publish at least every N simulated seconds (default: 900)')
+    parser.add_argument('--aggregate-window', type=float, default=0.0,
+                       help='With --report-by-exception, aggregate samples over N simulated seconds (default: off)')
+    parser.add_argument('--aggregate-json', action='store_true',
+                       help='Send aggregated single-value readings as {"value","min","max","n"} JSON')
+    parser.add_argument('--scenario', default=None,
+                       help='YAML/TOML scenario file defining devices, phases and faults; replaces --devices')
+    parser.add_argument('--shard', default='0/1',
+                       help='Run only shard INDEX/COUNT of the devices or of the --scenario (default: 0/1)')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Split the fleet over N processes (default: 1)')
+    parser.add_argument('--spawn', choices=['zygote', 'cold'], default='zygote',
+                       help='With --workers: fork from a preloaded parent, or start each worker from scratch '
+                            '(default: zygote)')
+    parser.add_argument('--report-fd', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--launched-at', type=float, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--timeline-start', type=float, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--verbose', '-v', action='store_true',
+                       help='Enable verbose logging')
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    shard, shards = (int(part) for part in args.shard.split('/'))
+    if args.workers > 1:
+        if shards > 1:
+            parser.error("--workers splits the fleet itself; don't combine it with --shard")
+    local_backend = args.local_backend and args.simulator == 'dynamic'
+    if local_backend and args.report_fd is None:
+        # Cold workers are handed the parent's backend URL instead of starting their own
+        args.backend_url = start_local_backend(args)
+    if args.link_proxy and ',' in args.broker_url:
+        parser.error("--link-proxy needs a single --broker-url")
+    if args.link_proxy and args.report_fd is None:
+        # One link for the whole fleet; the scenario clock starts now, for the proxy and every worker alike
+        args.timeline_start = time.time()
+        args.broker_url = start_link_proxy(args)
+    if args.workers > 1 and args.spawn == 'cold':
+        extra_args = ['--backend-url', args.backend_url]
+        if args.link_proxy:
+            extra_args += ['--broker-url', args.broker_url, '--timeline-start', repr(args.timeline_start)]
+        sys.exit(spawn_cold_workers(args.workers, extra_args))
+
+    simulator_class = load_simulator_class(args.simulator)
+    simulator_kwargs = {
+        "broker_url": args.broker_url,
+        "username": args.username,
+        "password": args.password,
+        # Every device reuses the same TLS context instead of loading the CA again
+        "ssl_context": mqtt_transport.get_shared_ssl_context(args.ca_file, args.insecure)
+    }
+    if ',' in args.broker_url:
+        # One cluster for the whole fleet, so every device sees the same endpoint health
+        simulator_kwargs["cluster"] = mqtt_transport.BrokerCluster.from_urls(args.broker_url)
+    if args.latency_model:
+        from latency_model import LatencyModel
+        simulator_kwargs["latency_model"] = LatencyModel.from_file(args.latency_model, seed=args.seed)
+    if args.simulator == 'dynamic':
+        simulator_kwargs["backend_url"] = args.backend_url
+        simulator_kwargs["share_group"] = args.share_group
+        simulator_kwargs["topic_aliases"] = args.topic_aliases
+        simulator_kwargs["payload_profile"] = args.payload_profile
+
+    if args.scenario:
+        from scenario import Scenario, ScenarioRunner
+        scenario = Scenario.from_file(args.scenario)
+        logger.info(f"🎬 Scenario '{scenario.name}': {scenario.device_count} devices, "
+                    f"running shard {shard}/{shards}")
+        fleet = SimulatorFleet.from_scenario(scenario, simulator_class, shard, shards, catalogs=not local_backend,
+                                             **simulator_kwargs)
+        fleet.scenario_runner = ScenarioRunner(scenario, fleet, shard, shards, started=args.timeline_start)
+        telemetry_interval = args.telemetry_interval or scenario.phase_at(0).get("telemetryInterval", 0)
+        time_scale = scenario.time_scale
+        seed = scenario.seed if args.seed is None else args.seed
+    else:
+        device_ids = [f"{args.device_prefix}-{i}" for i in worker_range(args.devices, shard, shards)]
+        fleet = SimulatorFleet.create(simulator_class, device_ids, **simulator_kwargs)
+        telemetry_interval, time_scale, seed = args.telemetry_interval, args.time_scale, args.seed
+
+    report = None
+    if args.workers > 1:
+        started = time.time()
+        fleet.prepare()
+        logger.info(f"🧬 Zygote loaded {len(fleet.devices)} devices in {time.time() - started:.2f}s")
+        fleet, report = fork_workers(fleet, args.workers)
+    elif args.report_fd is not None:
+        report = (args.report_fd, args.launched_at or time.time(), shard)
+    if len(fleet.devices) > mqtt_transport.MAX_CLIENTS_PER_PROCESS:
+        logger.warning(f"⚠️ {len(fleet.devices)} devices in one process: paho's select() loop only handles "
+                       f"about {mqtt_transport.MAX_CLIENTS_PER_PROCESS} clients, the rest will not connect. "
+                       f"Split the fleet over several processes with --workers")
+    fleet.drain_timeout = max(0.0, args.drain_timeout)
+    fleet.broker_cluster = simulator_kwargs.get("cluster")
+    fleet.catalog_refresh_interval = max(0.0, args.catalog_refresh)
+    if args.rate_profile or args.global_rate:
+        from rate_limit import parse_rate_profile
+        fleet.enable_rate_limits(parse_rate_profile(args.rate_profile) if args.rate_profile else None,
+                                 parse_rate_profile(args.global_rate) if args.global_rate else None)
+
+    if args.loop_watchdog > 0:
+        fleet.enable_loop_watchdog(args.loop_watchdog / 1000.0)
+    # Workers and shards each write their own files
+    worker_index = report[2] if report is not None else shard if shards > 1 else None
+    if args.record_events:
+        fleet.enable_event_recorder(worker_path(args.record_events, worker_index))
+    if args.checkpoint:
+        fleet.enable_state_checkpoint(worker_path(args.checkpoint, worker_index), max(0.1, args.checkpoint_interval))
+
+    if telemetry_interval > 0 and args.simulator == 'dynamic':
+        edge = None
+        if args.report_by_exception:
+            edge = {"max_silence": args.max_silence, "window": args.aggregate_window,
+                    "aggregate_json": args.aggregate_json}
+        fleet.enable_telemetry(telemetry_interval, time_scale, seed, args.sensor_id_format, edge)
+
+    for device in fleet.devices:
+        device.success_rate = max(0.0, min(1.0, args.success_rate))
+        device.tasks.preempt = not args.no_preemption
+        device.tasks.coalesce_window = max(0.0, args.coalesce_window)
+
+    signal.signal(signal.SIGINT, fleet.signal_handler)
+    signal.signal(signal.SIGTERM, fleet.signal_handler)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, fleet.reload_signal_handler)
+
+    try:
+        fleet.start()
+        if report is not None:
+            threading.Thread(target=fleet.report_startup, args=report, daemon=True).start()
+        fleet.wait()
+    except KeyboardInterrupt:
+        logger.info("👋 Goodbye!")
+    except Exception as e:
+        logger.error(f"❌ Fatal error: {e}")
+        fleet.stop()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Smart Farm Sensor History Generator
+Streams historical sensor_readings rows as PostgreSQL COPY files for load testing.
+
+Usage:
+    python history_generator.py --days 90 --devices 200 --interval 60 -o history/
+    python history_generator.py --scenario scenario.example.yaml --days 180 --workers 8 -o history/
+    python history_generator.py ... --resume          # continue an interrupted run
+    cd history && psql "$DATABASE_URL" -f load.sql
+
+Readings come from the same closed-loop greenhouse model the simulators
+publish from (environment_model.py), with actuators switched by the sensors'
+thresholds, so the history has day/night cycles and control-loop sawtooths
+instead of noise. Each sensor ID gets one row per interval; the DHT11 writes
+temperature to value1 and humidity to value2 like the backend does.
+
+``sensor_readings.id`` is a varchar(36) primary key with no default in
+sfdb_postgres.sql (TypeORM fills it in the backend), so every row gets a
+deterministic UUID (version 8, RFC 9562): createdAt in microseconds, then
+the sensor's index and the seed. A rerun or --resume writes the same IDs,
+IDs from runs with different seeds don't collide, and they arrive in
+roughly ascending order, which keeps primary-key inserts at the right edge
+of the index.
+
+Output is split into fixed-size chunks written by worker processes, so memory
+stays constant whatever the row count. A chunk file only appears once it is
+complete; with --resume the model is replayed (cheap: no formatting) through
+the chunks already on disk and generation continues from the first missing one.
+"""
+
+import os
+import json
+import gzip
+import time
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+import numpy as np
+
+from environment_model import EnvironmentModel, DEFAULT_SENSORS, VALUE_FORMATS
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+COLUMNS = '"id", "sensor_id", "value1", "value2", "createdAt"'
+
+# Decimals kept per simulated quantity, from the printf formats of the published telemetry ("%.1f" -> 1)
+DECIMALS = {quantity: int(fmt.rstrip('f').partition('.')[2] or 0) for quantity, fmt in VALUE_FORMATS.items()}
+
+SEED_BITS = 31
+
+FORMATS = {
+    # extension, field separator, NULL marker, COPY options
+    "text": (".tsv", "\t", "\\N", ""),
+    "csv": (".csv", ",", "", " WITH (FORMAT csv)"),
+}
+
+
+class Layout:
+    """One environment model and the sensor IDs it writes rows for"""
+
+    def __init__(self, device_ids: List[str], sensors: List[Dict[str, Any]], sensor_id_format: str, seed: int):
+        self.model = EnvironmentModel(device_ids, sensors, seed=seed, start_time=0.0)
+
+        # Sensors sharing a sensorId become one row (value1, value2)
+        groups: Dict[str, List[Dict[str, Any]]] = {}
+        for sensor in self.model.sensors:
+            groups.setdefault(sensor["sensorId"], []).append(sensor)
+        self.groups = list(groups.items())
+
+        # Sensor ID strings, row order: group-major, then device
+        self.sensor_ids = [
+            sensor_id_format.format(sensor=sensor_id, device_id=device_id)
+            for sensor_id, _ in self.groups for device_id in device_ids
+        ]
+        self.devices = len(device_ids)
+        self.rows_per_step = self.devices * len(self.groups)
+
+        # Devices report at fixed offsets inside the interval instead of all at once
+        self.stagger = (np.arange(self.devices, dtype=np.int64) * 7919) % 1000
+
+    def step(self, dt: float, weather: Dict[str, Any]):
+        """Advance the model one interval"""
+        model = self.model
+        model.ambient_offset = float(weather.get("ambientOffset", 0.0))
+        model.outside_humidity = float(weather.get("outsideHumidity", 58.0))
+        model.control()
+        model.step(dt)
+
+    def rows(self):
+        """value1 and value2 arrays (NaN where absent) for the current step"""
+        value1, value2 = [], []
+        for _, sensors in self.groups:
+            first = sensors[0]["quantity"]
+            value1.append(np.round(self.model.values(first), DECIMALS[first]))
+            if len(sensors) > 1:
+                second = sensors[1]["quantity"]
+                value2.append(np.round(self.model.values(second), DECIMALS[second]))
+            else:
+                value2.append(np.full(self.devices, np.nan))
+        return np.concatenate(value1), np.concatenate(value2)
+
+
+# Per worker process: the sensor ID table and seed, sent once instead of with every chunk
+_sensor_ids = None
+_seed = 0
+
+
+def _init_worker(sensor_ids: List[str], seed: int = 0):
+    global _sensor_ids, _seed
+    _sensor_ids = np.array(sensor_ids)
+    _seed = seed
+
+
+def row_ids(seed: int, id_index: np.ndarray, created_us: np.ndarray) -> np.ndarray:
+    """Deterministic version 8 UUID strings for (createdAt, sensor, seed)"""
+    created = created_us.astype(np.uint64)
+    # 48 bits of createdAt >> 12, version 8, the low 12 bits of createdAt
+    high = ((created >> np.uint64(12)) << np.uint64(16)) | np.uint64(0x8000) | (created & np.uint64(0xFFF))
+    # variant 0b10, 30 bits of sensor index, 31 bits of seed
+    low = (np.uint64(0x8000000000000000) | (id_index.astype(np.uint64) << np.uint64(SEED_BITS))
+           | np.uint64(seed & (2 ** SEED_BITS - 1)))
+    raw = np.empty((len(created), 2), dtype='>u8')
+    raw[:, 0], raw[:, 1] = high, low
+    digits = np.frombuffer(raw.tobytes().hex().encode('ascii'), dtype='S1').reshape(-1, 32)
+    text = np.full((len(created), 36), b'-', dtype='S1')
+    text[:, 0:8], text[:, 9:13], text[:, 14:18] = digits[:, 0:8], digits[:, 8:12], digits[:, 12:16]
+    text[:, 19:23], text[:, 24:36] = digits[:, 16:20], digits[:, 20:32]
+    return text.view('S36').ravel().astype(str)
+
+
+def write_chunk(path: str, fmt: str, compress: bool, id_index: np.ndarray, value1: np.ndarray,
+                value2: np.ndarray, created_us: np.ndarray) -> int:
+    """Format one chunk and write it atomically; returns bytes written"""
+    _, separator, null, _ = FORMATS[fmt]
+    v1 = value1.astype(str)
+    v2 = np.where(np.isnan(value2), null, value2.astype(str))
+    created = np.datetime_as_string(created_us.astype('datetime64[us]'), unit='us')
+
+    ids = row_ids(_seed, id_index, created_us)
+
+    lines = map(separator.join, zip(ids.tolist(), _sensor_ids[id_index].tolist(), v1.tolist(), v2.tolist(),
+                                    created.tolist()))
+    data = ("\n".join(lines) + "\n").encode('utf-8')
+
+    tmp = path + ".part"
+    with (gzip.open(tmp, 'wb', compresslevel=1) if compress else open(tmp, 'wb')) as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return len(data)
+
+
+class HistoryGenerator:
+    """Steps the layouts through time and hands fixed-size chunks to writers"""
+
+    def __init__(self, layouts: List[Layout], start: datetime, interval: float, steps: int,
+                 chunk_rows: int, output_dir: str, fmt: str = "text", compress: bool = False,
+                 scenario=None, seed: int = 0):
+        self.layouts = layouts
+        self.seed = seed  # part of every row ID
+        self.start = start
+        self.interval = interval
+        self.steps = steps
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.compress = compress
+        self.scenario = scenario
+
+        self.rows_per_step = sum(layout.rows_per_step for layout in layouts)
+        self.steps_per_chunk = max(1, chunk_rows // self.rows_per_step)
+        self.chunks = -(-steps // self.steps_per_chunk)
+        self.total_rows = steps * self.rows_per_step
+
+        # Global sensor ID table and each layout's offset into it
+        self.sensor_ids = []
+        self.offsets = []
+        for layout in layouts:
+            self.offsets.append(len(self.sensor_ids))
+            self.sensor_ids.extend(layout.sensor_ids)
+
+        # Naive start times are UTC, like the createdAt column
+        start_epoch = start.replace(tzinfo=timezone.utc).timestamp()
+        self._start_us = int(start_epoch * 1e6)
+        for layout in layouts:
+            layout.model.sim_time = start_epoch
+
+    def chunk_path(self, chunk: int) -> str:
+        extension = FORMATS[self.fmt][0] + (".gz" if self.compress else "")
+        return os.path.join(self.output_dir, f"sensor_readings_{chunk:06d}{extension}")
+
+    def weather(self, step: int) -> Dict[str, Any]:
+        """Scenario phase settings in effect at a step"""
+        if self.scenario is None:
+            return {}
+        return self.scenario.phase_at(step * self.interval)
+
+    def build_chunk(self, chunk: int, emit: bool):
+        """Step through one chunk; return its arrays when ``emit`` is set"""
+        first = chunk * self.steps_per_chunk
+        last = min(first + self.steps_per_chunk, self.steps)
+        parts = []
+        for step in range(first, last):
+            weather = self.weather(step)
+            step_us = self._start_us + int((step + 1) * self.interval * 1e6)
+            for layout, offset in zip(self.layouts, self.offsets):
+                layout.step(self.interval, weather)
+                if emit:
+                    value1, value2 = layout.rows()
+                    ids = np.arange(offset, offset + layout.rows_per_step, dtype=np.int32)
+                    created = step_us + np.tile(layout.stagger * int(self.interval * 1000), len(layout.groups))
+                    parts.append((ids, value1, value2, created))
+        if not emit:
+            return None
+        return tuple(np.concatenate([part[i] for part in parts]) for i in range(4))
+
+    def write_manifest(self, params: Dict[str, Any]):
+        with open(os.path.join(self.output_dir, "manifest.json"), 'w') as f:
+            json.dump(params, f, indent=2)
+
+    def write_load_script(self):
+        """psql script loading every chunk with \\copy"""
+        options = FORMATS[self.fmt][3]
+        with open(os.path.join(self.output_dir, "load.sql"), 'w') as f:
+            f.write(f"-- {self.total_rows} sensor_readings rows in {self.chunks} chunks\n")
+            for chunk in range(self.chunks):
+                name = os.path.basename(self.chunk_path(chunk))
+                source = f"PROGRAM 'gzip -dc {name}'" if self.compress else f"'{name}'"
+                f.write(f"\\copy sensor_readings ({COLUMNS}) FROM {source}{options}\n")
+
+    def run(self, workers: int = 1, resume: bool = False) -> Dict[str, Any]:
+        """Generate every missing chunk and return throughput figures"""
+        done = {chunk for chunk in range(self.chunks) if resume and os.path.exists(self.chunk_path(chunk))}
+        if done:
+            logger.info(f"⏩ Resuming: {len(done)}/{self.chunks} chunks already written")
+
+        started = time.perf_counter()
+        rows_written = bytes_written = 0
+        pending = []
+        max_pending = workers * 2  # Bounds memory: chunks being formatted plus one queued each
+
+        def collect():
+            nonlocal rows_written, bytes_written
+            number, rows, future = pending.pop(0)
+            bytes_written += future.result()
+            rows_written += rows
+            elapsed = time.perf_counter() - started
+            logger.info(f"💾 Chunk {number + 1}/{self.chunks}: {rows} rows "
+                        f"({rows_written / elapsed:,.0f} rows/s overall)")
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(self.sensor_ids, self.seed)) as pool:
+            for chunk in range(self.chunks):
+                arrays = self.build_chunk(chunk, emit=chunk not in done)
+                if arrays is None:
+                    continue
+                pending.append((chunk, len(arrays[0]),
+                                pool.submit(write_chunk, self.chunk_path(chunk), self.fmt, self.compress, *arrays)))
+                if len(pending) >= max_pending:
+                    collect()
+            while pending:
+                collect()
+
+        elapsed = time.perf_counter() - started
+        return {
+            "rows": rows_written,
+            "bytes": bytes_written,
+            "chunks": self.chunks - len(done),
+            "seconds": round(elapsed, 2),
+            "rowsPerSec": round(rows_written / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+
+def build_layouts(args, seed: int):
+    """Layouts from a scenario file or from --devices"""
+    if args.scenario:
+        from scenario import Scenario
+        scenario = Scenario.from_file(args.scenario)
+        groups: Dict[str, Any] = {}
+        for spec in scenario.iter_devices():
+            groups.setdefault(spec.group, (spec.sensors, spec.sensor_id_format, []))[2].append(spec.device_id)
+        layouts = [Layout(device_ids, sensors, id_format, seed + number)
+                   for number, (sensors, id_format, device_ids) in enumerate(groups.values())]
+        return layouts, scenario
+
+    sensor_id_format = args.sensor_id_format or ("{sensor}" if args.devices == 1 else "{device_id}-{sensor}")
+    device_ids = [args.device_id] if args.devices == 1 else [f"{args.device_prefix}-{i}" for i in range(args.devices)]
+    return [Layout(device_ids, DEFAULT_SENSORS, sensor_id_format, seed)], None
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Generate historical sensor_readings as PostgreSQL COPY files')
+    parser.add_argument('--output-dir', '-o', default='history',
+                       help='Directory for chunk files, manifest and load.sql (default: history)')
+    parser.add_argument('--days', type=float, default=30.0,
+                       help='Days of history to generate (default: 30)')
+    parser.add_argument('--start', default=None,
+                       help='Start date, ISO format (default: --days before now)')
+    parser.add_argument('--interval', type=float, default=60.0,
+                       help='Seconds between readings of each sensor (default: 60)')
+    parser.add_argument('--devices', '-c', type=int, default=1,
+                       help='Number of simulated devices (default: 1, the seeded dht11/YL-69/BH1750 node)')
+    parser.add_argument('--device-id', default='dht11h',
+                       help='Device ID when --devices is 1 (default: dht11h)')
+    parser.add_argument('--device-prefix', '-d', default='sim',
+                       help='Device ID prefix for multiple devices (default: sim)')
+    parser.add_argument('--sensor-id-format', default=None,
+                       help='Sensor ID template (default: {sensor} for one device, {device_id}-{sensor} for more)')
+    parser.add_argument('--scenario', default=None,
+                       help='Take devices, sensors and weather phases from a scenario file instead')
+    parser.add_argument('--chunk-rows', type=int, default=1000000,
+                       help='Approximate rows per chunk file (default: 1000000)')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='text',
+                       help='COPY text (tab-separated) or CSV (default: text)')
+    parser.add_argument('--gzip', action='store_true',
+                       help='Compress chunk files (loaded with \\copy ... FROM PROGRAM)')
+    parser.add_argument('--workers', '-w', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                       help='Processes formatting chunks (default: CPU count - 1)')
+    parser.add_argument('--seed', type=int, default=None,
+                       help='Random seed (default: random, recorded in the manifest for --resume)')
+    parser.add_argument('--resume', action='store_true',
+                       help='Continue a previous run in --output-dir with the same settings')
+
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = os.path.join(args.output_dir, "manifest.json")
+
+    # Everything that determines the generated rows, so a resume reproduces them
+    params = {
+        "days": args.days,
+        "start": args.start,
+        "interval": args.interval,
+        "devices": args.devices,
+        "deviceId": args.device_id,
+        "devicePrefix": args.device_prefix,
+        "sensorIdFormat": args.sensor_id_format,
+        "scenario": os.path.abspath(args.scenario) if args.scenario else None,
+        "chunkRows": args.chunk_rows,
+        "format": args.format,
+        "gzip": args.gzip,
+        "seed": args.seed,
+    }
+
+    if args.resume and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        for key, value in params.items():
+            if key in ("seed", "start") and value is None:
+                params[key] = previous[key]
+            elif previous.get(key) != value:
+                parser.error(f"--resume: {key} differs from the previous run ({previous.get(key)!r} vs {value!r})")
+
+    if params["seed"] is None:
+        params["seed"] = int(np.random.SeedSequence().entropy % 2 ** 31)
+    if params["start"] is None:
+        params["start"] = (datetime.now(timezone.utc) - timedelta(days=args.days)).replace(tzinfo=None).isoformat()
+
+    layouts, scenario = build_layouts(args, params["seed"])
+    generator = HistoryGenerator(
+        layouts,
+        start=datetime.fromisoformat(params["start"]),
+        interval=args.interval,
+        steps=int(args.days * 86400 / args.interval),
+        chunk_rows=args.chunk_rows,
+        output_dir=args.output_dir,
+        fmt=args.format,
+        compress=args.gzip,
+        scenario=scenario,
+        seed=params["seed"]
+    )
+    generator.write_manifest(params)
+    generator.write_load_script()
+
+    logger.info(f"📈 Generating {generator.total_rows:,} rows for {len(generator.sensor_ids)} sensors "
+                f"in {generator.chunks} chunks from {params['start']} (seed {params['seed']})")
+    result = generator.run(workers=max(1, args.workers), resume=args.resume)
+    logger.info(f"✅ Wrote {result['rows']:,} rows ({result['bytes'] / 1e6:.1f} MB) in {result['seconds']}s "
+                f"= {result['rowsPerSec']:,.0f} rows/s")
+    logger.info(f"📥 Load with: cd {args.output_dir} && psql \"$DATABASE_URL\" -f load.sql")
+
+
+if __name__ == "__main__":
+    main()
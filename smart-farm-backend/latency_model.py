@@ -0,0 +1,204 @@
+"""
+Latency and failure distribution engine for the device simulators.
+
+Replaces the flat ``random.uniform`` delay and single success rate with
+per-action distributions that have realistic tails, correlated failure
+bursts and consistently slow devices. Draws are pre-sampled from NumPy in
+batches, so taking a sample while handling a message is a list pop.
+
+Model file (JSON):
+
+    {
+      "default": {
+        "latency": {"distribution": "lognormal", "median": 0.8, "sigma": 0.6, "max": 30},
+        "failureRate": 0.1
+      },
+      "actions": {
+        "open_roof": {"latency": {"distribution": "pareto", "scale": 1.5, "alpha": 2.2}},
+        "calibrate": {"failureRate": 0.2,
+                      "errors": [{"errorCode": "CALIBRATION_ERROR", "error": "Sensor drift detected"}]}
+      },
+      "errors": [
+        {"errorCode": "HARDWARE_ERROR", "error": "Hardware component not responding", "weight": 3},
+        {"errorCode": "TIMEOUT", "error": "Communication timeout with actuator", "weight": 1}
+      ],
+      "bursts": {"enterProbability": 0.01, "exitProbability": 0.2, "failureRate": 0.7},
+      "slowDevices": {"fraction": 0.02, "factor": 6.0}
+    }
+
+Latency distributions (seconds, optionally capped with "max"):
+    lognormal  median, sigma
+    pareto     scale (minimum), alpha (tail index)
+    uniform    low, high
+    constant   value
+
+Bursts are a two-state (Gilbert-Elliott) chain per device: each command may
+enter or leave the burst state, and while in it the burst failure rate
+replaces the action's own. Slow devices are picked by hashing the device ID,
+so the same devices are slow in every run with the same seed.
+"""
+
+import json
+import threading
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_ERRORS = [
+    {"errorCode": "HARDWARE_ERROR", "error": "Hardware component not responding"},
+    {"errorCode": "HARDWARE_ERROR", "error": "GPIO pin malfunction"},
+    {"errorCode": "HARDWARE_ERROR", "error": "Power supply insufficient"},
+    {"errorCode": "HARDWARE_ERROR", "error": "Sensor calibration required"},
+    {"errorCode": "HARDWARE_ERROR", "error": "Communication timeout with actuator"},
+]
+
+
+class SampleBuffer:
+    """Pre-sampled values refilled in batches
+
+    ``list.pop`` is atomic, so executor threads can share a buffer without a
+    lock; a concurrent refill only means one batch is discarded.
+    """
+
+    def __init__(self, draw: Callable[[int], np.ndarray], batch_size: int):
+        self._draw = draw
+        self._batch_size = batch_size
+        self._values: List[Any] = []
+
+    def next(self) -> Any:
+        while True:
+            try:
+                return self._values.pop()
+            except IndexError:
+                self._values = self._draw(self._batch_size).tolist()
+
+
+def build_latency_draw(rng: np.random.Generator, spec: Dict[str, Any]) -> Callable[[int], np.ndarray]:
+    """Turn a latency spec into a batch draw function"""
+    distribution = spec.get("distribution", "lognormal")
+    cap = spec.get("max")
+
+    if distribution == "lognormal":
+        mu, sigma = np.log(spec.get("median", 1.0)), spec.get("sigma", 0.5)
+        draw = lambda n: rng.lognormal(mu, sigma, n)
+    elif distribution == "pareto":
+        scale, alpha = spec.get("scale", 0.5), spec.get("alpha", 2.5)
+        # numpy's pareto is Lomax (shifted); +1 gives the classic Pareto with minimum `scale`
+        draw = lambda n: (rng.pareto(alpha, n) + 1.0) * scale
+    elif distribution == "uniform":
+        low, high = spec.get("low", 0.5), spec.get("high", 3.0)
+        draw = lambda n: rng.uniform(low, high, n)
+    elif distribution == "constant":
+        value = spec.get("value", 1.0)
+        draw = lambda n: np.full(n, value)
+    else:
+        raise ValueError(f"Unknown latency distribution: {distribution}")
+
+    if cap is not None:
+        return lambda n: np.minimum(draw(n), cap)
+    return draw
+
+
+class ActionProfile:
+    """Latency, failure rate and error catalog for one action"""
+
+    def __init__(self, rng: np.random.Generator, spec: Dict[str, Any], errors: List[Dict[str, Any]], batch_size: int):
+        self.failure_rate = spec.get("failureRate", 0.15)
+        self.latency = SampleBuffer(build_latency_draw(rng, spec.get("latency", {})), batch_size)
+
+        self.errors = [{"errorCode": e["errorCode"], "error": e["error"]} for e in errors]
+        weights = np.array([e.get("weight", 1.0) for e in errors], dtype=float)
+        probabilities = weights / weights.sum()
+        self.error_index = SampleBuffer(lambda n: rng.choice(len(errors), n, p=probabilities), batch_size)
+
+
+class DeviceLatencySampler:
+    """Per-device view of the model: burst state and slow-device factor"""
+
+    def __init__(self, model: 'LatencyModel', device_id: str, slow_factor: float):
+        self.model = model
+        self.device_id = device_id
+        self.slow_factor = slow_factor
+        self.in_burst = False
+
+    def draw(self, action: str) -> Tuple[float, Optional[Dict[str, str]]]:
+        """Return the execution delay and, for a failure, its error and errorCode"""
+        model = self.model
+        profile = model.profile(action)
+        delay = profile.latency.next() * self.slow_factor
+
+        failure_rate = profile.failure_rate
+        if model.bursts:
+            roll = model.uniform.next()
+            if self.in_burst:
+                self.in_burst = roll >= model.burst_exit
+            else:
+                self.in_burst = roll < model.burst_enter
+            if self.in_burst:
+                failure_rate = model.burst_failure_rate
+
+        if model.uniform.next() < failure_rate:
+            return delay, profile.errors[profile.error_index.next()]
+        return delay, None
+
+
+class LatencyModel:
+    """Shared latency/failure engine; one per process, one sampler per device"""
+
+    def __init__(self, config: Dict[str, Any] = None, seed: int = None, batch_size: int = 4096):
+        self.config = config or {}
+        self.seed = seed
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.uniform = SampleBuffer(self.rng.random, batch_size)
+
+        self.default_errors = self.config.get("errors") or DEFAULT_ERRORS
+        self.default_spec = self.config.get("default", {})
+        self.action_specs = self.config.get("actions", {})
+        self._profiles: Dict[str, ActionProfile] = {}
+        self._samplers: Dict[str, DeviceLatencySampler] = {}
+        self._lock = threading.Lock()
+
+        bursts = self.config.get("bursts")
+        self.bursts = bool(bursts)
+        self.burst_enter = (bursts or {}).get("enterProbability", 0.0)
+        self.burst_exit = (bursts or {}).get("exitProbability", 1.0)
+        self.burst_failure_rate = (bursts or {}).get("failureRate", 0.0)
+
+        slow = self.config.get("slowDevices", {})
+        self.slow_fraction = slow.get("fraction", 0.0)
+        self.slow_factor = slow.get("factor", 1.0)
+
+    @classmethod
+    def from_file(cls, path: str, seed: int = None) -> 'LatencyModel':
+        """Load a model from a JSON file"""
+        with open(path) as f:
+            return cls(json.load(f), seed=seed)
+
+    def profile(self, action: str) -> ActionProfile:
+        """Get (building on first use) the profile for an action"""
+        profile = self._profiles.get(action)
+        if profile is not None:
+            return profile
+
+        with self._lock:
+            if action not in self._profiles:
+                spec = dict(self.default_spec)
+                spec.update(self.action_specs.get(action, {}))
+                errors = spec.get("errors") or self.default_errors
+                self._profiles[action] = ActionProfile(self.rng, spec, errors, self.batch_size)
+            return self._profiles[action]
+
+    def for_device(self, device_id: str) -> DeviceLatencySampler:
+        """Get the sampler for a device, deciding once whether it is a slow outlier"""
+        sampler = self._samplers.get(device_id)
+        if sampler is not None:
+            return sampler
+
+        with self._lock:
+            if device_id not in self._samplers:
+                bucket = zlib.crc32(f"{self.seed}:{device_id}".encode('utf-8')) / 2 ** 32
+                slow_factor = self.slow_factor if bucket < self.slow_fraction else 1.0
+                self._samplers[device_id] = DeviceLatencySampler(self, device_id, slow_factor)
+            return self._samplers[device_id]
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Fault-Injecting Link Proxy
+Sits between the simulators and a broker and makes the connection behave like a flaky rural link.
+
+Usage:
+    python link_proxy.py --port 1884 --upstream 127.0.0.1:1883 --profile 3g
+    python link_proxy.py --port 1884 --upstream 127.0.0.1:1883 --profile "lte,loss=2%" --scenario storm.yaml
+    python fleet_simulator.py --devices 300 -b mqtt://127.0.0.1:1883 --link-proxy 2g
+    python scaling_sweep.py --devices 100 --rates 20 --workers 1 --links direct lte 3g 2g
+
+The proxy forwards raw TCP, so MQTT, MQTT over WebSocket (``ws://``) and TLS
+all pass through unchanged. Each chunk read from one side is scheduled for
+delivery to the other side at
+
+    arrival + latency + jitter          (one way; the round trip pays it twice)
+    later than the previous chunk       (TCP is ordered: jitter never reorders)
+    after the link has sent the bytes   (--bandwidth is shared by all connections,
+                                         per direction, like a farm's uplink)
+    + a retransmission stall            (with probability 1-(1-loss)^segments;
+                                         everything behind it waits: head-of-line)
+
+Partitions come in two modes. ``blackhole`` holds all traffic and new
+connections until the partition ends. Clients then time out on keepalive,
+exactly as with a dead link. ``reset`` closes every connection at once and
+refuses new ones.
+
+Link settings (``--profile``, and scenario faults) are a profile name
+(perfect, fibre, wifi, lte, 3g, 2g, satellite), ``key=value`` pairs, or a
+name followed by overrides:
+
+    latency=150ms  jitter=60ms  bandwidth=16kB (/s; also kbit, MB, Mbit)
+    loss=1%  stall=300ms (retransmission timeout)
+
+With ``--scenario``, the file's ``link`` and ``partition`` faults are played on
+the scenario's timeline. Time 0 is ``--start-at`` (epoch seconds, default:
+now). The fleet passes its own start time, so these faults line up with its
+phases:
+
+    faults:
+      - {type: link, start: 1h, end: 2h, profile: 2g}
+      - {type: link, start: 3h, end: 4h, latency: 800ms, loss: 5%}
+      - {type: partition, start: 5h, end: 5h10m, mode: blackhole}
+
+On stop the proxy logs its connection, byte, stall and added-delay counts.
+"""
+
+import asyncio
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+import argparse
+import logging
+import signal
+from typing import Any, Dict, List, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SEGMENT_BYTES = 1460  # TCP payload per segment on Ethernet-sized links
+READ_BYTES = 16384
+QUEUE_CHUNKS = 256  # chunks in flight per direction before the proxy stops reading (backpressure)
+PARTITION_MODES = ("blackhole", "reset")
+
+# One-way latency and jitter in ms, bandwidth in bytes/s per direction (0 = unlimited), loss per segment
+LINK_PROFILES = {
+    "perfect": {},
+    "fibre": {"latency": 5, "jitter": 1},
+    "wifi": {"latency": 10, "jitter": 8, "loss": 0.001},
+    "lte": {"latency": 40, "jitter": 20, "bandwidth": 1000000, "loss": 0.002},
+    "3g": {"latency": 150, "jitter": 60, "bandwidth": 48000, "loss": 0.01},
+    "2g": {"latency": 400, "jitter": 150, "bandwidth": 4000, "loss": 0.03},
+    "satellite": {"latency": 300, "jitter": 30, "bandwidth": 250000, "loss": 0.005},
+}
+DEFAULT_LINK = {"latency": 0.0, "jitter": 0.0, "bandwidth": 0.0, "loss": 0.0, "stall": 300.0}
+
+BANDWIDTH_UNITS = {"b": 1, "kb": 1000, "mb": 1000000, "bit": 1 / 8, "kbit": 125, "mbit": 125000}
+
+
+def parse_ms(value: Any) -> float:
+    """``150``, ``"150ms"`` or ``"1.5s"`` as milliseconds"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*(ms|s)?\s*', str(value).lower())
+    if not match:
+        raise ValueError(f"Invalid duration: {value!r}")
+    return float(match.group(1)) * (1000.0 if match.group(2) == 's' else 1.0)
+
+
+def parse_bandwidth(value: Any) -> float:
+    """``48000``, ``"48kB"`` or ``"384kbit"`` (per second) as bytes per second"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmKM]?(?:[bB]|bit))?(?:/s)?\s*', str(value))
+    if not match:
+        raise ValueError(f"Invalid bandwidth: {value!r}")
+    unit = (match.group(2) or "b")
+    unit = unit.lower() if unit.endswith("bit") else unit[:-1].lower() + "b"
+    return float(match.group(1)) * BANDWIDTH_UNITS[unit]
+
+
+def parse_loss(value: Any) -> float:
+    """``0.02`` or ``"2%"`` as a fraction"""
+    text = str(value).strip()
+    loss = float(text[:-1]) / 100.0 if text.endswith('%') else float(text)
+    if not 0.0 <= loss < 1.0:
+        raise ValueError(f"Loss must be in [0, 1): {value!r}")
+    return loss
+
+
+LINK_PARSERS = {"latency": parse_ms, "jitter": parse_ms, "stall": parse_ms,
+                "bandwidth": parse_bandwidth, "loss": parse_loss}
+
+
+def link_overrides(settings: Dict[str, Any]) -> Dict[str, float]:
+    """Parse the link keys of a mapping (a scenario fault); ``profile`` names a base profile"""
+    overrides = {}
+    if settings.get("profile") is not None:
+        # A named profile replaces the whole link, not only the keys it sets
+        overrides.update(parse_link_profile(str(settings["profile"])))
+    for key, parse in LINK_PARSERS.items():
+        if settings.get(key) is not None:
+            overrides[key] = parse(settings[key])
+    return overrides
+
+
+def parse_link_profile(text: str, base: Dict[str, float] = None) -> Dict[str, float]:
+    """``3g``, ``latency=200ms,loss=2%`` or ``3g,loss=5%`` as link settings over ``base``"""
+    link = dict(DEFAULT_LINK if base is None else base)
+    for part in filter(None, (part.strip() for part in text.split(','))):
+        key, sep, value = part.partition('=')
+        if not sep:
+            if key not in LINK_PROFILES:
+                raise ValueError(f"Unknown link profile '{key}' (expected one of {', '.join(LINK_PROFILES)} "
+                                 f"or key=value pairs)")
+            link.update(LINK_PROFILES[key])
+        elif key.strip() in LINK_PARSERS:
+            link[key.strip()] = LINK_PARSERS[key.strip()](value)
+        else:
+            raise ValueError(f"Unknown link setting '{key}' (expected one of {', '.join(LINK_PARSERS)})")
+    return link
+
+
+def format_link(link: Dict[str, float], partition: Optional[str] = None) -> str:
+    if partition:
+        return f"partitioned ({partition})"
+    parts = [f"{link['latency']:g}±{link['jitter']:g} ms"]
+    if link["bandwidth"]:
+        parts.append(f"{link['bandwidth'] / 1000:g} kB/s")
+    if link["loss"]:
+        parts.append(f"{link['loss']:.1%} loss")
+    return ", ".join(parts)
+
+
+class LinkStats:
+    """Connection, byte, stall and delay counters"""
+
+    def __init__(self):
+        self.connections = 0
+        self.open_connections = 0
+        self.refused = 0
+        self.resets = 0
+        self.bytes = {"up": 0, "down": 0}
+        self.chunks = 0
+        self.stalls = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+        self.partitions = 0
+        self.partitioned_seconds = 0.0
+
+    def format_summary(self) -> str:
+        mean = self.delay_total / self.chunks * 1000 if self.chunks else 0.0
+        return (f"{self.connections} connections ({self.open_connections} open, {self.refused} refused, "
+                f"{self.resets} reset), {self.bytes['up'] / 1e6:.2f} MB up / {self.bytes['down'] / 1e6:.2f} MB down, "
+                f"{self.stalls} loss stalls, added delay mean {mean:.0f}ms max {self.delay_max * 1000:.0f}ms, "
+                f"{self.partitions} partitions ({self.partitioned_seconds:.0f}s)")
+
+
+class LinkProxy:
+    """The emulated link: current settings, shared bandwidth and the open connections"""
+
+    def __init__(self, upstream_host: str, upstream_port: int, link: Dict[str, float], seed: int = None):
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.link = link
+        self.partition = None  # None, "blackhole" or "reset"
+        self.random = random.Random(seed)
+        self.stats = LinkStats()
+        self._busy_until = {"up": 0.0, "down": 0.0}  # when the link finishes sending what it has accepted
+        self._open = asyncio.Event()
+        self._open.set()
+        self._partition_started = None
+        self._writers = set()
+
+    def set_link(self, link: Dict[str, float], partition: Optional[str] = None):
+        """Switch link settings; chunks already scheduled keep their delivery time"""
+        self.link = link
+        if partition == self.partition:
+            return
+        loop_time = time.monotonic()
+        if self.partition is not None and self._partition_started is not None:
+            self.stats.partitioned_seconds += loop_time - self._partition_started
+        self.partition = partition
+        if partition is None:
+            self._open.set()
+            return
+        self.stats.partitions += 1
+        self._partition_started = loop_time
+        self._open.clear()
+        if partition == "reset":
+            self.stats.resets += len(self._writers) // 2  # client and upstream side of each connection
+            for writer in list(self._writers):
+                writer.transport.abort()
+
+    def schedule(self, direction: str, size: int, arrival: float, previous: float) -> float:
+        """Delivery time of a chunk of ``size`` bytes read at ``arrival``"""
+        link = self.link
+        deliver = arrival + link["latency"] / 1000.0
+        if link["jitter"]:
+            deliver += self.random.expovariate(1000.0 / link["jitter"])
+        if link["bandwidth"]:
+            start = max(arrival, self._busy_until[direction])
+            self._busy_until[direction] = start + size / link["bandwidth"]
+            deliver = max(deliver, self._busy_until[direction] + link["latency"] / 1000.0)
+        if link["loss"]:
+            segments = math.ceil(size / SEGMENT_BYTES)
+            if self.random.random() < 1.0 - (1.0 - link["loss"]) ** segments:
+                deliver += link["stall"] / 1000.0
+                self.stats.stalls += 1
+        return max(deliver, previous)
+
+    async def handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        self.stats.connections += 1
+        if self.partition == "reset":
+            self.stats.refused += 1
+            client_writer.transport.abort()
+            return
+        # A blackholed link doesn't complete new connections either
+        await self._open.wait()
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(self.upstream_host, self.upstream_port)
+        except OSError as e:
+            logger.warning(f"⚠️ Upstream {self.upstream_host}:{self.upstream_port} unreachable: {e}")
+            self.stats.refused += 1
+            client_writer.transport.abort()
+            return
+        self.stats.open_connections += 1
+        self._writers.update((client_writer, upstream_writer))
+
+        def close():
+            # Either side closing or failing ends both directions, like a TCP connection through NAT
+            for writer in (client_writer, upstream_writer):
+                writer.transport.abort()
+
+        try:
+            await asyncio.gather(self.pipe("up", client_reader, upstream_writer, close),
+                                 self.pipe("down", upstream_reader, client_writer, close))
+        except asyncio.CancelledError:
+            pass  # proxy shutting down; asyncio.start_server would log the cancelled handler as an error
+        finally:
+            self.stats.open_connections -= 1
+            self._writers.discard(client_writer)
+            self._writers.discard(upstream_writer)
+            close()
+
+    async def pipe(self, direction: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, close):
+        """Copy one direction, delaying each chunk to its scheduled delivery time"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(QUEUE_CHUNKS)
+
+        async def deliver():
+            broken = False
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if broken:
+                    continue  # keep taking chunks so the reader never blocks on a full queue
+                due, arrival, data = item
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not self._open.is_set():
+                    await self._open.wait()
+                try:
+                    writer.write(data)
+                    await writer.drain()
+                except (ConnectionError, OSError):
+                    broken = True
+                    close()
+                    continue
+                added = loop.time() - arrival
+                self.stats.chunks += 1
+                self.stats.delay_total += added
+                self.stats.delay_max = max(self.stats.delay_max, added)
+
+        sender = asyncio.create_task(deliver())
+        previous = 0.0
+        try:
+            while True:
+                data = await reader.read(READ_BYTES)
+                if not data:
+                    break
+                arrival = loop.time()
+                self.stats.bytes[direction] += len(data)
+                previous = self.schedule(direction, len(data), arrival, previous)
+                await queue.put((previous, arrival, data))
+        except (ConnectionError, OSError):
+            pass
+        # What was read before the close still arrives, late, like the last segments of a TCP stream
+        await queue.put(None)
+        await sender
+        close()
+
+
+class LinkTimeline:
+    """Plays a scenario's ``link`` and ``partition`` faults on a proxy"""
+
+    def __init__(self, scenario, proxy: LinkProxy, base: Dict[str, float], started: float, tick: float = 0.5):
+        self.scenario = scenario
+        self.proxy = proxy
+        self.base = base
+        self.started = started
+        self.tick = tick
+        self.faults = [(fault, link_overrides(fault.settings)) for fault in scenario.faults
+                       if fault.type in ("link", "partition")]
+        for fault, _ in self.faults:
+            if fault.type == "partition" and fault.settings.get("mode", "blackhole") not in PARTITION_MODES:
+                raise ValueError(f"Fault '{fault.name}': partition mode must be one of {', '.join(PARTITION_MODES)}")
+        self._active = ()
+
+    def state_at(self, t: float) -> Tuple[Dict[str, float], Optional[str], Tuple[str, ...]]:
+        """(link settings, partition mode, active fault names) at simulated time ``t``"""
+        link = dict(self.base)
+        partition = None
+        active = []
+        for fault, overrides in self.faults:
+            if fault.active(t):
+                active.append(fault.name)
+                if fault.type == "partition":
+                    partition = fault.settings.get("mode", "blackhole")
+                else:
+                    link.update(overrides)
+        return link, partition, tuple(active)
+
+    async def run(self):
+        while True:
+            t = (time.time() - self.started) * self.scenario.time_scale
+            link, partition, active = self.state_at(t)
+            if active != self._active:
+                self._active = active
+                self.proxy.set_link(link, partition)
+                names = ", ".join(active) or "none"
+                logger.info(f"🌩️ Link at t={t / 3600:.2f}h: {format_link(link, partition)} (faults: {names})")
+            await asyncio.sleep(self.tick)
+
+
+async def serve(proxy: LinkProxy, host: str, port: int, timeline: LinkTimeline = None, stats_interval: float = 0):
+    server = await asyncio.start_server(proxy.handle, host, port, reuse_address=True, backlog=4096)
+    logger.info(f"🔌 Link proxy on {host}:{port} -> {proxy.upstream_host}:{proxy.upstream_port}: "
+                f"{format_link(proxy.link)}")
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    async def report_stats():
+        while True:
+            await asyncio.sleep(stats_interval)
+            logger.info(f"📊 {proxy.stats.format_summary()}")
+
+    tasks = []
+    if stats_interval > 0:
+        tasks.append(asyncio.create_task(report_stats()))
+    if timeline is not None:
+        tasks.append(asyncio.create_task(timeline.run()))
+    await stop.wait()
+    for task in tasks:
+        task.cancel()
+    server.close()
+    proxy.set_link(proxy.link, None)
+    logger.info(f"📊 {proxy.stats.format_summary()}")
+    logger.info("👋 Link proxy stopped")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_process(args: List[str] = (), timeout: float = 10.0, **popen_kwargs) -> Tuple[subprocess.Popen, int]:
+    """Start a link proxy on a free loopback port; returns the process and its port"""
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, 'link_proxy.py'), '--port', str(port), *args],
+                               **popen_kwargs)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"link proxy exited with {process.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"link proxy did not start within {timeout}s")
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='TCP proxy that injects latency, bandwidth limits, loss stalls '
+                                                 'and partitions between simulators and a broker')
+    parser.add_argument('--host', default='127.0.0.1',
+                       help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=1884,
+                       help='Port to listen on (default: 1884)')
+    parser.add_argument('--upstream', required=True, metavar='HOST:PORT',
+                       help='Broker to forward to')
+    parser.add_argument('--profile', default='perfect',
+                       help=f"Link settings: {', '.join(LINK_PROFILES)}, key=value pairs "
+                            f"(latency, jitter, bandwidth, loss, stall) or a profile with overrides (default: perfect)")
+    parser.add_argument('--scenario', default=None,
+                       help='Play the link and partition faults of this scenario file')
+    parser.add_argument('--start-at', type=float, default=None, metavar='EPOCH',
+                       help='With --scenario, wall-clock time of scenario time 0 (default: now)')
+    parser.add_argument('--seed', type=int, default=None,
+                       help='Random seed for jitter and loss')
+    parser.add_argument('--stats-interval', type=float, default=0,
+                       help='Log link counters every N seconds (default: off)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                       help='Enable debug logging')
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    try:
+        host, _, port = args.upstream.rpartition(':')
+        link = parse_link_profile(args.profile)
+        proxy = LinkProxy(host or '127.0.0.1', int(port), link, args.seed)
+        timeline = None
+        if args.scenario:
+            from scenario import Scenario
+            timeline = LinkTimeline(Scenario.from_file(args.scenario), proxy, link, args.start_at or time.time())
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ {e}")
+        sys.exit(2)
+    asyncio.run(serve(proxy, args.host, args.port, timeline, args.stats_interval))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+"""
+Local Backend Stand-in
+Serves device action catalogs like the NestJS backend's ``GET /devices/{id}/actions`` for offline fleet runs.
+
+Usage:
+    python local_backend.py --port 3000
+    python local_backend.py --scenario scenario.example.yaml --latency 40 --jitter 60 --error-rate 0.02
+    python fleet_simulator.py --devices 300 --local-backend --backend-latency 40
+
+Catalogs have the backend's JSON shape (``id``, ``name``, ``description``,
+``icon``, ``actionUri``, ``actionType``, ``category``, ``sensorType``,
+``triggerType``) and are built the way ``DeviceActionsService`` builds them:
+one action per ``action_low``/``action_high`` of each of the device's
+sensors. The sensors come from
+
+- the ``sensors`` seed rows of ``sfdb_postgres.sql`` (default). Devices that
+  are not in the seed data get the sensors of the first seeded device, with
+  their own ID in the action URIs, so any simulated fleet has a realistic
+  catalog. ``--strict`` answers ``[]`` for them instead, like the real
+  backend.
+- or a scenario file (``--scenario``): a device ID is matched to its group by
+  the group's ``deviceId`` format. Groups with an ``actions`` list serve it
+  as-is, other groups derive actions from their sensors.
+
+Responses carry an ETag and ``If-None-Match`` gets a 304, so conditional
+catalog reloads behave as against the real backend. ``--latency`` delays
+every response, ``--jitter`` adds an exponentially distributed extra delay
+with that mean (a long tail) and ``--error-rate`` answers a fraction of
+requests with ``--error-status``. SIGHUP re-reads the seed data or scenario.
+
+The server is a single asyncio loop with HTTP/1.1 keep-alive and
+pre-serialized bodies, so thousands of devices bootstrapping at once queue
+on the configured latency rather than on the server.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import string
+import subprocess
+import sys
+import time
+import argparse
+import logging
+import signal
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SEED_SQL = os.path.join(HERE, '..', 'sfdb_postgres.sql')
+CATALOG_PATH = re.compile(r"^(?:/[^?]*)?/devices/([^/?]+)/actions/?(?:\?.*)?$")
+CACHE_SIZE = 20000  # Serialized catalogs kept; a fleet bigger than this re-serializes on reload
+MAX_REQUEST_BYTES = 65536
+
+STATUS_TEXT = {200: "OK", 304: "Not Modified", 404: "Not Found", 405: "Method Not Allowed",
+               500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable",
+               504: "Gateway Timeout"}
+
+
+def parse_sql_values(text: str) -> List[List[Any]]:
+    """Rows of a ``VALUES (...), (...)`` list: quoted strings, NULL and numbers"""
+    rows, row, index = [], None, 0
+    while index < len(text):
+        char = text[index]
+        if char == '(':
+            row = []
+            index += 1
+        elif char == ')':
+            rows.append(row)
+            row = None
+            index += 1
+        elif char == "'":
+            end = index + 1
+            value = []
+            while True:
+                quote = text.index("'", end)
+                value.append(text[end:quote])
+                if text.startswith("''", quote):
+                    value.append("'")
+                    end = quote + 2
+                else:
+                    break
+            row.append("".join(value))
+            index = quote + 1
+        elif row is not None and (char.isalnum() or char in '-.'):
+            match = re.match(r"[^,)\s]+", text[index:])
+            token = match.group(0)
+            if token.upper() == 'NULL':
+                row.append(None)
+            else:
+                number = float(token)
+                row.append(int(number) if number.is_integer() and '.' not in token else number)
+            index += len(token)
+        else:
+            index += 1
+    return rows
+
+
+def load_seed_sensors(path: str) -> List[Dict[str, Any]]:
+    """Sensor rows from the ``INSERT INTO "sensors"`` statement of a SQL seed file"""
+    with open(path, encoding='utf-8') as f:
+        sql = f.read()
+    match = re.search(r'INSERT INTO "sensors"\s*\(([^)]*)\)\s*VALUES\s*(.*?)\s*(?:ON CONFLICT[^;]*)?;', sql, re.S)
+    if not match:
+        raise ValueError(f"{path} has no INSERT INTO \"sensors\" statement")
+    columns = [column.strip().strip('"') for column in match.group(1).split(',')]
+    return [dict(zip(columns, values)) for values in parse_sql_values(match.group(2))]
+
+
+def _title(action_name: str) -> str:
+    return " ".join(word[:1].upper() + word[1:] for word in action_name.split('_'))
+
+
+def action_icon(name: str) -> str:
+    name = name.lower()
+    if 'ventilator' in name or 'fan' in name:
+        return 'air'
+    if 'water' in name or 'pump' in name or 'irrigation' in name:
+        return 'water_drop'
+    if 'humidifier' in name:
+        return 'humidity_percentage'
+    if 'roof' in name:
+        return 'open_in_full' if 'open' in name else 'close_fullscreen'
+    if 'light' in name:
+        return 'lightbulb' if 'on' in name else 'lightbulb_outline'
+    if 'heater' in name or 'heat' in name:
+        return 'local_fire_department'
+    return 'smart_toy'
+
+
+def action_type(name: str) -> str:
+    name = name.lower()
+    if any(word in name for word in ('pump', 'irrigation', 'heater', 'roof')):
+        return 'critical'
+    if any(word in name for word in ('ventilator', 'fan', 'humidifier')):
+        return 'important'
+    return 'normal'
+
+
+def action_category(name: str) -> str:
+    name = name.lower()
+    if 'water' in name or 'pump' in name or 'irrigation' in name:
+        return 'irrigation'
+    if 'ventilator' in name or 'fan' in name:
+        return 'ventilation'
+    if 'humidifier' in name:
+        return 'humidity'
+    if 'roof' in name:
+        return 'structure'
+    if 'light' in name:
+        return 'lighting'
+    if 'heater' in name or 'heat' in name:
+        return 'heating'
+    return 'system'
+
+
+def device_actions(device_id: str, sensors: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """The catalog DeviceActionsService.getDeviceActions returns for a device's sensor rows
+
+    ``action_low``/``action_high`` may be full ``mqtt:`` URIs (seed data) or bare
+    action names (scenario sensors); either way the URI is addressed to ``device_id``.
+    """
+    actions = []
+    for sensor in sensors:
+        for trigger in ('low', 'high'):
+            uri = sensor.get(f"action_{trigger}")
+            if not uri:
+                continue
+            name = uri.split('/')[-1]
+            uri = f"mqtt:smartfarm/actuators/{device_id}/{name}"
+            sensor_type = sensor["type"]
+            actions.append({
+                "id": f"{sensor['sensor_id']}_{sensor_type}_{trigger}_{name}",
+                "name": f"{_title(name)} ({sensor_type} {trigger.capitalize()})",
+                "description": f"Execute {name.replace('_', ' ')} when {sensor_type} is {trigger}",
+                "icon": action_icon(name),
+                "actionUri": uri,
+                "actionType": action_type(name),
+                "category": action_category(name),
+                "sensorType": sensor_type,
+                "triggerType": trigger,
+            })
+    return actions
+
+
+def device_id_pattern(id_format: str, group: str) -> 're.Pattern':
+    """Regex matching the device IDs a scenario group's ``deviceId`` format produces"""
+    parts = []
+    for literal, field, _, _ in string.Formatter().parse(id_format):
+        parts.append(re.escape(literal))
+        if field == 'group':
+            parts.append(re.escape(group))
+        elif field is not None:
+            parts.append(r"\d+")
+    return re.compile("".join(parts) + "$")
+
+
+class CatalogSource:
+    """Builds each device's catalog from seed sensor rows or a scenario"""
+
+    def __init__(self, seed_sql: str = DEFAULT_SEED_SQL, scenario: str = None, strict: bool = False):
+        self.seed_sql = seed_sql
+        self.scenario_path = scenario
+        self.strict = strict
+        self.reload()
+
+    def reload(self):
+        if self.scenario_path:
+            from scenario import Scenario, build_action
+            scenario = Scenario.from_file(self.scenario_path)
+            self._build_action = build_action
+            self.groups = []
+            for group in scenario.groups:
+                # Scenario sensors use camelCase keys; catalogs want sensors-table columns
+                sensors = [{"sensor_id": sensor["sensorId"], "type": sensor["type"],
+                            "action_low": sensor.get("actionLow"), "action_high": sensor.get("actionHigh")}
+                           for sensor in group["sensors"]]
+                self.groups.append((device_id_pattern(group["deviceId"], group["name"]), group["actions"], sensors))
+            self.description = f"scenario {scenario.name} ({len(self.groups)} groups)"
+        else:
+            rows = load_seed_sensors(self.seed_sql)
+            self.sensors: Dict[str, List[Dict[str, Any]]] = {}
+            for row in rows:
+                self.sensors.setdefault(row["device_id"], []).append(row)
+            self.template = next(iter(self.sensors.values()), [])
+            self.description = (f"{os.path.basename(self.seed_sql)} ({len(rows)} sensors on "
+                                f"{len(self.sensors)} devices)")
+
+    def catalog(self, device_id: str) -> List[Dict[str, Any]]:
+        if self.scenario_path:
+            for pattern, actions, sensors in self.groups:
+                if pattern.match(device_id):
+                    if actions:
+                        return [self._build_action(entry, device_id) for entry in actions]
+                    return device_actions(device_id, sensors)
+            return []
+        sensors = self.sensors.get(device_id)
+        if sensors is None:
+            sensors = [] if self.strict else self.template
+        return device_actions(device_id, sensors)
+
+
+class BackendStats:
+    """Request, response and connection counters"""
+
+    def __init__(self):
+        self.requests = 0
+        self.responses = {}
+        self.injected_errors = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.open_connections = 0
+        self.peak_connections = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.cache_misses = 0
+
+    def format_summary(self) -> str:
+        statuses = ", ".join(f"{count} {status}" for status, count in sorted(self.responses.items()))
+        return (f"{self.requests} requests ({statuses or 'none'}), {self.injected_errors} injected errors, "
+                f"{self.bytes_out / 1e6:.1f} MB out, {self.cache_misses} catalogs built, "
+                f"{self.open_connections} open / {self.peak_connections} peak connections, "
+                f"{self.peak_in_flight} peak in flight")
+
+
+class LocalBackend:
+    """Catalog cache, latency and error injection shared by all connections"""
+
+    def __init__(self, source: CatalogSource, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 503, seed: int = None):
+        self.source = source
+        self.latency = latency      # seconds added to every response
+        self.jitter = jitter        # mean of an exponential extra delay, seconds
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.stats = BackendStats()
+        self._cache: 'OrderedDict[str, Tuple[bytes, str]]' = OrderedDict()
+
+    def catalog_body(self, device_id: str) -> Tuple[bytes, str]:
+        """Serialized catalog and its ETag, built once per device"""
+        cached = self._cache.get(device_id)
+        if cached is not None:
+            self._cache.move_to_end(device_id)
+            return cached
+        body = json.dumps(self.source.catalog(device_id)).encode('utf-8')
+        # Express-style weak ETag: length and a content hash
+        etag = f'W/"{len(body):x}-{hashlib.sha1(body).hexdigest()[:27]}"'
+        self._cache[device_id] = (body, etag)
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+        self.stats.cache_misses += 1
+        return body, etag
+
+    def reload(self):
+        """Re-read the catalog source; changed catalogs get new ETags"""
+        try:
+            self.source.reload()
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Catalog reload failed, keeping the old catalogs: {e}")
+            return
+        self._cache.clear()
+        logger.info(f"🔁 Reloaded catalogs from {self.source.description}")
+
+    def delay(self) -> float:
+        extra = self.random.expovariate(1.0 / self.jitter) if self.jitter > 0 else 0.0
+        return self.latency + extra
+
+    def respond(self, method: str, path: str, headers: Dict[str, str]) -> Tuple[int, Dict[str, str], bytes]:
+        """Status, headers and body for one request"""
+        if method not in ('GET', 'HEAD'):
+            return 405, {}, b'{"statusCode":405,"message":"Method Not Allowed"}'
+        if path in ('/health', '/api/health'):
+            return 200, {}, b'{"status":"ok"}'
+        match = CATALOG_PATH.match(path)
+        if not match:
+            return 404, {}, json.dumps({"statusCode": 404, "message": f"Cannot GET {path}"}).encode('utf-8')
+        if self.error_rate > 0 and self.random.random() < self.error_rate:
+            self.stats.injected_errors += 1
+            status = self.error_status
+            return status, {}, json.dumps({"statusCode": status, "message": STATUS_TEXT.get(status, "Error")}).encode()
+        body, etag = self.catalog_body(match.group(1))
+        if headers.get('if-none-match') == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"ETag": etag}, body
+
+
+class HTTPConnection(asyncio.Protocol):
+    """One keep-alive client connection; requests are answered in order"""
+
+    def __init__(self, backend: LocalBackend):
+        self.backend = backend
+        self.transport: Optional[asyncio.Transport] = None
+        self.buffer = bytearray()
+        self.busy = False  # a response is waiting out its delay
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        stats = self.backend.stats
+        stats.connections += 1
+        stats.open_connections += 1
+        stats.peak_connections = max(stats.peak_connections, stats.open_connections)
+
+    def data_received(self, data: bytes):
+        self.buffer += data
+        if len(self.buffer) > MAX_REQUEST_BYTES:
+            self.close()
+            return
+        self.process()
+
+    def process(self):
+        while not self.busy and not self.closed:
+            end = self.buffer.find(b"\r\n\r\n")
+            if end < 0:
+                return
+            head = bytes(self.buffer[:end]).decode('latin-1')
+            del self.buffer[:end + 4]
+            lines = head.split("\r\n")
+            try:
+                method, path, version = lines[0].split(" ", 2)
+            except ValueError:
+                self.send(400, {}, b"", keep_alive=False)
+                return
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length') or 0)
+            if length:
+                # Catalog requests have no body; drop whatever was sent
+                del self.buffer[:length]
+            keep_alive = (headers.get('connection', '').lower() != 'close'
+                          if version == 'HTTP/1.1' else headers.get('connection', '').lower() == 'keep-alive')
+
+            backend = self.backend
+            backend.stats.requests += 1
+            status, extra_headers, body = backend.respond(method, path, headers)
+            if method == 'HEAD':
+                body = b""
+            delay = backend.delay()
+            if delay > 0:
+                self.busy = True
+                backend.stats.in_flight += 1
+                backend.stats.peak_in_flight = max(backend.stats.peak_in_flight, backend.stats.in_flight)
+                asyncio.get_running_loop().call_later(delay, self.finish, status, extra_headers, body, keep_alive)
+                return
+            self.send(status, extra_headers, body, keep_alive)
+
+    def finish(self, status: int, headers: Dict[str, str], body: bytes, keep_alive: bool):
+        self.busy = False
+        self.backend.stats.in_flight -= 1
+        if self.closed:
+            return
+        self.send(status, headers, body, keep_alive)
+        self.process()
+
+    def send(self, status: int, headers: Dict[str, str], body: bytes, keep_alive: bool = True):
+        stats = self.backend.stats
+        stats.responses[status] = stats.responses.get(status, 0) + 1
+        stats.bytes_out += len(body)
+        head = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'Error')}",
+                f"Content-Length: {len(body)}",
+                "Connection: keep-alive" if keep_alive else "Connection: close"]
+        if status != 304:
+            head.append("Content-Type: application/json; charset=utf-8")
+        head.extend(f"{name}: {value}" for name, value in headers.items())
+        self.transport.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body)
+        if not keep_alive:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.backend.stats.open_connections -= 1
+
+
+async def serve(backend: LocalBackend, host: str, port: int, stats_interval: float = 0):
+    loop = asyncio.get_running_loop()
+    # A fleet bootstraps all at once; asyncio's default backlog of 100 would drop connections
+    server = await loop.create_server(lambda: HTTPConnection(backend), host, port,
+                                      reuse_address=True, backlog=4096)
+    logger.info(f"📡 Local backend serving {backend.source.description} on http://{host}:{port}/api")
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, backend.reload)
+
+    async def report_stats():
+        while True:
+            await asyncio.sleep(stats_interval)
+            logger.info(f"📊 {backend.stats.format_summary()}")
+
+    task = asyncio.create_task(report_stats()) if stats_interval > 0 else None
+    await stop.wait()
+    if task is not None:
+        task.cancel()
+    server.close()
+    logger.info(f"📊 {backend.stats.format_summary()}")
+    logger.info("👋 Backend stopped")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_process(args: List[str] = (), timeout: float = 10.0, **popen_kwargs) -> Tuple[subprocess.Popen, str]:
+    """Start a local backend on a free loopback port; returns the process and its API URL"""
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, 'local_backend.py'), '--port', str(port),
+                                *args], **popen_kwargs)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"local backend exited with {process.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process, f"http://127.0.0.1:{port}/api"
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"local backend did not start within {timeout}s")
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Local stand-in for the backend\'s device action catalog API')
+    parser.add_argument('--host', default='127.0.0.1',
+                       help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=3000,
+                       help='Port to listen on (default: 3000)')
+    parser.add_argument('--seed-sql', default=DEFAULT_SEED_SQL,
+                       help='SQL seed file whose sensors rows define the catalogs (default: ../sfdb_postgres.sql)')
+    parser.add_argument('--scenario', default=None,
+                       help='Serve catalogs of this scenario file\'s groups instead of the seed data')
+    parser.add_argument('--strict', action='store_true',
+                       help='Answer [] for devices not in the seed data, like the real backend')
+    parser.add_argument('--latency', type=float, default=0, metavar='MS',
+                       help='Delay every response by MS milliseconds (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0, metavar='MS',
+                       help='Add an exponentially distributed delay with this mean (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                       help='Fraction of catalog requests answered with --error-status (default: 0)')
+    parser.add_argument('--error-status', type=int, default=503,
+                       help='HTTP status of injected errors (default: 503)')
+    parser.add_argument('--seed', type=int, default=None,
+                       help='Random seed for jitter and errors')
+    parser.add_argument('--stats-interval', type=float, default=0,
+                       help='Log request counts every N seconds (default: off)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                       help='Enable debug logging')
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    try:
+        source = CatalogSource(args.seed_sql, args.scenario, args.strict)
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ {e}")
+        sys.exit(2)
+    backend = LocalBackend(source, args.latency / 1000.0, args.jitter / 1000.0,
+                           max(0.0, min(1.0, args.error_rate)), args.error_status, args.seed)
+    asyncio.run(serve(backend, args.host, args.port, args.stats_interval))
+
+
+if __name__ == "__main__":
+    main()
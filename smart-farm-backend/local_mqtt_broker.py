@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+Local MQTT Broker Stand-in
+A small in-process MQTT 3.1.1 broker for running the simulators on one machine without network access.
+
+Usage:
+    python local_mqtt_broker.py
+    python local_mqtt_broker.py --host 127.0.0.1 --port 1883 --stats-interval 10
+
+Supports what the simulators and the backend use: QoS 0/1/2 publishes,
+retained messages, last wills, ``+``/``#`` wildcard subscriptions, keepalive
+and client takeover. It does not persist sessions: a reconnecting client
+starts clean and QoS 1/2 messages are not redelivered. Authentication is
+accepted as given. MQTT 5 clients (``--mqtt5``, share groups, topic aliases)
+are refused - use a real broker for those.
+
+Subscriptions live in a topic tree, so routing a publish costs the depth of
+the topic rather than the number of subscribers, and the broker keeps up
+with fleets of thousands of devices on a single core.
+"""
+
+import asyncio
+import time
+import argparse
+import logging
+import signal
+import struct
+from typing import Any, Dict, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+CONNACK_UNACCEPTABLE_PROTOCOL = 0x01
+
+
+class ProtocolError(Exception):
+    """Malformed or unsupported packet; the connection is closed"""
+
+
+def encode_length(length: int) -> bytes:
+    """MQTT variable-length integer"""
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(text: str) -> bytes:
+    data = text.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def publish_packet(topic: str, payload: bytes, qos: int, retain: bool, packet_id: int = 0) -> bytes:
+    """Build a PUBLISH packet"""
+    body = encode_string(topic) + (struct.pack('!H', packet_id) if qos else b'') + payload
+    return bytes([PUBLISH << 4 | qos << 1 | int(retain)]) + encode_length(len(body)) + body
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Whether a topic matches a subscription filter (used for retained messages)"""
+    if topic.startswith('$') and topic_filter[:1] in ('+', '#'):
+        return False
+    filter_levels, topic_levels = topic_filter.split('/'), topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels) or (level != '+' and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class TopicTree:
+    """Subscriptions by topic level, with ``+`` and ``#`` as children of their parent level"""
+
+    def __init__(self):
+        self.root: Dict[str, Any] = {}  # level -> [children, {session: qos}]
+
+    def add(self, topic_filter: str, session: 'ClientSession', qos: int):
+        node = None
+        children = self.root
+        for level in topic_filter.split('/'):
+            node = children.setdefault(level, [{}, {}])
+            children = node[0]
+        node[1][session] = qos
+
+    def remove(self, topic_filter: str, session: 'ClientSession'):
+        path = []
+        children = self.root
+        for level in topic_filter.split('/'):
+            node = children.get(level)
+            if node is None:
+                return
+            path.append((children, level, node))
+            children = node[0]
+        path[-1][2][1].pop(session, None)
+        # Prune empty branches so churned device IDs don't accumulate
+        for children, level, node in reversed(path):
+            if node[0] or node[1]:
+                break
+            del children[level]
+
+    def match(self, topic: str) -> Dict['ClientSession', int]:
+        """Subscribers of a topic with the highest QoS each one subscribed at"""
+        levels = topic.split('/')
+        matched: Dict[ClientSession, int] = {}
+
+        def collect(subscribers: Dict['ClientSession', int]):
+            for session, qos in subscribers.items():
+                if matched.get(session, -1) < qos:
+                    matched[session] = qos
+
+        def walk(children: Dict[str, Any], depth: int):
+            wildcard = children.get('#')
+            if wildcard is not None and not (depth == 0 and topic.startswith('$')):
+                collect(wildcard[1])
+            if depth == len(levels):
+                return
+            for level in (levels[depth], '+'):
+                if level == '+' and depth == 0 and topic.startswith('$'):
+                    continue
+                node = children.get(level)
+                if node is not None:
+                    if depth + 1 == len(levels):
+                        collect(node[1])
+                        # "a/#" also matches "a"
+                        if '#' in node[0]:
+                            collect(node[0]['#'][1])
+                    else:
+                        walk(node[0], depth + 1)
+
+        walk(self.root, 0)
+        return matched
+
+
+class ClientSession(asyncio.Protocol):
+    """One client connection"""
+
+    def __init__(self, broker: 'LocalBroker'):
+        self.broker = broker
+        self.transport: Optional[asyncio.Transport] = None
+        self.buffer = bytearray()
+        self.client_id: Optional[str] = None
+        self.keepalive = 0
+        self.last_seen = time.monotonic()
+        self.will: Optional[Tuple[str, bytes, int, bool]] = None
+        self.subscriptions: Dict[str, int] = {}
+        self.next_packet_id = 0
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        self.last_seen = time.monotonic()
+        self.buffer += data
+        try:
+            while True:
+                packet = self._next_packet()
+                if packet is None:
+                    return
+                self.handle_packet(*packet)
+                if self.closed:
+                    return
+        except (ProtocolError, struct.error, UnicodeDecodeError, IndexError) as e:
+            logger.warning(f"⚠️ Closing {self.client_id or 'client'}: {e}")
+            self.close()
+
+    def _next_packet(self) -> Optional[Tuple[int, int, bytes]]:
+        """Split one complete packet off the buffer"""
+        buffer = self.buffer
+        length, multiplier, index = 0, 1, 1
+        while True:
+            if index >= len(buffer):
+                return None
+            byte = buffer[index]
+            length += (byte & 0x7F) * multiplier
+            index += 1
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+            if index > 4:
+                raise ProtocolError("malformed remaining length")
+        if len(buffer) < index + length:
+            return None
+        header = buffer[0]
+        body = bytes(buffer[index:index + length])
+        del buffer[:index + length]
+        return header >> 4, header & 0x0F, body
+
+    def handle_packet(self, packet_type: int, flags: int, body: bytes):
+        if self.client_id is None and packet_type != CONNECT:
+            raise ProtocolError("expected CONNECT")
+        if packet_type == CONNECT:
+            self.handle_connect(body)
+        elif packet_type == PUBLISH:
+            self.handle_publish(flags, body)
+        elif packet_type == PUBREL:
+            self.transport.write(bytes([PUBCOMP << 4, 2]) + body[:2])
+        elif packet_type == PUBREC:
+            # Our QoS 2 delivery: release it
+            self.transport.write(bytes([PUBREL << 4 | 2, 2]) + body[:2])
+        elif packet_type in (PUBACK, PUBCOMP):
+            pass  # no redelivery, so nothing to clear
+        elif packet_type == SUBSCRIBE:
+            self.handle_subscribe(body)
+        elif packet_type == UNSUBSCRIBE:
+            self.handle_unsubscribe(body)
+        elif packet_type == PINGREQ:
+            self.transport.write(bytes([PINGRESP << 4, 0]))
+        elif packet_type == DISCONNECT:
+            self.will = None
+            self.close()
+        else:
+            raise ProtocolError(f"unexpected packet type {packet_type}")
+
+    def handle_connect(self, body: bytes):
+        if self.client_id is not None:
+            raise ProtocolError("second CONNECT")
+        position = 2 + struct.unpack_from('!H', body)[0]
+        protocol_name = body[2:position].decode('utf-8')
+        level, connect_flags, self.keepalive = struct.unpack_from('!BBH', body, position)
+        position += 4
+        if protocol_name not in ('MQTT', 'MQIsdp') or level not in (3, 4):
+            self.transport.write(bytes([CONNACK << 4, 2, 0, CONNACK_UNACCEPTABLE_PROTOCOL]))
+            self.client_id = ''
+            logger.warning(f"⚠️ Refused {protocol_name} level {level} client (MQTT 3.1.1 only)")
+            self.close()
+            return
+
+        def read_field() -> bytes:
+            nonlocal position
+            length = struct.unpack_from('!H', body, position)[0]
+            field = body[position + 2:position + 2 + length]
+            position += 2 + length
+            return field
+
+        client_id = read_field().decode('utf-8')
+        if connect_flags & 0x04:
+            will_topic = read_field().decode('utf-8')
+            will_payload = read_field()
+            self.will = (will_topic, will_payload, (connect_flags >> 3) & 0x03, bool(connect_flags & 0x20))
+        # Username and password (flags 0x80/0x40) are accepted without checking
+        self.client_id = client_id or f"auto-{id(self):x}"
+        self.broker.register(self)
+        self.transport.write(bytes([CONNACK << 4, 2, 0, 0]))
+
+    def handle_publish(self, flags: int, body: bytes):
+        qos, retain = (flags >> 1) & 0x03, bool(flags & 0x01)
+        topic_length = struct.unpack_from('!H', body)[0]
+        topic = body[2:2 + topic_length].decode('utf-8')
+        position = 2 + topic_length
+        if qos:
+            packet_id = body[position:position + 2]
+            position += 2
+        payload = body[position:]
+        if '+' in topic or '#' in topic:
+            raise ProtocolError(f"wildcard in publish topic {topic}")
+        self.broker.publish(topic, payload, qos, retain)
+        if qos == 1:
+            self.transport.write(bytes([PUBACK << 4, 2]) + packet_id)
+        elif qos == 2:
+            self.transport.write(bytes([PUBREC << 4, 2]) + packet_id)
+
+    def handle_subscribe(self, body: bytes):
+        packet_id, position = body[:2], 2
+        granted = []
+        filters = []
+        while position < len(body):
+            length = struct.unpack_from('!H', body, position)[0]
+            topic_filter = body[position + 2:position + 2 + length].decode('utf-8')
+            qos = min(body[position + 2 + length] & 0x03, 2)
+            position += 3 + length
+            self.subscriptions[topic_filter] = qos
+            self.broker.subscriptions.add(topic_filter, self, qos)
+            granted.append(qos)
+            filters.append((topic_filter, qos))
+        self.transport.write(bytes([SUBACK << 4]) + encode_length(2 + len(granted)) + packet_id + bytes(granted))
+        for topic_filter, qos in filters:
+            self.broker.send_retained(self, topic_filter, qos)
+
+    def handle_unsubscribe(self, body: bytes):
+        packet_id, position = body[:2], 2
+        while position < len(body):
+            length = struct.unpack_from('!H', body, position)[0]
+            topic_filter = body[position + 2:position + 2 + length].decode('utf-8')
+            position += 2 + length
+            self.subscriptions.pop(topic_filter, None)
+            self.broker.subscriptions.remove(topic_filter, self)
+        self.transport.write(bytes([UNSUBACK << 4, 2]) + packet_id)
+
+    def deliver(self, topic: str, payload: bytes, qos: int, retain: bool = False):
+        if self.closed:
+            return
+        packet_id = 0
+        if qos:
+            self.next_packet_id = self.next_packet_id % 65535 + 1
+            packet_id = self.next_packet_id
+        self.transport.write(publish_packet(topic, payload, qos, retain, packet_id))
+        self.broker.stats["delivered"] += 1
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.broker.unregister(self)
+
+
+class LocalBroker:
+    """Routing, retained messages and sessions of the stand-in broker"""
+
+    def __init__(self):
+        self.subscriptions = TopicTree()
+        self.retained: Dict[str, Tuple[bytes, int]] = {}
+        self.sessions: Dict[str, ClientSession] = {}
+        self.stats = {"connections": 0, "received": 0, "delivered": 0, "wills": 0}
+        self.started = time.time()
+
+    def register(self, session: ClientSession):
+        previous = self.sessions.get(session.client_id)
+        if previous is not None and previous is not session:
+            logger.debug(f"🔁 Client takeover: {session.client_id}")
+            previous.close()
+            self.unregister(previous)
+        self.sessions[session.client_id] = session
+        self.stats["connections"] += 1
+
+    def unregister(self, session: ClientSession):
+        for topic_filter in session.subscriptions:
+            self.subscriptions.remove(topic_filter, session)
+        session.subscriptions = {}
+        if session.client_id and self.sessions.get(session.client_id) is session:
+            del self.sessions[session.client_id]
+        if session.will is not None:
+            topic, payload, qos, retain = session.will
+            session.will = None
+            self.stats["wills"] += 1
+            self.publish(topic, payload, qos, retain)
+
+    def publish(self, topic: str, payload: bytes, qos: int, retain: bool):
+        self.stats["received"] += 1
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+        for session, subscribed_qos in self.subscriptions.match(topic).items():
+            session.deliver(topic, payload, min(qos, subscribed_qos))
+
+    def send_retained(self, session: ClientSession, topic_filter: str, qos: int):
+        if '+' not in topic_filter and '#' not in topic_filter:
+            matches = [topic_filter] if topic_filter in self.retained else []
+        else:
+            matches = [topic for topic in self.retained if topic_matches(topic_filter, topic)]
+        for topic in matches:
+            payload, retained_qos = self.retained[topic]
+            session.deliver(topic, payload, min(qos, retained_qos), retain=True)
+
+    async def expire_idle_sessions(self):
+        """Drop clients silent for 1.5x their keepalive, publishing their wills"""
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for session in list(self.sessions.values()):
+                if session.keepalive and now - session.last_seen > 1.5 * session.keepalive:
+                    logger.info(f"⏰ Keepalive expired: {session.client_id}")
+                    session.close()
+
+    async def report_stats(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f"📊 {self.format_summary()}")
+
+    def format_summary(self) -> str:
+        return (f"{len(self.sessions)} clients, {self.stats['received']} msgs in, "
+                f"{self.stats['delivered']} out, {len(self.retained)} retained, {self.stats['wills']} wills")
+
+
+async def serve(host: str, port: int, stats_interval: float = 0):
+    broker = LocalBroker()
+    loop = asyncio.get_running_loop()
+    # A fleet connects all at once; asyncio's default backlog of 100 would drop handshakes
+    server = await loop.create_server(lambda: ClientSession(broker), host, port,
+                                      reuse_address=True, backlog=4096)
+    logger.info(f"📡 Local MQTT broker listening on mqtt://{host}:{port}")
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    tasks = [asyncio.create_task(broker.expire_idle_sessions())]
+    if stats_interval > 0:
+        tasks.append(asyncio.create_task(broker.report_stats(stats_interval)))
+
+    await stop.wait()
+    for task in tasks:
+        task.cancel()
+    server.close()
+    for session in list(broker.sessions.values()):
+        session.close()
+    logger.info(f"📊 {broker.format_summary()}")
+    logger.info("👋 Broker stopped")
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Local MQTT 3.1.1 broker stand-in')
+    parser.add_argument('--host', default='127.0.0.1',
+                       help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=1883,
+                       help='Port to listen on (default: 1883)')
+    parser.add_argument('--stats-interval', type=float, default=0,
+                       help='Log client and message counts every N seconds (default: off)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                       help='Enable debug logging')
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    asyncio.run(serve(args.host, args.port, args.stats_interval))
+
+
+if __name__ == "__main__":
+    main()
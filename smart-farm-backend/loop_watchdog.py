@@ -0,0 +1,227 @@
+"""
+Watchdog for the paho network loop of the device simulators.
+
+paho runs ``on_connect``, ``on_message`` (and with it the JSON parse in
+``process_action``), ``on_publish`` and ``on_disconnect`` on the client's
+single network thread. While one of them is slow, the loop reads nothing
+else and sends no PINGREQ: with the 60 s keepalive the broker drops a client
+that stays silent for 90 s, and paho itself closes the socket when a ping
+goes unanswered for a keepalive period. Those are the "unexplained"
+disconnects under load.
+
+``LoopWatchdog.instrument(client, device_id)`` wraps the client's callbacks
+and records, per callback, how long it ran and how long after the loop
+started reading its packet it was dispatched. A monitor thread
+
+- takes a stack sample of any callback still running after the threshold
+  and logs it as a stall, and
+- checks every client's keepalive margin: the seconds left before the broker
+  would give up on it (1.5 x keepalive minus the time since the client last
+  sent anything), warning when it falls below a quarter of the keepalive.
+
+One watchdog serves a whole process; fleets share it between devices.
+Durations go into fixed histogram buckets, so recording a call takes a lock
+and a few integer updates.
+"""
+
+import logging
+import sys
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+CALLBACKS = ("on_connect", "on_message", "on_publish", "on_subscribe", "on_disconnect", "on_connect_fail")
+# Histogram bucket upper bounds (ms); the last bucket catches everything slower
+BUCKETS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+STACK_FRAMES = 12
+
+
+class LatencyHistogram:
+    """Count, total, max and bucketed distribution of durations"""
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def record(self, ms: float):
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.buckets[bisect_left(BUCKETS_MS, ms)] += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th percentile"""
+        if not self.count:
+            return None
+        target = q / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return BUCKETS_MS[index] if index < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        return {"count": self.count, "meanMs": round(self.total / self.count, 3) if self.count else None,
+                "p99Ms": self.percentile(99), "maxMs": round(self.max, 3)}
+
+
+class LoopWatchdog:
+    """Times network-thread callbacks and flags loop stalls and shrinking keepalive margins"""
+
+    def __init__(self, threshold: float = 0.5, interval: float = None, stack_frames: int = STACK_FRAMES):
+        self.threshold = threshold   # seconds a callback may run before it counts as a stall
+        self.interval = interval or max(0.05, min(threshold / 4, 1.0))
+        self.stack_frames = stack_frames
+        self.callbacks: Dict[str, LatencyHistogram] = {name: LatencyHistogram() for name in CALLBACKS}
+        self.dispatch = LatencyHistogram()   # packet read started -> callback entered
+        self.stalls = 0
+        self.worst_stall: Optional[Dict[str, Any]] = None
+        self.min_keepalive_margin: Optional[float] = None
+        self.keepalive_warnings = 0
+        self._clients: List[tuple] = []      # (client, device_id)
+        self._active: Dict[int, list] = {}   # thread id -> [device_id, callback, started, stack]
+        self._read_started = threading.local()
+        self._low_margin = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def instrument(self, client: mqtt.Client, device_id: str):
+        """Wrap a client's callbacks; call after they are set and before connecting"""
+        for name in CALLBACKS:
+            callback = getattr(client, name, None)
+            if callback is not None:
+                setattr(client, name, self._wrap(callback, name, device_id))
+        packet_read = client._packet_read
+        local = self._read_started
+
+        def timed_packet_read():
+            local.value = time.perf_counter()
+            return packet_read()
+
+        client._packet_read = timed_packet_read
+        with self._lock:
+            self._clients.append((client, device_id))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+                self._thread.start()
+
+    def _wrap(self, callback, name: str, device_id: str):
+        histogram = self.callbacks[name]
+        active = self._active
+        local = self._read_started
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            # One dispatch per packet read; callbacks not caused by a read have no stamp
+            read_started = getattr(local, 'value', None)
+            local.value = None
+            ident = threading.get_ident()
+            entry = [device_id, name, started, None]  # stack filled in by the monitor
+            active[ident] = entry
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                active.pop(ident, None)
+                stalled = elapsed >= self.threshold
+                with self._lock:
+                    histogram.record(elapsed * 1000)
+                    if read_started is not None:
+                        self.dispatch.record((started - read_started) * 1000)
+                    if stalled:
+                        self.stalls += 1
+                        if self.worst_stall is None or elapsed > self.worst_stall["seconds"]:
+                            self.worst_stall = {"deviceId": device_id, "callback": name,
+                                                "seconds": round(elapsed, 3), "stack": entry[3]}
+                if stalled:
+                    logger.warning(f"🐢 {name} of {device_id} blocked the network loop for {elapsed * 1000:.0f} ms")
+
+        return timed
+
+    def _monitor(self):
+        next_keepalive_check = 0.0
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            frames = None
+            for ident, entry in list(self._active.items()):
+                device_id, name, started, stack = entry
+                elapsed = now - started
+                if stack is not None or elapsed < self.threshold:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                frame = frames.get(ident)
+                entry[3] = "".join(traceback.format_stack(frame, limit=self.stack_frames)) if frame else ""
+                logger.warning(f"🐢 Network loop of {device_id} stalled {elapsed * 1000:.0f} ms in {name}:\n"
+                               f"{entry[3]}")
+            if now >= next_keepalive_check:
+                self.check_keepalive()
+                next_keepalive_check = now + 1.0
+
+    def check_keepalive(self):
+        """Track the smallest margin before a broker would drop one of our clients"""
+        now = time.monotonic()
+        with self._lock:
+            clients = list(self._clients)
+        for client, device_id in clients:
+            keepalive = client._keepalive
+            if not keepalive or not client.is_connected():
+                continue
+            margin = 1.5 * keepalive - (now - client._last_msg_out)
+            if self.min_keepalive_margin is None or margin < self.min_keepalive_margin:
+                self.min_keepalive_margin = margin
+            if margin < 0.25 * keepalive:
+                if device_id not in self._low_margin:
+                    self._low_margin.add(device_id)
+                    self.keepalive_warnings += 1
+                    logger.warning(f"⏳ {device_id}: {margin:.1f}s of keepalive margin left "
+                                   f"(nothing sent for {now - client._last_msg_out:.1f}s, keepalive {keepalive}s)")
+            else:
+                self._low_margin.discard(device_id)
+
+    def stop(self):
+        self._stop.set()
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            summary = {
+                "thresholdMs": round(self.threshold * 1000),
+                "callbacks": {name: histogram.summary() for name, histogram in self.callbacks.items()
+                              if histogram.count},
+                "dispatchDelay": self.dispatch.summary(),
+                "stalls": self.stalls,
+                "keepaliveWarnings": self.keepalive_warnings,
+                "minKeepaliveMarginSeconds": (round(self.min_keepalive_margin, 1)
+                                              if self.min_keepalive_margin is not None else None),
+            }
+            if self.worst_stall:
+                summary["worstStall"] = dict(self.worst_stall)
+        return summary
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        parts = [f"{name} {stats['count']} calls mean {stats['meanMs']:.2f} ms p99 <={stats['p99Ms']:g} ms "
+                 f"max {stats['maxMs']:.1f} ms" for name, stats in summary["callbacks"].items()]
+        dispatch = summary["dispatchDelay"]
+        if dispatch["count"]:
+            parts.append(f"read->dispatch p99 <={dispatch['p99Ms']:g} ms max {dispatch['maxMs']:.1f} ms")
+        parts.append(f"{summary['stalls']} stalls over {summary['thresholdMs']} ms")
+        if summary["minKeepaliveMarginSeconds"] is not None:
+            parts.append(f"min keepalive margin {summary['minKeepaliveMarginSeconds']}s")
+        worst = summary.get("worstStall")
+        if worst:
+            parts.append(f"worst stall {worst['seconds'] * 1000:.0f} ms in {worst['callback']} of {worst['deviceId']}")
+        return "; ".join(parts)
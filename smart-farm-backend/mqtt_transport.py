@@ -0,0 +1,394 @@
+"""
+MQTT transport helpers shared by the Smart Farm device simulators.
+
+The broker URL scheme selects the transport:
+    mqtt://host:1883        plain MQTT over TCP
+    mqtts://host:8883       MQTT over TLS (what field devices use)
+    ws://host:8083/mqtt     MQTT over WebSocket
+    wss://host:8084/mqtt    MQTT over WebSocket + TLS
+
+TLS contexts are cached and shared: loading CA certificates is the expensive
+part of building an SSLContext, so a fleet of thousands of clients builds one
+context per (CA file, verification mode) instead of one per device.
+
+Several comma-separated URLs form a ``BrokerCluster``: devices are spread
+over the listeners by consistent hashing on their device ID, so adding or
+removing a listener only moves the devices that hashed to it. An endpoint
+whose connection attempts keep failing is marked down and its devices fail
+over to the next node of their hash ring until it has had time to recover.
+"""
+
+import os
+import ssl
+import socket
+import threading
+import logging
+import time
+import hashlib
+from bisect import bisect
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+# CA bundle for the EMQX Cloud broker, kept at the repository root
+DEFAULT_CA_FILE = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'certs', 'emqxsl-ca.crt'
+))
+
+# scheme -> (paho transport, TLS enabled, default port)
+TRANSPORTS = {
+    'mqtt': ('tcp', False, 1883),
+    'tcp': ('tcp', False, 1883),
+    'mqtts': ('tcp', True, 8883),
+    'ssl': ('tcp', True, 8883),
+    'ws': ('websockets', False, 8083),
+    'wss': ('websockets', True, 8084),
+}
+
+# paho 1.6 waits on its socket with select(), which cannot watch file
+# descriptors >= 1024; each client holds about three (socket + wakeup pair),
+# so clients past this count in one process silently never connect
+MAX_CLIENTS_PER_PROCESS = 330
+
+
+class BrokerEndpoint(NamedTuple):
+    """Connection details parsed from a broker URL"""
+    scheme: str
+    host: str
+    port: int
+    transport: str
+    use_ssl: bool
+    ws_path: str
+
+
+def parse_broker_url(broker_url: str) -> BrokerEndpoint:
+    """Parse a broker URL into host, port and transport settings"""
+    parsed = urlparse(broker_url)
+    scheme = parsed.scheme.lower()
+    if scheme not in TRANSPORTS:
+        raise ValueError(
+            f"Unsupported broker URL scheme '{parsed.scheme}' "
+            f"(expected one of: {', '.join(sorted(TRANSPORTS))})"
+        )
+
+    transport, use_ssl, default_port = TRANSPORTS[scheme]
+    return BrokerEndpoint(
+        scheme=scheme,
+        host=parsed.hostname,
+        port=parsed.port or default_port,
+        transport=transport,
+        use_ssl=use_ssl,
+        ws_path=parsed.path or '/mqtt'
+    )
+
+
+_ssl_contexts: Dict[Tuple[Optional[str], bool], ssl.SSLContext] = {}
+_ssl_contexts_lock = threading.Lock()
+
+
+def get_shared_ssl_context(ca_file: Optional[str] = DEFAULT_CA_FILE, insecure: bool = False) -> ssl.SSLContext:
+    """Return a process-wide TLS context, building it on first use
+
+    With ``insecure=True`` certificates are not verified, which matches the
+    simulators' historical behaviour for brokers with self-signed certs.
+    """
+    key = (ca_file, insecure)
+    context = _ssl_contexts.get(key)
+    if context is not None:
+        return context
+
+    with _ssl_contexts_lock:
+        if key not in _ssl_contexts:
+            if insecure:
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            elif ca_file and os.path.exists(ca_file):
+                context = ssl.create_default_context(cafile=ca_file)
+            else:
+                if ca_file:
+                    logger.warning(f"⚠️ CA file not found: {ca_file}, using system trust store")
+                context = ssl.create_default_context()
+            _ssl_contexts[key] = context
+        return _ssl_contexts[key]
+
+
+def create_mqtt_client(endpoint: BrokerEndpoint, protocol: int = mqtt.MQTTv311,
+                       client_id: str = "") -> mqtt.Client:
+    """Create a paho client using the transport selected by the endpoint"""
+    client = mqtt.Client(client_id=client_id, transport=endpoint.transport, protocol=protocol)
+    if endpoint.transport == 'websockets':
+        client.ws_set_options(path=endpoint.ws_path)
+    return client
+
+
+def retarget_client(client: mqtt.Client, endpoint: BrokerEndpoint, keepalive: int = 60):
+    """Point a client's next (re)connect at another endpoint of the same scheme
+
+    Safe to call from a callback: paho's network loop picks the new host up
+    on its next reconnect attempt.
+    """
+    if endpoint.transport == 'websockets':
+        client.ws_set_options(path=endpoint.ws_path)
+    client.connect_async(endpoint.host, endpoint.port, keepalive)
+
+
+def on_network_thread(client: mqtt.Client) -> bool:
+    """True when called from the client's loop_start() thread, i.e. inside a callback"""
+    return threading.current_thread() is getattr(client, '_thread', None)
+
+
+def sever_connection(client: mqtt.Client) -> bool:
+    """Cut a client's connection without a DISCONNECT packet, as a dropped link would
+
+    The broker publishes the Last Will and paho's network loop reconnects
+    after its reconnect delay. Works for every transport because the
+    underlying TCP socket is shut down rather than the TLS/WebSocket wrapper.
+    """
+    sock = client.socket()
+    if sock is None:
+        return False
+    raw = socket.fromfd(sock.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        raw.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        return False
+    finally:
+        raw.close()
+    return True
+
+
+class InflightTracker:
+    """QoS 1 publishes of one client still waiting for their PUBACK
+
+    ``on_publish`` runs on the network thread and can fire before
+    ``client.publish`` has returned the mid to the publishing thread, so a
+    PUBACK for a mid that isn't registered yet is remembered and cancels the
+    registration instead of leaving an entry that is never removed. QoS 0
+    publishes are noted until paho reports them written, so that callback is
+    not mistaken for an early PUBACK.
+
+    A QoS 1 publish made while disconnected returns ``MQTT_ERR_NO_CONN`` but
+    stays queued in paho and is sent on reconnect, so it is tracked too.
+    Early PUBACKs are forgotten after ``early_ack_ttl`` seconds: a real one is
+    matched within microseconds, and a stale one must not swallow a later
+    publish that reuses the mid once the 16-bit counter wraps.
+    """
+
+    early_ack_ttl = 10.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[int, mqtt.MQTTMessageInfo] = {}
+        self._unsent = set()        # QoS 0 mids whose on_publish hasn't fired yet
+        self._acked_early = {}      # mid -> time its on_publish beat the registration, oldest first
+
+    def sent(self, info: mqtt.MQTTMessageInfo, qos: int):
+        """Register a publish once ``client.publish`` has returned"""
+        queued = info.rc == mqtt.MQTT_ERR_SUCCESS or (qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN)
+        if not queued:
+            return
+        with self._lock:
+            self._expire(time.time())
+            if self._acked_early.pop(info.mid, None) is not None:
+                return
+            if qos > 0:
+                self._unsent.discard(info.mid)
+                self._pending[info.mid] = info
+            else:
+                self._unsent.add(info.mid)
+
+    def acked(self, mid: int):
+        """Forget a publish; called from on_publish"""
+        with self._lock:
+            if self._pending.pop(mid, None) is not None:
+                return
+            if mid in self._unsent:
+                self._unsent.discard(mid)
+            else:
+                now = time.time()
+                self._expire(now)
+                self._acked_early[mid] = now
+
+    def _expire(self, now: float):
+        """Drop early PUBACKs older than the TTL; insertion order is arrival order"""
+        early = self._acked_early
+        while early:
+            mid = next(iter(early))
+            if now - early[mid] <= self.early_ack_ttl:
+                break
+            del early[mid]
+
+    def wait(self, deadline: float) -> int:
+        """Wait until every pending publish is acknowledged or the deadline passes; returns how many are left"""
+        with self._lock:
+            pending = list(self._pending.values())
+        for info in pending:
+            while self._waiting(info):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    info.wait_for_publish(timeout=remaining)
+                else:
+                    # Queued while disconnected: paho's wait_for_publish raises for these, so poll
+                    time.sleep(min(0.05, remaining))
+        return sum(1 for info in pending if self._waiting(info))
+
+    def _waiting(self, info: mqtt.MQTTMessageInfo) -> bool:
+        with self._lock:
+            return self._pending.get(info.mid) is info
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._unsent.clear()
+            self._acked_early.clear()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+def _ring_hash(key: str) -> int:
+    """64-bit ring position; md5 spreads similar keys (sim-1, sim-2, ...) evenly, crc32 does not"""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class EndpointStats:
+    """Connections, health and traffic of one broker endpoint in a cluster"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.endpoint = parse_broker_url(url)
+        self.connections = 0       # devices currently connected here
+        self.connects = 0
+        self.failures = 0          # connection attempts that failed
+        self.consecutive_failures = 0
+        self.failovers_in = 0      # devices that moved here from a down endpoint
+        self.down_since = None
+        # Publishes from every device on this endpoint, under its own lock rather than the cluster's
+        self.messages = 0
+        self._messages_lock = threading.Lock()
+
+    def record_publish(self):
+        with self._messages_lock:
+            self.messages += 1
+
+    @property
+    def healthy(self) -> bool:
+        return self.down_since is None
+
+
+class BrokerCluster:
+    """Consistent-hash assignment of devices to broker endpoints with failover"""
+
+    def __init__(self, urls: List[str], replicas: int = 512, failure_threshold: int = 3,
+                 retry_after: float = 30.0):
+        if not urls:
+            raise ValueError("A broker cluster needs at least one URL")
+        self.endpoints = {url: EndpointStats(url) for url in urls}
+        # One client can only move between listeners that share its transport and TLS setup
+        if len({(stats.endpoint.transport, stats.endpoint.use_ssl) for stats in self.endpoints.values()}) > 1:
+            raise ValueError("All broker URLs in a cluster must use the same scheme")
+        self.failure_threshold = failure_threshold  # consecutive failed connects before an endpoint is down
+        self.retry_after = retry_after  # seconds a down endpoint is skipped before it is tried again
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+        # Each endpoint owns `replicas` points on the ring so the load evens out
+        ring = sorted((_ring_hash(f"{url}#{replica}"), url)
+                      for url in self.endpoints for replica in range(replicas))
+        self._ring_hashes = [point for point, _ in ring]
+        self._ring_urls = [url for _, url in ring]
+
+    @classmethod
+    def from_urls(cls, broker_urls: str, **kwargs) -> 'BrokerCluster':
+        """Build a cluster from a comma-separated URL list"""
+        return cls([url.strip() for url in broker_urls.split(',') if url.strip()], **kwargs)
+
+    def preference_list(self, device_id: str) -> List[str]:
+        """Endpoints in the order a device tries them: its ring position clockwise"""
+        start = bisect(self._ring_hashes, _ring_hash(device_id))
+        order = []
+        for i in range(len(self._ring_urls)):
+            url = self._ring_urls[(start + i) % len(self._ring_urls)]
+            if url not in order:
+                order.append(url)
+                if len(order) == len(self.endpoints):
+                    break
+        return order
+
+    def assign(self, device_id: str) -> str:
+        """The first healthy endpoint of the device's preference list"""
+        with self._lock:
+            return self._first_healthy(self.preference_list(device_id))
+
+    def _first_healthy(self, order: List[str]) -> str:
+        now = time.time()
+        for url in order:
+            stats = self.endpoints[url]
+            if stats.down_since is not None and now - stats.down_since >= self.retry_after:
+                stats.down_since = None  # give it another chance
+                stats.consecutive_failures = 0
+            if stats.healthy:
+                return url
+        return order[0]  # everything is down: keep trying the primary
+
+    def record_connect(self, url: str):
+        with self._lock:
+            stats = self.endpoints[url]
+            stats.connections += 1
+            stats.connects += 1
+            stats.consecutive_failures = 0
+            if stats.down_since is not None:
+                logger.info(f"💚 Broker endpoint {url} is back up")
+            stats.down_since = None
+
+    def record_disconnect(self, url: str):
+        with self._lock:
+            stats = self.endpoints[url]
+            stats.connections = max(0, stats.connections - 1)
+
+    def record_failure(self, url: str, device_id: str) -> str:
+        """Count a failed connection attempt; return the endpoint the device should try next"""
+        with self._lock:
+            stats = self.endpoints[url]
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if stats.healthy and stats.consecutive_failures >= self.failure_threshold:
+                stats.down_since = time.time()
+                logger.warning(f"💔 Broker endpoint {url} marked down after "
+                               f"{stats.consecutive_failures} failed connection attempts")
+            if stats.healthy:
+                return url
+            target = self._first_healthy(self.preference_list(device_id))
+            if target != url:
+                self.endpoints[target].failovers_in += 1
+            return target
+
+    def record_publish(self, url: str):
+        self.endpoints[url].record_publish()
+
+    def summary(self) -> Dict[str, Any]:
+        """Per endpoint connection count, health and message rate"""
+        elapsed = max(time.time() - self.started, 1e-9)
+        with self._lock:
+            summary = {}
+            for url, stats in self.endpoints.items():
+                messages = stats.messages
+                summary[url] = {"healthy": stats.healthy, "connections": stats.connections,
+                                "connects": stats.connects, "failures": stats.failures,
+                                "failoversIn": stats.failovers_in, "messages": messages,
+                                "messagesPerSecond": round(messages / elapsed, 1)}
+            return summary
+
+    def format_summary(self) -> str:
+        """One line per endpoint, for logs"""
+        return "; ".join(
+            f"{url} [{'up' if stats['healthy'] else 'DOWN'}]: {stats['connections']} connections, "
+            f"{stats['messages']} msgs ({stats['messagesPerSecond']}/s), {stats['failures']} failed connects, "
+            f"{stats['failoversIn']} failovers in"
+            for url, stats in self.summary().items())
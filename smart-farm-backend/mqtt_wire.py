@@ -0,0 +1,306 @@
+"""
+Wire-size helpers for high-rate simulator traffic.
+
+MQTT 5 topic aliases
+    After the broker advertises ``TopicAliasMaximum`` in CONNACK, the first
+    QoS 0 publish on a topic carries the full topic plus an alias number and later
+    publishes send an empty topic with just the alias. Aliases belong to one
+    connection and are reset on every (re)connect.
+
+Compact payload profile
+    Status and ack messages can be sent with short keys, epoch-millisecond
+    timestamps and no whitespace. Status messages only include
+    ``capabilities`` when they changed since the last status on the same
+    connection. Compact messages carry ``"v": 1`` so the backend can tell them
+    apart from verbose ones on the same topics.
+
+    Ack (smartfarm/devices/{deviceId}/ack)
+        v  profile version (1)        i  actionId
+        s  status                     t  timestamp (epoch ms)
+        d  deviceId                   a  action
+        m  message                    x  executionTime (s)
+        e  error                      c  errorCode
+        st deviceState
+
+    Status (smartfarm/devices/{deviceId}/status)
+        v  profile version (1)        d  deviceId
+        s  status                     t  timestamp (epoch ms, also lastSeen)
+        u  uptime (s)                 st deviceState
+        cap capabilities (only when changed)
+        r  reason
+
+    Keys not listed are passed through unchanged.
+
+Egress accounting
+    ``WireStats`` counts messages, payload bytes and full PUBLISH packet bytes
+    per message kind so runs with and without these options can be compared.
+    The verbose size of a compact message is estimated from the compact one
+    (``verbose_size``) rather than by serialising the verbose payload too.
+"""
+
+import json
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+COMPACT_PROFILE_VERSION = 1
+
+ACK_KEYS = {
+    "actionId": "i",
+    "status": "s",
+    "timestamp": "t",
+    "deviceId": "d",
+    "action": "a",
+    "message": "m",
+    "executionTime": "x",
+    "error": "e",
+    "errorCode": "c",
+    "deviceState": "st",
+}
+
+STATUS_KEYS = {
+    "deviceId": "d",
+    "status": "s",
+    "timestamp": "t",
+    "uptime": "u",
+    "deviceState": "st",
+    "capabilities": "cap",
+    "reason": "r",
+}
+
+# Verbose status fields the compact profile drops entirely
+STATUS_DROPPED = ("lastSeen",)
+
+_EXPAND_KEYS = {
+    "ack": {short: key for key, short in ACK_KEYS.items()},
+    "status": {short: key for key, short in STATUS_KEYS.items()},
+}
+
+
+def dumps_compact(payload: Dict[str, Any]) -> str:
+    """Serialize JSON without insignificant whitespace"""
+    return json.dumps(payload, separators=(',', ':'))
+
+
+# Quoted datetime.now(timezone.utc).isoformat(), e.g. "2025-01-01T12:00:00.123456+00:00"
+ISO_TIMESTAMP_BYTES = 34
+
+
+def verbose_size(compact: Dict[str, Any], compact_bytes: int, kind: str, extra_bytes: int = 0) -> int:
+    """Size ``json.dumps`` would give the verbose payload a compact ``ack``/``status`` was built from
+
+    Adds back what compaction removed: the long keys, the ``": "`` and ``", "``
+    separators (one level of nesting too) and the ISO-8601 timestamp, and
+    takes off the ``"v"`` marker. ``extra_bytes`` covers fields the caller
+    dropped or shortened, such as ``lastSeen`` or a rounded ``uptime``.
+    """
+    keys = _EXPAND_KEYS[kind]
+    size = compact_bytes - len(f'"v":{COMPACT_PROFILE_VERSION},') - 1 + extra_bytes
+    for key, value in compact.items():
+        if key == "v":
+            continue
+        size += 2 + len(keys.get(key, key)) - len(key)
+        if isinstance(value, dict) and value:
+            size += 2 * len(value) - 1
+        elif isinstance(value, list) and value:
+            size += len(value) - 1
+    if isinstance(compact.get("t"), int):
+        size += ISO_TIMESTAMP_BYTES - len(str(compact["t"]))
+    return size
+
+
+def _epoch_ms(timestamp: Any) -> Any:
+    """Convert an ISO-8601 timestamp to epoch milliseconds"""
+    if isinstance(timestamp, str):
+        return int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+    return timestamp
+
+
+def compact_ack(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a verbose ack payload to the compact profile"""
+    compact = {"v": COMPACT_PROFILE_VERSION}
+    for key, value in payload.items():
+        if key == "timestamp":
+            value = _epoch_ms(value)
+        elif key == "executionTime" and isinstance(value, float):
+            value = round(value, 3)
+        compact[ACK_KEYS.get(key, key)] = value
+    return compact
+
+
+def compact_status(payload: Dict[str, Any], include_capabilities: bool) -> Dict[str, Any]:
+    """Convert a verbose status payload to the compact profile"""
+    compact = {"v": COMPACT_PROFILE_VERSION}
+    for key, value in payload.items():
+        if key in STATUS_DROPPED or (key == "capabilities" and not include_capabilities):
+            continue
+        if key == "timestamp":
+            value = _epoch_ms(value)
+        elif key == "uptime" and isinstance(value, float):
+            value = int(value)
+        compact[STATUS_KEYS.get(key, key)] = value
+    return compact
+
+
+def expand_compact(payload: Dict[str, Any], kind: str) -> Dict[str, Any]:
+    """Expand a compact ``ack`` or ``status`` payload back to verbose keys
+
+    Reference decoder for consumers opting into the compact profile; the
+    timestamp stays in epoch milliseconds.
+    """
+    keys = _EXPAND_KEYS[kind]
+    return {keys.get(key, key): value for key, value in payload.items() if key != "v"}
+
+
+class TopicAliasTable:
+    """Outgoing MQTT 5 topic aliases for a single connection
+
+    Aliases are only used for QoS 0 publishes. paho re-sends unacknowledged
+    QoS 1 packets verbatim after a reconnect, and an alias-only packet from
+    the previous connection would be rejected (or misrouted) by the broker.
+    QoS 0 packets are never re-sent and are written in the order they are
+    queued, so an alias can be used without its topic as soon as the publish
+    establishing it has been handed to the client.
+    """
+
+    def __init__(self):
+        self.maximum = 0
+        self._epoch = 0
+        self._applied_epoch = 0
+        self._aliases: Dict[str, int] = {}
+        self._next_alias = 1
+        self._established = set()
+        self.lock = threading.Lock()
+
+    def reset(self, maximum: int):
+        """Forget all aliases; called on connect with the broker's limit and on disconnect with 0
+
+        Runs on the network thread, so it never takes ``lock``; the next
+        ``resolve`` applies the reset.
+        """
+        self.maximum = maximum or 0
+        self._epoch += 1
+
+    def resolve(self, topic: str, qos: int) -> Tuple[str, Optional[Properties], Optional[int]]:
+        """Return the topic to send, its PUBLISH properties and the alias used
+
+        Callers must hold ``lock`` from ``resolve`` until ``sent``, so aliases
+        reach the wire in assignment order.
+        """
+        if self._applied_epoch != self._epoch:
+            self._aliases = {}
+            self._next_alias = 1
+            self._established = set()
+            self._applied_epoch = self._epoch
+
+        if qos or not self.maximum:
+            return topic, None, None
+
+        alias = self._aliases.get(topic)
+        if alias is None:
+            if self._next_alias > self.maximum:
+                return topic, None, None
+            alias = self._next_alias
+            self._next_alias += 1
+            self._aliases[topic] = alias
+
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.TopicAlias = alias
+        if alias in self._established:
+            return "", properties, alias
+        return topic, properties, alias
+
+    def sent(self, topic: str, alias: Optional[int], rc: int):
+        """Record the result of handing a publish using ``alias`` to the client"""
+        if alias is None:
+            return
+        if rc == 0:
+            self._established.add(alias)
+        elif alias not in self._established:
+            # Never reached the wire; next publish must send the topic again
+            self._aliases.pop(topic, None)
+
+
+def _varint_length(value: int) -> int:
+    """Bytes needed for an MQTT variable byte integer"""
+    length = 1
+    while value >= 128:
+        value //= 128
+        length += 1
+    return length
+
+
+def publish_packet_size(topic_bytes: int, payload_bytes: int, qos: int,
+                        mqtt5: bool = False, alias: bool = False) -> int:
+    """Size on the wire of a PUBLISH packet (excluding transport framing)"""
+    remaining = 2 + topic_bytes + payload_bytes + (2 if qos else 0)
+    if mqtt5:
+        properties = 3 if alias else 0
+        remaining += _varint_length(properties) + properties
+    return 1 + _varint_length(remaining) + remaining
+
+
+class WireStats:
+    """Per message kind counters of outbound messages and bytes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.kinds: Dict[str, Dict[str, int]] = {}
+
+    def record(self, kind: str, payload_bytes: int, packet_bytes: int, baseline_bytes: int = None):
+        """Record one published message
+
+        ``baseline_bytes`` is the packet size the same message would have had
+        with the full topic and verbose payload, when that differs.
+        """
+        with self._lock:
+            stats = self.kinds.get(kind)
+            if stats is None:
+                stats = self.kinds[kind] = {"messages": 0, "payloadBytes": 0, "packetBytes": 0, "baselineBytes": 0}
+            stats["messages"] += 1
+            stats["payloadBytes"] += payload_bytes
+            stats["packetBytes"] += packet_bytes
+            stats["baselineBytes"] += packet_bytes if baseline_bytes is None else baseline_bytes
+
+    def merge(self, other: 'WireStats'):
+        """Add another device's counters into this one"""
+        with self._lock:
+            for kind, other_stats in other.kinds.items():
+                stats = self.kinds.setdefault(kind, {"messages": 0, "payloadBytes": 0, "packetBytes": 0, "baselineBytes": 0})
+                for key, value in other_stats.items():
+                    stats[key] += value
+
+    def summary(self) -> Dict[str, Any]:
+        """Totals plus bytes per message for each kind"""
+        with self._lock:
+            kinds = {kind: dict(stats) for kind, stats in self.kinds.items()}
+
+        total = {"messages": 0, "payloadBytes": 0, "packetBytes": 0, "baselineBytes": 0}
+        for stats in kinds.values():
+            for key in total:
+                total[key] += stats[key]
+            stats["bytesPerMessage"] = round(stats["packetBytes"] / stats["messages"], 1)
+
+        if total["messages"]:
+            total["bytesPerMessage"] = round(total["packetBytes"] / total["messages"], 1)
+        if total["baselineBytes"]:
+            total["savedPercent"] = round(100.0 * (1 - total["packetBytes"] / total["baselineBytes"]), 1)
+        return {"kinds": kinds, "total": total}
+
+    def format_summary(self) -> str:
+        """One line per kind, for logs"""
+        summary = self.summary()
+        lines = []
+        for kind, stats in sorted(summary["kinds"].items()):
+            lines.append(f"{kind}: {stats['messages']} msgs, {stats['bytesPerMessage']} B/msg, "
+                         f"{stats['packetBytes']} B total")
+        total = summary["total"]
+        if total["messages"]:
+            line = f"total egress: {total['packetBytes']} B in {total['messages']} msgs ({total['bytesPerMessage']} B/msg)"
+            if total.get("savedPercent"):
+                line += f", {total['savedPercent']}% smaller than full topics + verbose payloads"
+            lines.append(line)
+        return "; ".join(lines) if lines else "no messages published"
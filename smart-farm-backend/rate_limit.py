@@ -0,0 +1,188 @@
+"""
+Outbound rate limiting that models constrained device uplinks.
+
+Each device gets a message-rate and a bandwidth token bucket, and a fleet can
+add one global pair on top (the farm's shared uplink). Buckets use virtual
+scheduling: a publish takes its tokens at once, letting the balance go
+negative, and waits until the balance would have recovered. Taking tokens is
+a few float operations under the bucket's lock - no queue entries, timers or
+other per-message objects - so the limiter adds no garbage on the hot path.
+
+Profiles (``--rate-profile``):
+
+    esp32-2g     ESP32 behind a GPRS/EDGE modem
+    esp32-lte-m  ESP32 with an LTE-M module
+    esp32-wifi   ESP32 on weak farm Wi-Fi
+    pi-wifi      Raspberry Pi on Wi-Fi
+    pi-fibre     Raspberry Pi on a wired fibre uplink
+
+or ``MSGS:BYTES`` per second (e.g. ``5:8000``; 0 means unlimited).
+
+Throttle delays are counted separately from everything else in
+``ThrottleStats``: time a message spent waiting here is simulator-imposed,
+any further delay before the broker acks it is broker backpressure.
+QoS 0 telemetry is never delayed - like a sensor node with a full radio
+queue, the reading is shed instead and counted as such.
+"""
+
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# Per second, with the burst the device can send back to back
+PROFILES = {
+    "esp32-2g": {"messagesPerSecond": 2, "bytesPerSecond": 2500, "burstMessages": 4, "burstBytes": 2048},
+    "esp32-lte-m": {"messagesPerSecond": 10, "bytesPerSecond": 30000, "burstMessages": 10, "burstBytes": 8192},
+    "esp32-wifi": {"messagesPerSecond": 50, "bytesPerSecond": 60000, "burstMessages": 20, "burstBytes": 16384},
+    "pi-wifi": {"messagesPerSecond": 500, "bytesPerSecond": 2500000, "burstMessages": 100, "burstBytes": 262144},
+    "pi-fibre": {"messagesPerSecond": 2000, "bytesPerSecond": 12500000, "burstMessages": 500, "burstBytes": 1048576},
+}
+
+
+def parse_rate_profile(text: str) -> Dict[str, float]:
+    """A profile name or ``MSGS:BYTES`` per second; bursts default to one second's worth"""
+    if text in PROFILES:
+        return dict(PROFILES[text])
+    try:
+        messages, _, byte_rate = text.partition(':')
+        messages, byte_rate = float(messages or 0), float(byte_rate or 0)
+    except ValueError:
+        raise ValueError(f"Unknown rate profile '{text}' (expected one of {', '.join(PROFILES)} or MSGS:BYTES)")
+    return {"messagesPerSecond": messages, "bytesPerSecond": byte_rate,
+            "burstMessages": max(1.0, messages), "burstBytes": max(1.0, byte_rate)}
+
+
+class TokenBucket:
+    """Token bucket with virtual scheduling; a rate of 0 disables it"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "_lock")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Take ``amount`` tokens and return how long the caller has to wait for them"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+            self.tokens = tokens
+            self.updated = now
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+    def try_take(self, amount: float, now: float) -> bool:
+        """Take ``amount`` tokens only if they are available right now"""
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if tokens < amount:
+                self.tokens = tokens
+                return False
+            self.tokens = tokens - amount
+        return True
+
+    def refund(self, amount: float):
+        if self.rate > 0:
+            with self._lock:
+                self.tokens = min(self.burst, self.tokens + amount)
+
+
+class ThrottleStats:
+    """Simulator-imposed delay, kept apart from broker backpressure"""
+
+    __slots__ = ("messages", "throttled", "delay", "max_delay", "shed", "_lock")
+
+    def __init__(self):
+        self.messages = 0
+        self.throttled = 0   # messages that had to wait for tokens
+        self.delay = 0.0     # total seconds waited
+        self.max_delay = 0.0
+        self.shed = 0        # QoS 0 telemetry dropped instead of waiting
+        self._lock = threading.Lock()
+
+    def record(self, delay: float):
+        with self._lock:
+            self.messages += 1
+            if delay > 0:
+                self.throttled += 1
+                self.delay += delay
+                if delay > self.max_delay:
+                    self.max_delay = delay
+
+    def record_shed(self):
+        with self._lock:
+            self.shed += 1
+
+    def merge(self, other: 'ThrottleStats'):
+        with self._lock:
+            self.messages += other.messages
+            self.throttled += other.throttled
+            self.delay += other.delay
+            self.max_delay = max(self.max_delay, other.max_delay)
+            self.shed += other.shed
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            summary = {"messages": self.messages, "throttled": self.throttled, "shed": self.shed,
+                       "throttleSeconds": round(self.delay, 3), "maxThrottleMs": round(self.max_delay * 1000, 1)}
+        if summary["throttled"]:
+            summary["meanThrottleMs"] = round(1000 * summary["throttleSeconds"] / summary["throttled"], 1)
+        return summary
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        return (f"rate limit: {summary['throttled']} of {summary['messages']} msgs delayed "
+                f"({summary['throttleSeconds']}s total, mean {summary.get('meanThrottleMs', 0)} ms, "
+                f"max {summary['maxThrottleMs']} ms), {summary['shed']} telemetry readings shed")
+
+
+class RateLimiter:
+    """Message and byte buckets for one device, optionally under a shared global limiter"""
+
+    def __init__(self, profile: Dict[str, float], parent: Optional['RateLimiter'] = None):
+        self.profile = profile
+        self.messages = TokenBucket(profile.get("messagesPerSecond", 0), profile.get("burstMessages", 1))
+        self.bytes = TokenBucket(profile.get("bytesPerSecond", 0), profile.get("burstBytes", 1))
+        self.parent = parent
+        self.stats = ThrottleStats()
+
+    def reserve(self, size: int, now: float) -> float:
+        """Take tokens for one message here and in the parent; the longest wait applies"""
+        delay = max(self.messages.reserve(1, now), self.bytes.reserve(size, now))
+        if self.parent is not None:
+            delay = max(delay, self.parent.reserve(size, now))
+        return delay
+
+    def acquire(self, size: int, block: bool = True) -> float:
+        """Reserve tokens for a message of ``size`` bytes and wait for them
+
+        Returns the delay. With ``block=False`` (callers on the MQTT network
+        thread, which must not stall) the tokens are still taken, so the
+        messages that follow pay for this one, but nothing sleeps.
+        """
+        delay = self.reserve(size, time.monotonic())
+        self.stats.record(delay)
+        if self.parent is not None:
+            self.parent.stats.record(delay)
+        if delay > 0 and block:
+            time.sleep(delay)
+        return delay
+
+    def try_acquire(self, size: int) -> bool:
+        """Take tokens only if available now (QoS 0 telemetry); count a shed message otherwise"""
+        now = time.monotonic()
+        if self.messages.try_take(1, now):
+            if self.bytes.try_take(size, now):
+                if self.parent is None or self.parent.try_acquire(size):
+                    self.stats.record(0.0)
+                    return True
+                self.bytes.refund(size)
+            self.messages.refund(1)
+        self.stats.record_shed()
+        return False
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+"""
+Fleet Scaling Sweep
+Runs the fleet simulator across a grid of device counts, command rates and worker processes and reports where it stops scaling.
+
+Usage:
+    python scaling_sweep.py
+    python scaling_sweep.py --devices 100,500,1000,2000 --rates 20,100 --workers 1,2,4 \\
+        --duration 30 --csv sweep.csv --json sweep.json
+    python scaling_sweep.py --devices 100 --rates 20 --workers 1 --links direct lte 3g 2g
+
+Everything runs on this machine with no network. For each configuration a
+fresh ``local_mqtt_broker.py`` is started on a free loopback port, the
+devices are split over ``--workers`` ``fleet_simulator.py`` processes, and
+this script plays the backend: it sends commands at the configured rate
+(open loop, so a slow fleet builds a queue instead of slowing the sender)
+and times each one until its ack arrives.
+
+Per configuration it records:
+    throughput   acks per second over the measurement window
+    p50/p99      command -> ack latency
+    overhead     p99 of latency minus the device-reported executionTime,
+                 i.e. time spent queued and in transit rather than "in hardware"
+    cpu          worker CPU seconds per wall second (100% = one core)
+    rss          peak resident memory of all workers, total and per device
+
+Devices run with a zero-delay, zero-failure latency model and preemption off
+so every command goes through the full path; handler delays (0.1-0.5 s) still
+apply. The ``p99x`` column is p99 relative to the smallest device count with
+the same rate, workers and link - the device count where it climbs is where ack
+latency goes non-linear.
+
+``--links`` adds a network dimension: every link other than ``direct`` puts a
+``link_proxy.py`` with that profile (or ``key=value`` settings) between the
+workers and the broker, while the sweep itself stays directly connected, so
+the measured latency includes one degraded hop each way. The ``vs link``
+column is p99 relative to the first link with the same devices, rate and
+workers.
+"""
+
+import csv
+import json
+import os
+import time
+import argparse
+import itertools
+import logging
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import paho.mqtt.client as mqtt
+
+import link_proxy
+import mqtt_transport
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Commands go to fan_on/fan_off: both the static and the fallback dynamic catalog have them
+DEFAULT_ACTIONS = ["fan_on", "fan_off"]
+ZERO_DELAY_MODEL = {"default": {"latency": {"distribution": "constant", "value": 0.0}, "failureRate": 0.0}}
+
+
+def parse_grid(text: str, kind=int) -> List[Any]:
+    return [kind(value) for value in text.split(',') if value.strip()]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a process (Linux /proc)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+
+def rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of already sorted values"""
+    if not values:
+        return None
+    rank = max(1, int(round(q / 100.0 * len(values) + 0.5)))
+    return values[min(rank, len(values)) - 1]
+
+
+class LoadDriver:
+    """Plays the backend: sends commands and times their acks"""
+
+    def __init__(self, port: int, device_ids: List[str], actions: List[str], qos: int, run_id: str):
+        self.device_ids = device_ids
+        self.actions = actions
+        self.qos = qos
+        self.run_id = run_id
+        self.online = set()
+        self.sent: Dict[str, float] = {}
+        self.latencies: List[float] = []
+        self.overheads: List[float] = []
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self.client = mqtt.Client(client_id=f"sweep-driver-{run_id}")
+        self.client.on_message = self.on_message
+        self.client.max_inflight_messages_set(1000)
+        self.client.connect('127.0.0.1', port)
+        self.client.subscribe([("smartfarm/devices/+/status", 1), ("smartfarm/devices/+/ack", 1)])
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, msg):
+        received = time.perf_counter()
+        try:
+            payload = json.loads(msg.payload)
+        except ValueError:
+            return
+        if msg.topic.endswith('/ack'):
+            with self._lock:
+                sent = self.sent.pop(payload.get("actionId"), None)
+                if sent is None:
+                    return
+                latency = received - sent
+                self.latencies.append(latency)
+                self.overheads.append(max(0.0, latency - float(payload.get("executionTime") or 0)))
+                if payload.get("status") != "success":
+                    self.errors += 1
+        elif payload.get("status") == "online":
+            self.online.add(payload.get("deviceId"))
+            if len(self.online) >= len(self.device_ids):
+                self._ready.set()
+
+    def wait_ready(self, timeout: float) -> bool:
+        return self._ready.wait(timeout)
+
+    def run(self, rate: float, duration: float) -> int:
+        """Send commands at ``rate`` per second for ``duration`` seconds; returns the number sent"""
+        total = int(rate * duration)
+        started = time.perf_counter()
+        device_count = len(self.device_ids)
+        for index in range(total):
+            # Open loop: every command has a fixed send time, however the fleet is doing
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            device_id = self.device_ids[index % device_count]
+            action = self.actions[(index // device_count) % len(self.actions)]
+            action_id = f"sweep_{self.run_id}_{index}"
+            payload = json.dumps({"event": "action_triggered", "actionId": action_id, "deviceId": device_id,
+                                  "action": action, "timestamp": datetime.now(timezone.utc).isoformat()})
+            with self._lock:
+                self.sent[action_id] = time.perf_counter()
+            self.client.publish(f"smartfarm/actuators/{device_id}/{action}", payload, qos=self.qos)
+        return total
+
+    def drain(self, timeout: float):
+        deadline = time.time() + timeout
+        while self.sent and time.time() < deadline:
+            time.sleep(0.05)
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class ResourceSampler:
+    """Peak RSS of a set of processes, sampled in the background"""
+
+    def __init__(self, pids: List[int], interval: float = 0.5):
+        self.pids = pids
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, sum(rss_bytes(pid) for pid in self.pids))
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> int:
+        self._stop.set()
+        self._thread.join()
+        return self.peak
+
+
+def stop_processes(processes: List[subprocess.Popen], timeout: float):
+    """SIGINT all at once (so they drain in parallel), then kill whatever is left"""
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+    deadline = time.time() + timeout
+    for process in processes:
+        try:
+            process.wait(max(0.1, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def run_configuration(index: int, devices: int, rate: float, workers: int, link: str, args,
+                      model_path: str) -> Dict[str, Any]:
+    """Run one grid point against a fresh local broker"""
+    result = {"devices": devices, "rate": rate, "workers": workers, "link": link}
+    if -(-devices // workers) > mqtt_transport.MAX_CLIENTS_PER_PROCESS:
+        needed = -(-devices // mqtt_transport.MAX_CLIENTS_PER_PROCESS)
+        return dict(result, error=f"over {mqtt_transport.MAX_CLIENTS_PER_PROCESS} devices per worker "
+                                  f"(paho select() limit), needs {needed}+ workers")
+    port = free_port()
+    output = open(os.path.join(args.log_dir, f"config{index}-broker.log"), 'w') if args.log_dir else subprocess.DEVNULL
+    broker = subprocess.Popen([sys.executable, os.path.join(HERE, 'local_mqtt_broker.py'), '--port', str(port)],
+                              stdout=output, stderr=subprocess.STDOUT)
+    processes = []
+    proxy = None
+    driver = None
+    try:
+        if not wait_for_port(port, 10):
+            return dict(result, error="broker did not start")
+
+        worker_port = port
+        if link != "direct":
+            proxy_args = ['--upstream', f"127.0.0.1:{port}", '--profile', link]
+            if args.link_scenario:
+                proxy_args += ['--scenario', args.link_scenario]
+            output = (open(os.path.join(args.log_dir, f"config{index}-proxy.log"), 'w')
+                      if args.log_dir else subprocess.DEVNULL)
+            proxy, worker_port = link_proxy.start_process(proxy_args, stdout=output, stderr=subprocess.STDOUT)
+
+        device_ids = []
+        split = [devices // workers + (1 if worker < devices % workers else 0) for worker in range(workers)]
+        for worker, count in enumerate(split):
+            if not count:
+                continue
+            prefix = f"sweep{index}-w{worker}"
+            device_ids.extend(f"{prefix}-{i}" for i in range(count))
+            command = [sys.executable, os.path.join(HERE, 'fleet_simulator.py'),
+                       '--devices', str(count), '--device-prefix', prefix, '--simulator', args.simulator,
+                       '--broker-url', f"mqtt://127.0.0.1:{worker_port}", '--backend-url', args.backend_url,
+                       '--success-rate', '1', '--latency-model', model_path, '--no-preemption',
+                       '--drain-timeout', '2']
+            output = (open(os.path.join(args.log_dir, f"config{index}-worker{worker}.log"), 'w')
+                      if args.log_dir else subprocess.DEVNULL)
+            processes.append(subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT))
+
+        driver = LoadDriver(port, device_ids, args.actions, args.qos, str(index))
+        ready_started = time.time()
+        if not driver.wait_ready(args.ready_timeout):
+            return dict(result, error=f"only {len(driver.online)}/{devices} devices online "
+                                      f"after {args.ready_timeout:.0f}s")
+        result["startupSeconds"] = round(time.time() - ready_started, 2)
+        time.sleep(args.warmup)
+
+        pids = [process.pid for process in processes]
+        sampler = ResourceSampler(pids)
+        sampler.start()
+        cpu_before = sum(cpu_seconds(pid) for pid in pids)
+        broker_cpu_before = cpu_seconds(broker.pid)
+        started = time.time()
+        sent = driver.run(rate, args.duration)
+        driver.drain(args.drain)
+        wall = time.time() - started
+        cpu = sum(cpu_seconds(pid) for pid in pids) - cpu_before
+        broker_cpu = cpu_seconds(broker.pid) - broker_cpu_before
+        peak_rss = sampler.stop()
+
+        with driver._lock:
+            latencies = sorted(driver.latencies)
+            overheads = sorted(driver.overheads)
+            errors = driver.errors
+        acked = len(latencies)
+        result.update({
+            "sent": sent,
+            "acked": acked,
+            "lost": sent - acked,
+            "errors": errors,
+            "throughput": round(acked / args.duration, 1),
+            "p50Ms": round(1000 * percentile(latencies, 50), 1) if latencies else None,
+            "p99Ms": round(1000 * percentile(latencies, 99), 1) if latencies else None,
+            "maxMs": round(1000 * latencies[-1], 1) if latencies else None,
+            "overheadP99Ms": round(1000 * percentile(overheads, 99), 1) if overheads else None,
+            "cpuPercent": round(100 * cpu / wall, 1),
+            "cpuMsPerCommand": round(1000 * cpu / acked, 2) if acked else None,
+            "brokerCpuPercent": round(100 * broker_cpu / wall, 1),
+            "rssMB": round(peak_rss / 2 ** 20, 1),
+            "rssKBPerDevice": round(peak_rss / 1024 / devices, 1),
+        })
+        return result
+    finally:
+        if driver is not None:
+            driver.close()
+        stop_processes(processes, 15)
+        if proxy is not None:
+            stop_processes([proxy], 5)
+        stop_processes([broker], 5)
+
+
+def mark_knees(results: List[Dict[str, Any]]):
+    """p99 relative to the smallest device count with the same rate, workers and link"""
+    smallest = {}
+    for result in sorted(results, key=lambda r: r["devices"]):
+        if result.get("p99Ms"):
+            smallest.setdefault((result["rate"], result["workers"], result["link"]), result["p99Ms"])
+    for result in results:
+        base = smallest.get((result["rate"], result["workers"], result["link"]))
+        if result.get("p99Ms") and base:
+            result["p99Ratio"] = round(result["p99Ms"] / base, 2)
+
+
+def compare_links(results: List[Dict[str, Any]], links: List[str]):
+    """p99 and throughput relative to the first link with the same devices, rate and workers"""
+    baseline = {(r["devices"], r["rate"], r["workers"]): r for r in results
+                if r["link"] == links[0] and r.get("p99Ms")}
+    for result in results:
+        base = baseline.get((result["devices"], result["rate"], result["workers"]))
+        if result.get("p99Ms") and base:
+            result["p99VsLink"] = round(result["p99Ms"] / base["p99Ms"], 2)
+            result["throughputVsLink"] = round(result["throughput"] / base["throughput"], 2) if base["throughput"] else None
+
+
+def print_report(results: List[Dict[str, Any]]):
+    """Print a summary table of all configurations"""
+    print()
+    header = (f"{'devices':>7} {'rate':>6} {'workers':>7} {'link':>10} {'acks/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'p99x':>5} {'vs link':>7} {'ovh p99':>8} {'cpu %':>6} {'broker %':>8} {'rss MB':>7} {'KB/dev':>7} {'lost':>5}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        prefix = f"{r['devices']:>7} {r['rate']:>6g} {r['workers']:>7} {r['link'][:10]:>10}"
+        if "error" in r:
+            print(f"{prefix}  ❌ {r['error']}")
+            continue
+        ratio = r.get("p99Ratio")
+        vs_link = r.get("p99VsLink")
+        print(f"{prefix} {r['throughput']:>8.1f} {r['p50Ms'] or 0:>8.1f} {r['p99Ms'] or 0:>8.1f} "
+              f"{(f'{ratio:.1f}' if ratio else '-'):>5} {(f'{vs_link:.2f}' if vs_link else '-'):>7} "
+              f"{r['overheadP99Ms'] or 0:>8.1f} {r['cpuPercent']:>6.1f} "
+              f"{r['brokerCpuPercent']:>8.1f} {r['rssMB']:>7.1f} {r['rssKBPerDevice']:>7.1f} {r['lost']:>5}")
+    print(f"\n{os.cpu_count()} CPU(s); cpu % is worker CPU per wall second, 100% = one core")
+    print()
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Fleet scaling sweep against a local broker stand-in')
+    parser.add_argument('--devices', '-c', default='10,100,500',
+                       help='Comma-separated device counts (default: 10,100,500)')
+    parser.add_argument('--rates', '-r', default='10,50',
+                       help='Comma-separated fleet-wide command rates per second (default: 10,50)')
+    parser.add_argument('--workers', '-w', default='1,2',
+                       help='Comma-separated worker process counts (default: 1,2)')
+    parser.add_argument('--links', '-l', nargs='+', default=['direct'],
+                       help="Link profiles or key=value settings between workers and broker, e.g. "
+                            "'direct lte 3g,loss=5%%'; 'direct' for none (default: direct)")
+    parser.add_argument('--link-scenario', default=None,
+                       help='Scenario file whose link and partition faults every link proxy plays')
+    parser.add_argument('--duration', type=float, default=20.0,
+                       help='Seconds of commands per configuration (default: 20)')
+    parser.add_argument('--warmup', type=float, default=2.0,
+                       help='Seconds to wait after all devices are online (default: 2)')
+    parser.add_argument('--drain', type=float, default=10.0,
+                       help='Seconds to wait for outstanding acks after sending (default: 10)')
+    parser.add_argument('--ready-timeout', type=float, default=120.0,
+                       help='Seconds to wait for every device to come online (default: 120)')
+    parser.add_argument('--simulator', choices=['static', 'dynamic'], default='dynamic',
+                       help='Simulator implementation for the devices (default: dynamic)')
+    parser.add_argument('--backend-url', default='http://127.0.0.1:9/api',
+                       help='Backend for the dynamic catalog (default: unreachable, so the fallback catalog is used)')
+    parser.add_argument('--actions', default=','.join(DEFAULT_ACTIONS), type=lambda text: text.split(','),
+                       help=f"Comma-separated actions to send (default: {','.join(DEFAULT_ACTIONS)})")
+    parser.add_argument('--qos', type=int, choices=[0, 1, 2], default=1,
+                       help='QoS of the commands (default: 1)')
+    parser.add_argument('--log-dir', default=None,
+                       help='Keep broker and worker logs in this directory')
+    parser.add_argument('--csv', dest='csv_path', default=None,
+                       help='Write results to this CSV file')
+    parser.add_argument('--json', dest='json_path', default=None,
+                       help='Write results to this JSON file')
+
+    args = parser.parse_args()
+
+    for link in args.links:
+        if link != "direct":
+            try:
+                link_proxy.parse_link_profile(link)
+            except ValueError as e:
+                parser.error(f"--links {link}: {e}")
+
+    grid = list(itertools.product(parse_grid(args.devices), parse_grid(args.rates, float), parse_grid(args.workers),
+                                  args.links))
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+    logger.info(f"📐 Sweeping {len(grid)} configurations, {args.duration:.0f}s each")
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(ZERO_DELAY_MODEL, f)
+        model_path = f.name
+
+    results = []
+    try:
+        for index, (devices, rate, workers, link) in enumerate(grid):
+            logger.info(f"▶️ [{index + 1}/{len(grid)}] {devices} devices, {rate:g} cmd/s, {workers} worker(s), "
+                        f"link {link}")
+            result = run_configuration(index, devices, rate, workers, link, args, model_path)
+            if "error" in result:
+                logger.error(f"❌ {result['error']}")
+            else:
+                logger.info(f"✅ {result['throughput']} acks/s, p99 {result['p99Ms']} ms, "
+                            f"cpu {result['cpuPercent']}%, rss {result['rssMB']} MB")
+            results.append(result)
+    except KeyboardInterrupt:
+        logger.info("🛑 Sweep interrupted, reporting what has run")
+    finally:
+        os.unlink(model_path)
+
+    mark_knees(results)
+    compare_links(results, args.links)
+    print_report(results)
+
+    if args.csv_path and results:
+        fields = []
+        for result in results:
+            fields.extend(key for key in result if key not in fields)
+        with open(args.csv_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(results)
+        logger.info(f"💾 Results written to {args.csv_path}")
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({"createdAt": datetime.now(timezone.utc).isoformat(), "cpus": os.cpu_count(),
+                       "simulator": args.simulator, "duration": args.duration, "results": results}, f, indent=2)
+        logger.info(f"💾 Results written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+"""
+Declarative scenario files for large simulated farm workloads.
+
+A scenario describes a whole run: fleet composition, per-group sensors and
+action catalogs, a timeline of traffic phases and injected faults. YAML
+(``.yaml``/``.yml``) and TOML (``.toml``) are both accepted::
+
+    name: heatwave-300-farms
+    seed: 42
+    timeScale: 60                 # simulated seconds per real second
+    duration: 6h                  # simulated; the run stops afterwards
+
+    groups:
+      - name: greenhouse
+        farms: 300
+        devicesPerFarm: 40
+        deviceId: "{group}-{farm:03d}-{device:02d}"
+        sensorIdFormat: "{device_id}-{sensor}"
+        actions: [ventilator_on, ventilator_off, humidifier_on, open_roof,
+                  water_pump_on, light_on]
+        sensors:                  # same columns as the sensors table
+          - {sensor_id: dht11, type: temperature, unit: "°C", min_critical: 15,
+             min_warning: 17, max_warning: 28, max_critical: 50,
+             action_low: ventilator_off, action_high: ventilator_on}
+
+    phases:                       # settings carry over until changed
+      - {name: baseline, start: 0, telemetryInterval: 10, successRate: 0.95}
+      - {name: heatwave, start: 2h, ambientOffset: 8}
+      - {name: recovery, start: 4h, ambientOffset: 0}
+
+    faults:
+      - {type: flap, fraction: 0.2, start: 1h, every: 5m, downFor: 30s}
+      - {type: offline, fraction: 0.02, start: 3h, end: 3h30m}
+      - {type: failures, fraction: 0.1, groups: [greenhouse], start: 2h, successRate: 0.3}
+      - {type: link, start: 5h, end: 5h30m, profile: 2g}          # played by link_proxy.py
+      - {type: partition, start: 5h40m, end: 5h45m, mode: blackhole}
+
+Nothing is materialized per device: device IDs, sensors and catalogs are
+computed from the device's index on demand, and fault membership is a hash
+of the seed and device ID. ``iter_devices`` streams devices (optionally one
+shard of them), so a million-device scenario costs no memory until the
+devices are actually started.
+
+``link`` and ``partition`` faults degrade or cut the network link of the
+whole fleet. The fleet runner skips them: they are played by
+``link_proxy.py`` (``fleet_simulator.py --link-proxy``), on the same
+timeline. They take link settings (``profile``, ``latency``, ``jitter``,
+``bandwidth``, ``loss``) or a partition ``mode`` instead of a fraction.
+
+Durations are seconds or strings such as ``90s``, ``15m``, ``2h``, ``1d``
+or ``1h30m``. Sensor ``quantity`` (temperature, humidity, soil, light) says
+which simulated value a sensor reads; it defaults from ``type`` and unit.
+An optional sensor ``deadband`` is used with report-by-exception telemetry.
+
+Usage:
+    python scenario.py scenario.example.yaml            # summary
+    python scenario.py scenario.example.yaml --head 5   # plus the first devices
+"""
+
+import bisect
+import json
+import math
+import os
+import re
+import time
+import threading
+import zlib
+import argparse
+import logging
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+import environment_model
+import mqtt_transport
+
+logger = logging.getLogger(__name__)
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+FAULT_TYPES = ("flap", "offline", "failures", "link", "partition")
+# Faults of the whole network link, played by link_proxy.py rather than per device
+LINK_FAULT_TYPES = ("link", "partition")
+
+# Phase settings understood by the scenario runner
+PHASE_SETTINGS = ("telemetryInterval", "successRate", "ambientOffset", "outsideHumidity")
+
+
+def parse_duration(value: Any) -> float:
+    """Convert ``90``, ``"90s"``, ``"15m"`` or ``"1h30m"`` to seconds"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    parts = re.findall(r'(\d+(?:\.\d+)?)\s*([smhd])', value.strip().lower())
+    if not parts or re.sub(r'[\d.\s]+[smhd]', '', value.strip().lower()):
+        raise ValueError(f"Invalid duration: {value!r}")
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def sensor_from_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a sensors-table style row to an environment model sensor"""
+    sensor_type = row["type"]
+    quantity = row.get("quantity")
+    if quantity is None:
+        if sensor_type in ("temperature", "light"):
+            quantity = sensor_type
+        elif sensor_type == "humidity":
+            # Soil probes (YL-69) are stored as humidity on a 0-1 scale
+            quantity = "soil" if (row.get("max_critical") or 100) <= 1 else "humidity"
+        elif sensor_type in ("soil", "soil_moisture"):
+            quantity = "soil"
+        else:
+            raise ValueError(f"Sensor {row.get('sensor_id')}: cannot infer quantity for type {sensor_type!r}")
+    if quantity not in environment_model.QUANTITIES:
+        raise ValueError(f"Sensor {row.get('sensor_id')}: unknown quantity {quantity!r}")
+
+    return {
+        "sensorId": row["sensor_id"],
+        "type": sensor_type,
+        "unit": row.get("unit", ""),
+        "quantity": quantity,
+        "minCritical": row.get("min_critical"),
+        "minWarning": row.get("min_warning"),
+        "maxWarning": row.get("max_warning"),
+        "maxCritical": row.get("max_critical"),
+        "actionLow": row.get("action_low"),
+        "actionHigh": row.get("action_high"),
+        "deadband": row.get("deadband"),
+    }
+
+
+def build_action(entry: Any, device_id: str) -> Dict[str, Any]:
+    """Build a backend-style action record for a catalog entry"""
+    if isinstance(entry, str):
+        entry = {"name": entry}
+    name = entry["name"]
+    return {
+        "id": f"scenario_{name}",
+        "name": entry.get("displayName", name.replace('_', ' ').title()),
+        "actionUri": f"mqtt:smartfarm/actuators/{device_id}/{name}",
+        "actionType": entry.get("actionType", "normal"),
+        "category": entry.get("category", "scenario"),
+    }
+
+
+class DeviceSpec(NamedTuple):
+    """One device of a scenario, computed on demand"""
+    index: int
+    device_id: str
+    group: str
+    farm: int
+    sensors: List[Dict[str, Any]]
+    sensor_id_format: str
+    actions: Optional[List[Dict[str, Any]]]
+
+
+class Fault:
+    """A fault injection applied to a hashed fraction of the fleet"""
+
+    def __init__(self, spec: Dict[str, Any], seed: Any, number: int):
+        self.type = spec["type"]
+        if self.type not in FAULT_TYPES:
+            raise ValueError(f"Unknown fault type {self.type!r} (expected one of: {', '.join(FAULT_TYPES)})")
+        self.name = spec.get("name", f"{self.type}-{number}")
+        self.fraction = float(spec.get("fraction", 1.0))
+        self.groups = set(spec["groups"]) if spec.get("groups") else None
+        self.start = parse_duration(spec.get("start", 0))
+        self.end = parse_duration(spec.get("end"))
+        self.every = parse_duration(spec.get("every", "5m"))
+        self.down_for = parse_duration(spec.get("downFor", "30s"))
+        self.success_rate = spec.get("successRate", 0.0)
+        self.settings = spec  # link settings (latency, jitter, bandwidth, loss, profile, mode) for link_proxy.py
+        self._salt = f"{seed}:{self.name}:"
+        if self.type in LINK_FAULT_TYPES and (self.groups is not None or self.fraction != 1.0):
+            raise ValueError(f"Fault '{self.name}': {self.type} faults apply to every connection through "
+                             f"the link proxy and take no fraction or groups")
+
+    def applies_to(self, device: DeviceSpec) -> bool:
+        """Whether the device is in this fault's sample"""
+        if self.groups is not None and device.group not in self.groups:
+            return False
+        return self.hash_fraction(device.device_id) < self.fraction
+
+    def hash_fraction(self, device_id: str, salt: str = "") -> float:
+        """Stable pseudo-random number in [0, 1) for a device"""
+        return zlib.crc32(f"{self._salt}{salt}{device_id}".encode('utf-8')) / 2 ** 32
+
+    def active(self, t: float) -> bool:
+        """Whether the fault is in effect at simulated time ``t``"""
+        return t >= self.start and (self.end is None or t < self.end)
+
+
+class Scenario:
+    """A parsed scenario file; devices are generated lazily from it"""
+
+    def __init__(self, config: Dict[str, Any], path: str = None):
+        self.config = config
+        self.path = path
+        self.name = config.get("name") or (os.path.splitext(os.path.basename(path))[0] if path else "scenario")
+        self.seed = config.get("seed")
+        self.time_scale = float(config.get("timeScale", 1.0))
+        self.duration = parse_duration(config.get("duration"))
+
+        # Groups with cumulative device offsets for index -> group lookup
+        self.groups = []
+        self._offsets = []
+        total = 0
+        for spec in config.get("groups") or [{"name": "sim"}]:
+            farms = int(spec.get("farms", 1))
+            per_farm = int(spec.get("devicesPerFarm", spec.get("devices", 1)))
+            rows = spec.get("sensors")
+            actions = spec.get("actions")
+            self.groups.append({
+                "name": spec["name"],
+                "farms": farms,
+                "devicesPerFarm": per_farm,
+                "devices": farms * per_farm,
+                "deviceId": spec.get("deviceId", "{group}-{farm}-{device}"),
+                "sensorIdFormat": spec.get("sensorIdFormat", "{device_id}-{sensor}"),
+                "sensors": [sensor_from_row(row) for row in rows] if rows else environment_model.DEFAULT_SENSORS,
+                "actions": actions,
+            })
+            self._offsets.append(total)
+            total += farms * per_farm
+        self.device_count = total
+
+        for phase in config.get("phases") or []:
+            unknown = set(phase) - set(PHASE_SETTINGS) - {"name", "start"}
+            if unknown:
+                raise ValueError(f"Phase {phase.get('name')!r}: unknown settings {', '.join(sorted(unknown))}")
+        self.phases = sorted(
+            ({**phase, "start": parse_duration(phase.get("start", 0))} for phase in config.get("phases") or []),
+            key=lambda phase: phase["start"]
+        )
+        self._phase_starts = [phase["start"] for phase in self.phases]
+        self.faults = [Fault(spec, self.seed, i) for i, spec in enumerate(config.get("faults") or [])]
+
+    @classmethod
+    def from_file(cls, path: str) -> 'Scenario':
+        """Load a scenario from a YAML or TOML file"""
+        if path.endswith('.toml'):
+            try:
+                import tomllib
+            except ImportError:
+                import tomli as tomllib
+            with open(path, 'rb') as f:
+                return cls(tomllib.load(f), path)
+
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("PyYAML is required for YAML scenarios: pip install pyyaml")
+        with open(path) as f:
+            return cls(yaml.safe_load(f) or {}, path)
+
+    def device(self, index: int) -> DeviceSpec:
+        """Compute the device at a global index"""
+        if not 0 <= index < self.device_count:
+            raise IndexError(f"Device index {index} out of range (0-{self.device_count - 1})")
+        group_index = bisect.bisect_right(self._offsets, index) - 1
+        group = self.groups[group_index]
+        local = index - self._offsets[group_index]
+        farm, device = divmod(local, group["devicesPerFarm"])
+
+        device_id = group["deviceId"].format(group=group["name"], farm=farm, device=device, index=index)
+        actions = group["actions"]
+        return DeviceSpec(
+            index=index,
+            device_id=device_id,
+            group=group["name"],
+            farm=farm,
+            sensors=group["sensors"],
+            sensor_id_format=group["sensorIdFormat"],
+            actions=[build_action(entry, device_id) for entry in actions] if actions else None,
+        )
+
+    def shard_range(self, shard: int = 0, shards: int = 1) -> range:
+        """Contiguous slice of device indices for one of ``shards`` processes"""
+        return range(self.device_count * shard // shards, self.device_count * (shard + 1) // shards)
+
+    def iter_devices(self, shard: int = 0, shards: int = 1) -> Iterator[DeviceSpec]:
+        """Stream the devices of one shard (all devices by default)"""
+        for index in self.shard_range(shard, shards):
+            yield self.device(index)
+
+    def phases_started(self, t: float) -> int:
+        """Number of phases started by simulated time ``t``"""
+        return bisect.bisect_right(self._phase_starts, t)
+
+    def phase_at(self, t: float) -> Dict[str, Any]:
+        """Settings in effect at simulated time ``t``, merged over all started phases"""
+        settings = {"name": None}
+        for phase in self.phases[:self.phases_started(t)]:
+            settings.update(phase)
+        return settings
+
+    def summary(self) -> Dict[str, Any]:
+        """Counts and timeline without generating devices"""
+        return {
+            "name": self.name,
+            "devices": self.device_count,
+            "groups": [
+                {"name": g["name"], "farms": g["farms"], "devicesPerFarm": g["devicesPerFarm"],
+                 "devices": g["devices"], "sensors": len(g["sensors"]),
+                 "actions": len(g["actions"]) if g["actions"] else "backend"}
+                for g in self.groups
+            ],
+            "timeScale": self.time_scale,
+            "duration": self.duration,
+            "phases": [{"name": p.get("name"), "start": p["start"]} for p in self.phases],
+            "faults": [{"name": f.name, "type": f.type, "fraction": f.fraction, "start": f.start, "end": f.end}
+                       for f in self.faults],
+        }
+
+
+class ScenarioRunner:
+    """Drives a running fleet through a scenario's phases and faults
+
+    The timeline runs in simulated time (real time x ``timeScale``). Fault
+    membership is computed once per fault by streaming the fleet's shard of
+    the scenario again, so no per-device specs are kept around.
+    """
+
+    def __init__(self, scenario: Scenario, fleet, shard: int = 0, shards: int = 1, tick: float = 1.0,
+                 started: float = None):
+        self.scenario = scenario
+        self.fleet = fleet
+        self.shard = shard
+        self.shards = shards
+        self.tick = tick
+        self.started = started  # wall-clock time of scenario time 0; start() sets it if not given
+        self.phase = {"name": None}
+        self._phases_started = 0  # phases are told apart by position; names are optional and may repeat
+        self._faults = [{"fault": fault, "members": None, "cycles": None, "offsets": None, "active": False}
+                        for fault in scenario.faults]
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def elapsed(self) -> float:
+        """Simulated seconds since the scenario started"""
+        return (time.time() - self.started) * self.scenario.time_scale
+
+    def _members(self, state: Dict[str, Any]) -> List[int]:
+        """Fleet positions of the devices a fault applies to"""
+        if state["members"] is None:
+            fault = state["fault"]
+            specs = self.scenario.iter_devices(self.shard, self.shards)
+            state["members"] = [i for i, spec in enumerate(specs) if fault.applies_to(spec)]
+            devices = self.fleet.devices
+            state["offsets"] = [fault.hash_fraction(devices[i].device_id, "offset") * fault.every
+                                for i in state["members"]]
+            state["cycles"] = [0] * len(state["members"])
+        return state["members"]
+
+    def drop(self, device, down_for: float):
+        """Sever a device's connection and keep it down for ``down_for`` simulated seconds"""
+        delay = max(1, int(math.ceil(down_for / self.scenario.time_scale)))
+        device.client.reconnect_delay_set(min_delay=delay, max_delay=delay)
+        mqtt_transport.sever_connection(device.client)
+
+    def apply_phase(self, phase: Dict[str, Any]):
+        """Push phase settings to the fleet and its telemetry"""
+        for publisher in self.fleet.telemetry:
+            if "telemetryInterval" in phase:
+                publisher.interval = float(phase["telemetryInterval"])
+            if "ambientOffset" in phase:
+                publisher.model.ambient_offset = float(phase["ambientOffset"])
+            if "outsideHumidity" in phase:
+                publisher.model.outside_humidity = float(phase["outsideHumidity"])
+        self.apply_success_rates()
+
+    def apply_success_rates(self):
+        """Set every device's success rate from the phase, then active failure faults"""
+        rate = self.phase.get("successRate")
+        if rate is not None:
+            for device in self.fleet.devices:
+                device.success_rate = float(rate)
+        for state in self._faults:
+            if state["active"] and state["fault"].type == "failures":
+                for i in self._members(state):
+                    self.fleet.devices[i].success_rate = state["fault"].success_rate
+
+    def step(self):
+        """Apply whatever changed since the last step"""
+        t = self.elapsed()
+
+        started = self.scenario.phases_started(t)
+        if started != self._phases_started:
+            self._phases_started = started
+            self.phase = self.scenario.phase_at(t)
+            logger.info(f"🎬 Phase '{self.phase.get('name') or started}' at t={t / 3600:.2f}h")
+            self.apply_phase(self.phase)
+
+        for state in self._faults:
+            fault = state["fault"]
+            if fault.type in LINK_FAULT_TYPES:
+                continue
+            active = fault.active(t)
+            if active != state["active"]:
+                state["active"] = active
+                members = self._members(state)
+                logger.info(f"💥 Fault '{fault.name}' {'started' if active else 'ended'} "
+                            f"on {len(members)} devices at t={t / 3600:.2f}h")
+                if fault.type == "failures":
+                    self.apply_success_rates()
+                elif fault.type == "offline" and active:
+                    remaining = (fault.end or self.scenario.duration or 10 * 86400) - t
+                    for i in members:
+                        self.drop(self.fleet.devices[i], remaining)
+
+            if active and fault.type == "flap":
+                since = t - fault.start
+                cycles = state["cycles"]
+                for k, (i, offset) in enumerate(zip(state["members"], state["offsets"])):
+                    cycle = int((since + offset) // fault.every)
+                    if cycle > cycles[k]:
+                        cycles[k] = cycle
+                        self.drop(self.fleet.devices[i], fault.down_for)
+
+        if self.scenario.duration is not None and t >= self.scenario.duration:
+            logger.info(f"🏁 Scenario '{self.scenario.name}' finished")
+            self._stop_event.set()
+            self.fleet.stop()
+
+    def start(self):
+        """Start the timeline in a background thread"""
+        def loop():
+            while not self._stop_event.wait(self.tick):
+                try:
+                    self.step()
+                except Exception as e:
+                    logger.error(f"❌ Scenario step failed: {e}")
+
+        if self.started is None:
+            self.started = time.time()
+        self._stop_event.clear()
+        self.step()
+        self._thread = threading.Thread(target=loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the timeline"""
+        self._stop_event.set()
+
+
+def main():
+    """Print a scenario summary"""
+    parser = argparse.ArgumentParser(description='Inspect a Smart Farm simulator scenario file')
+    parser.add_argument('scenario', help='Scenario file (.yaml, .yml or .toml)')
+    parser.add_argument('--head', type=int, default=0,
+                       help='Also print the first N devices')
+    args = parser.parse_args()
+
+    scenario = Scenario.from_file(args.scenario)
+    print(json.dumps(scenario.summary(), indent=2, ensure_ascii=False))
+    for index in range(min(args.head, scenario.device_count)):
+        device = scenario.device(index)
+        faults = [fault.name for fault in scenario.faults if fault.applies_to(device)]
+        print(f"{device.index:>8}  {device.device_id:<32} {device.group:<16} faults={faults}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Simulator Hot-Path Microbenchmarks
+Times the per-message functions of both device simulators offline and tracks them against a JSON baseline.
+
+Usage:
+    python simulator_benchmark.py --save-baseline simulator_baseline.json
+    python simulator_benchmark.py --baseline simulator_baseline.json --threshold 10
+    python simulator_benchmark.py --filter dynamic.pipeline --rounds 9
+
+No broker or backend is needed: each simulator gets a ``NullClient`` in place
+of its paho client (publishes are accepted and counted, nothing is sent),
+the action catalog is built locally and handler/execution delays are
+stubbed to zero. What is left is the simulator's own CPU cost per call.
+
+Every benchmark runs ``--rounds`` rounds of ``--iterations`` calls and
+reports the median ns/op. ``pipeline.message`` pushes a whole command
+through ``on_message`` with the worker thread run inline, so its ops/s is the
+per-core message throughput of the simulator. Logging is disabled unless
+``--with-logging`` is given, since the INFO lines would otherwise dominate.
+
+With ``--baseline`` each result's best round is compared to the stored
+best round - the round least disturbed by whatever else the machine was
+doing, so it moves far less between runs than the median. A benchmark that
+got slower by more than ``--threshold`` percent is reported as a regression
+and the exit code is 1.
+"""
+
+import json
+import time
+import random
+import argparse
+import gc
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Tuple
+from unittest import mock
+
+import paho.mqtt.client as mqtt
+
+import device_simulator
+import dynamic_device_simulator
+from event_recorder import EventRecorder
+from scenario import build_action
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+BASELINE_VERSION = 1
+
+# Commands cycled through by the benchmarks; on/off pairs keep handlers on their success path
+DYNAMIC_ACTIONS = ["ventilator_on", "ventilator_off", "humidifier_on", "humidifier_off",
+                   "water_pump_on", "water_pump_off", "light_on", "light_off", "open_roof", "close_roof"]
+STATIC_ACTIONS = ["ventilator_on", "ventilator_off"]
+
+
+class NullClient:
+    """Stands in for the paho client: publishes succeed immediately and are only counted"""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self._mid = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self._mid += 1
+        self.messages += 1
+        self.bytes += len(payload) if payload else 0
+        info = mqtt.MQTTMessageInfo(self._mid)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        return info
+
+    def subscribe(self, *args, **kwargs):
+        return mqtt.MQTT_ERR_SUCCESS, self._mid
+
+    def unsubscribe(self, *args, **kwargs):
+        return mqtt.MQTT_ERR_SUCCESS, self._mid
+
+
+class InlineThread:
+    """threading.Thread replacement that runs the target in the caller"""
+
+    def __init__(self, target=None, args=(), kwargs=None, daemon=None):
+        self._target, self._args, self._kwargs = target, args, kwargs or {}
+
+    def start(self):
+        self._target(*self._args, **self._kwargs)
+
+
+class NullThread(InlineThread):
+    """threading.Thread replacement that never runs the target"""
+
+    def start(self):
+        pass
+
+
+def make_message(topic: str, payload: Dict[str, Any]) -> mqtt.MQTTMessage:
+    """An incoming command as paho would deliver it"""
+    message = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+    message.payload = json.dumps(payload).encode('utf-8')
+    return message
+
+
+def make_dynamic_device(payload_profile: str = "verbose"):
+    """An offline dynamic simulator with a local catalog"""
+    device = dynamic_device_simulator.DynamicSmartFarmDeviceSimulator(
+        "bench-dynamic", broker_url="mqtt://localhost:1883", backend_url="http://localhost:9/api",
+        install_signal_handlers=False, payload_profile=payload_profile)
+    device.client = NullClient()
+    device.action_catalog = [build_action(name, device.device_id) for name in DYNAMIC_ACTIONS + ["restart"]]
+    device.setup_dynamic_actions()
+    device.success_rate = 1.0
+    device.execution_delay_range = (0.0, 0.0)
+    device.start_time = time.time()
+    return device
+
+
+def make_static_device():
+    """An offline static simulator"""
+    device = device_simulator.SmartFarmDeviceSimulator(
+        "bench-static", broker_url="mqtt://localhost:1883", install_signal_handlers=False)
+    device.client = NullClient()
+    device.success_rate = 1.0
+    device.execution_delay_range = (0.0, 0.0)
+    device.start_time = time.time()
+    return device
+
+
+def cycle(values: List[Any]) -> Callable[[], Any]:
+    """Cheap round-robin over a fixed list"""
+    state = {"i": -1}
+    count = len(values)
+
+    def next_value():
+        state["i"] = (state["i"] + 1) % count
+        return values[state["i"]]
+    return next_value
+
+
+def build_benchmarks(resources: ExitStack) -> List[Tuple[str, Callable[[], Any], Callable[[], None], Any]]:
+    """(name, operation, reset between rounds, threading.Thread stand-in or None) per benchmark
+
+    Every benchmark gets its own device, so actuator state left behind by one
+    cannot push another onto its ALREADY_ON/ALREADY_OFF error path. Files the
+    benchmarks write are closed and removed when ``resources`` exits.
+    """
+    benchmarks = []
+
+    def add(name, build, make_device, actions, thread_class=None):
+        device = make_device()
+        topics = [f"smartfarm/actuators/{device.device_id}/{action}" for action in actions]
+        messages = [make_message(topic, {"actionId": f"bench_{i}", "action": action, "deviceId": device.device_id})
+                    for i, (topic, action) in enumerate(zip(topics, actions))]
+        benchmarks.append((name, build(device, cycle(actions), cycle(messages)),
+                           device._inflight.clear, thread_class))
+
+    # Ack serialization and publish, for both payload profiles
+    def acknowledge(device, next_action, next_message):
+        ack = {"message": "Ventilator On executed successfully", "executionTime": 0.42,
+               "action": "ventilator_on", "deviceState": dict(device.device_state)}
+        return lambda: device.send_acknowledgment("bench", "success", ack)
+
+    for prefix, make_device, actions in (("dynamic", make_dynamic_device, DYNAMIC_ACTIONS),
+                                         ("static", make_static_device, STATIC_ACTIONS)):
+        # on_message: topic split and validation only
+        def topic_parse(device, next_action, next_message):
+            device.process_action = lambda *args: None
+            return lambda: device.on_message(device.client, None, next_message())
+        add(f"{prefix}.on_message.topic_parse", topic_parse, make_device, actions)
+
+        # process_action: JSON decode and task registration; the worker thread is never started
+        def decode(device, next_action, next_message):
+            payloads = [message.payload.decode('utf-8') for message in (next_message() for _ in actions)]
+            next_command = cycle(list(zip(actions, payloads)))
+            def operation():
+                action, payload = next_command()
+                device.process_action(action, payload)
+            return operation
+        add(f"{prefix}.process_action.decode", decode, make_device, actions, NullThread)
+
+        # Handler dispatch: the dict lookup execute_action does per command
+        add(f"{prefix}.dispatch.lookup",
+            lambda device, next_action, next_message: lambda: device.action_handlers.get(next_action()),
+            make_device, actions)
+
+        # Handler execution with its delays stubbed (task_sleep is a no-op for the whole run)
+        if prefix == "dynamic":
+            add("dynamic.get_state_key_from_action",
+                lambda device, next_action, next_message: lambda: device.get_state_key_from_action(next_action()),
+                make_device, actions)
+            add("dynamic.handler.execute",
+                lambda device, next_action, next_message:
+                    lambda: device.action_handlers[next_action()](device.device_state),
+                make_device, actions)
+        else:
+            add("static.handler.execute",
+                lambda device, next_action, next_message: lambda: device.action_handlers[next_action()](),
+                make_device, actions)
+
+        # execute_action end to end, inline: latency draw, handler, ack
+        def execute(device, next_action, next_message):
+            payload = {"actionId": "bench"}
+            return lambda: device.execute_action(next_action(), "bench", payload)
+        add(f"{prefix}.execute_action.inline", execute, make_device, actions)
+
+        # Serialization and publish of acks and status
+        add(f"{prefix}.send_acknowledgment.verbose", acknowledge, make_device, actions)
+        add(f"{prefix}.publish_device_status.verbose",
+            lambda device, next_action, next_message: lambda: device.publish_device_status(),
+            make_device, actions)
+
+        # One heartbeat period: status publish plus the wait that schedules the next one
+        def heartbeat(device, next_action, next_message):
+            def operation():
+                device.publish_device_status()
+                device._stop_event.wait(0)
+            return operation
+        add(f"{prefix}.heartbeat.cycle", heartbeat, make_device, actions)
+
+        # Whole command as the network thread sees it, with the worker run inline
+        add(f"{prefix}.pipeline.message",
+            lambda device, next_action, next_message: lambda: device.on_message(device.client, None, next_message()),
+            make_device, actions, InlineThread)
+
+    # The same command with every stage written to an event recorder
+    workdir = resources.enter_context(tempfile.TemporaryDirectory(prefix="simulator_benchmark."))
+
+    def recorded():
+        device = make_dynamic_device()
+        device.event_recorder = EventRecorder(os.path.join(workdir, "simulator_benchmark.events"))
+        resources.callback(device.event_recorder.close)
+        return device
+    add("dynamic.pipeline.message.recorded",
+        lambda device, next_action, next_message: lambda: device.on_message(device.client, None, next_message()),
+        recorded, DYNAMIC_ACTIONS, InlineThread)
+
+    compact = lambda: make_dynamic_device("compact")
+    add("dynamic.send_acknowledgment.compact", acknowledge, compact, DYNAMIC_ACTIONS)
+    add("dynamic.publish_device_status.compact",
+        lambda device, next_action, next_message: lambda: device.publish_device_status(),
+        compact, DYNAMIC_ACTIONS)
+    return benchmarks
+
+
+def time_benchmark(operation: Callable[[], None], reset: Callable[[], None],
+                   iterations: int, rounds: int) -> Dict[str, Any]:
+    """Median and best ns/op over several rounds"""
+    for _ in range(min(iterations, 200)):  # warm up caches and lazy imports
+        operation()
+    reset()
+
+    per_op = []
+    for _ in range(rounds):
+        gc.collect()
+        gc.disable()  # like timeit: collector pauses are noise, not the function's cost
+        try:
+            started = time.perf_counter_ns()
+            for _ in range(iterations):
+                operation()
+            per_op.append((time.perf_counter_ns() - started) / iterations)
+        finally:
+            gc.enable()
+        reset()
+
+    median = statistics.median(per_op)
+    return {
+        "nsPerOp": round(median, 1),
+        "minNsPerOp": round(min(per_op), 1),
+        "opsPerSec": round(1e9 / median, 1) if median else None,
+        "spreadPercent": round(100.0 * (max(per_op) - min(per_op)) / median, 1) if median else 0.0,
+    }
+
+
+def run_benchmarks(args) -> Dict[str, Dict[str, Any]]:
+    """Run every benchmark matching the filter"""
+    random.seed(0)
+    results = {}
+    # Handler delays are simulated hardware time, not simulator cost
+    with ExitStack() as resources, \
+            mock.patch.object(dynamic_device_simulator, 'task_sleep', lambda seconds: None), \
+            mock.patch.object(device_simulator, 'task_sleep', lambda seconds: None):
+        for name, operation, reset, thread_class in build_benchmarks(resources):
+            if args.filter and not any(pattern in name for pattern in args.filter):
+                continue
+            if thread_class is None:
+                results[name] = time_benchmark(operation, reset, args.iterations, args.rounds)
+            else:
+                with mock.patch.object(threading, 'Thread', thread_class):
+                    results[name] = time_benchmark(operation, reset, args.iterations, args.rounds)
+            logger.debug(f"{name}: {results[name]}")
+    return results
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], threshold: float) -> Dict[str, Dict[str, Any]]:
+    """Change versus the baseline for each benchmark present in both"""
+    comparison = {}
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            comparison[name] = {"status": "new"}
+            continue
+        best = previous.get("minNsPerOp", previous["nsPerOp"])
+        change = 100.0 * (result["minNsPerOp"] - best) / best
+        status = "REGRESSION" if change > threshold else ("faster" if change < -threshold else "ok")
+        comparison[name] = {"baselineNsPerOp": best, "changePercent": round(change, 1), "status": status}
+    return comparison
+
+
+def print_report(results: Dict[str, Dict[str, Any]], comparison: Dict[str, Dict[str, Any]] = None):
+    """Print a summary table of all benchmarks"""
+    print()
+    header = f"{'benchmark':<42} {'ns/op':>10} {'best':>10} {'ops/s':>12} {'spread':>7}"
+    if comparison is not None:
+        header += f" {'baseline':>10} {'change':>8}  status"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        line = (f"{name:<42} {result['nsPerOp']:>10.1f} {result['minNsPerOp']:>10.1f} {result['opsPerSec'] or 0:>12.1f} "
+                f"{result['spreadPercent']:>6.1f}%")
+        if comparison is not None:
+            entry = comparison[name]
+            if entry["status"] == "new":
+                line += f" {'-':>10} {'-':>8}  new"
+            else:
+                line += (f" {entry['baselineNsPerOp']:>10.1f} {entry['changePercent']:>+7.1f}%  {entry['status']}")
+        print(line)
+    for prefix in ("dynamic", "static"):
+        pipeline = results.get(f"{prefix}.pipeline.message")
+        if pipeline:
+            print(f"\n{prefix} simulator: {pipeline['opsPerSec']:.0f} commands/s per core (pipeline.message)")
+    print()
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Simulator hot-path microbenchmarks')
+    parser.add_argument('--iterations', '-n', type=int, default=5000,
+                       help='Calls per round (default: 5000)')
+    parser.add_argument('--rounds', '-r', type=int, default=5,
+                       help='Rounds per benchmark; median and best are reported (default: 5)')
+    parser.add_argument('--filter', '-k', action='append', default=None,
+                       help='Only run benchmarks whose name contains this text (repeatable)')
+    parser.add_argument('--baseline', default=None,
+                       help='Compare against this baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                       help='Percent slowdown versus the baseline that counts as a regression (default: 10)')
+    parser.add_argument('--save-baseline', default=None,
+                       help='Write the results as a new baseline JSON file')
+    parser.add_argument('--json', dest='json_path', default=None,
+                       help='Also write results (and the comparison) to this JSON file')
+    parser.add_argument('--with-logging', action='store_true',
+                       help='Keep the simulators\' INFO logging enabled while timing')
+
+    args = parser.parse_args()
+
+    if not args.with_logging:
+        logging.disable(logging.INFO)
+    started = time.time()
+    results = run_benchmarks(args)
+    logging.disable(logging.NOTSET)
+    if not results:
+        logger.error(f"❌ No benchmark matches {args.filter}")
+        sys.exit(2)
+
+    comparison = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare(results, baseline, args.threshold)
+        logger.info(f"📐 Comparing with {args.baseline} ({baseline.get('created')}, "
+                    f"{baseline.get('python')}, threshold {args.threshold}%)")
+
+    print_report(results, comparison)
+    logger.info(f"⏱️ {len(results)} benchmarks in {time.time() - started:.1f}s")
+
+    document = {
+        "version": BASELINE_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "iterations": args.iterations,
+        "rounds": args.rounds,
+        "results": results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(document, f, indent=2)
+        logger.info(f"💾 Baseline written to {args.save_baseline}")
+    if args.json_path:
+        if comparison is not None:
+            document["comparison"] = comparison
+        with open(args.json_path, 'w') as f:
+            json.dump(document, f, indent=2)
+        logger.info(f"💾 Results written to {args.json_path}")
+
+    if comparison is not None:
+        regressions = [name for name, entry in comparison.items() if entry["status"] == "REGRESSION"]
+        if regressions:
+            logger.error(f"❌ {len(regressions)} regression(s) over {args.threshold}%: {', '.join(regressions)}")
+            sys.exit(1)
+        logger.info(f"✅ No regressions over {args.threshold}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""
+Fleet State Checkpoint
+Keeps the actuator state of many simulated devices across simulator restarts.
+
+Usage:
+    python fleet_simulator.py --devices 50000 --workers 8 --checkpoint fleet.state
+    python state_checkpoint.py fleet.w0.state
+    python state_checkpoint.py --bench 50000
+
+A checkpoint is a snapshot plus an append log:
+
+    PATH        the full state as a devices x keys ``uint8`` matrix. Every
+                value of a key (``False``/``True``, ``"closed"``/``"open"``)
+                is stored as its index in that key's value list. 255 means
+                the device has no such key.
+    PATH.log    batches of (device, key, code) records, 8 bytes each. Each
+                batch holds what changed since the previous checkpoint.
+
+Each tick encodes every ``device_state`` dict into a fresh matrix and compares
+it with the last one in numpy. Only the changed cells are appended to the log,
+and a tick with no changes writes nothing. The snapshot is rewritten
+(to a temporary file, then renamed over PATH) when new devices, keys or values
+appear, or when the log outgrows the snapshot. A device that is missing from
+the current run keeps its row, so state survives a fleet that is temporarily
+resized.
+
+Restore maps the snapshot copy-on-write, replays the log batches newer than
+the snapshot in one vectorized assignment, decodes each key's column with one
+numpy lookup, and updates the existing ``device_state`` dicts in place. Those
+dicts are the same objects that the telemetry model and heartbeats read. A
+torn last batch (a process killed mid-write) is ignored.
+
+File layout (little-endian): ``<8sIIIQd4x`` header (magic, devices, keys,
+metadata bytes, sequence number, write time), JSON metadata (device ids, keys,
+value lists), padding to 8 bytes, then the matrix. Log batches are a
+``<4sIQ`` header (magic, records, sequence number) followed by the records.
+The files are renamed but not fsynced. They survive a process restart or a
+redeploy, but not a power loss.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import struct
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"SFSTATE1"
+SNAPSHOT_HEADER = struct.Struct("<8sIIIQd4x")
+LOG_MAGIC = b"SFLG"
+LOG_HEADER = struct.Struct("<4sIQ")
+RECORD = np.dtype([("device", "<u4"), ("key", "<u2"), ("code", "u1"), ("pad", "u1")])
+MISSING = 255  # code of a key the device's state doesn't have
+MAX_VALUES = 255  # distinct values per key; codes 0..254
+
+_ABSENT = object()
+
+
+def _padded(size: int) -> int:
+    return (size + 7) & ~7
+
+
+class StateCheckpoint:
+    """Incremental snapshot + change log of many devices' ``device_state`` dicts"""
+
+    def __init__(self, path: str, interval: float = 5.0, compact_ratio: float = 1.0):
+        self.path = path
+        self.log_path = path + ".log"
+        self.interval = interval  # seconds between background checkpoints
+        self.compact_ratio = compact_ratio  # rewrite the snapshot once the log outgrows ratio x matrix bytes
+        self.devices: List[str] = []
+        self.keys: List[str] = []
+        self.values: Dict[str, List[Any]] = {}  # key -> values by code
+        self._device_index: Dict[str, int] = {}
+        self._codes: Dict[str, Dict[Any, int]] = {}  # key -> value -> code
+        self._matrix = np.zeros((0, 0), dtype=np.uint8)
+        self._log = None
+        self._log_bytes = 0
+        self._snapshot_bytes = 0
+        self.seq = 0
+        self.checkpoints = 0
+        self.snapshots = 0
+        self.changes = 0
+        self.write_seconds = 0.0
+        self.max_write_seconds = 0.0
+        self.restored = 0
+        self.restore_seconds = None
+        self._get_states = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    # ---- encoding ----
+
+    def _add_key(self, key: str):
+        self.keys.append(key)
+        self.values[key] = []
+        self._codes[key] = {_ABSENT: MISSING}
+
+    def _code_of(self, key: str, value: Any) -> int:
+        """Code of a value not yet in the key's value list, adding it; MISSING if it can't be stored"""
+        codes = self._codes[key]
+        try:
+            code = codes.get(value)
+        except TypeError:  # unhashable: dicts and lists aren't actuator state
+            return MISSING
+        if code is not None:
+            return code
+        if len(self.values[key]) >= MAX_VALUES:
+            logger.warning(f"⚠️ More than {MAX_VALUES} values for state key {key}; {value!r} not checkpointed")
+            return MISSING
+        code = len(self.values[key])
+        self.values[key].append(value)
+        codes[value] = code
+        return code
+
+    def _encode(self, states: Dict[str, Dict[str, Any]]):
+        """(matrix, grown): the states as codes, and whether devices, keys or values were added"""
+        items = list(states.items())
+        devices, keys, values = len(self.devices), len(self.keys), sum(map(len, self.values.values()))
+        for device_id, _ in items:
+            if device_id not in self._device_index:
+                self._device_index[device_id] = len(self.devices)
+                self.devices.append(device_id)
+        dicts = [state for _, state in items]
+        for key in sorted(set().union(*dicts) - set(self._codes)) if dicts else ():
+            self._add_key(key)
+
+        matrix = np.full((len(self.devices), len(self.keys)), MISSING, dtype=np.uint8)
+        matrix[:self._matrix.shape[0], :self._matrix.shape[1]] = self._matrix
+        rows = np.fromiter((self._device_index[device_id] for device_id, _ in items), dtype=np.int64,
+                           count=len(items))
+        for k, key in enumerate(self.keys):
+            codes = self._codes[key]
+            try:
+                column = [codes.get(state.get(key, _ABSENT), -1) for state in dicts]
+            except TypeError:
+                column = [-1] * len(dicts)
+            if -1 in column:
+                column = [code if code != -1 else self._code_of(key, dicts[i].get(key, _ABSENT))
+                          for i, code in enumerate(column)]
+            matrix[rows, k] = column
+        grown = (len(self.devices), len(self.keys), sum(map(len, self.values.values()))) != (devices, keys, values)
+        return matrix, grown
+
+    # ---- writing ----
+
+    def checkpoint(self, states: Dict[str, Dict[str, Any]] = None) -> int:
+        """Write what changed since the last checkpoint; returns the number of changed cells"""
+        states = states if states is not None else self._get_states()
+        with self._lock:
+            started = time.perf_counter()
+            matrix, grown = self._encode(states)
+            previous = self._matrix
+            if previous.shape != matrix.shape:
+                previous = np.full(matrix.shape, MISSING, dtype=np.uint8)
+                previous[:self._matrix.shape[0], :self._matrix.shape[1]] = self._matrix
+            devices, keys = np.nonzero(matrix != previous)
+            changed = len(devices)
+            if grown or self._log is None or self._log_bytes > self.compact_ratio * max(matrix.size, 4096):
+                self._write_snapshot(matrix)
+            elif changed:
+                self._append(devices, keys, matrix[devices, keys])
+            self._matrix = matrix
+            elapsed = time.perf_counter() - started
+            self.checkpoints += 1
+            self.changes += changed
+            self.write_seconds += elapsed
+            self.max_write_seconds = max(self.max_write_seconds, elapsed)
+            return changed
+
+    def _write_snapshot(self, matrix: np.ndarray):
+        self.seq += 1
+        meta = json.dumps({"devices": self.devices, "keys": self.keys, "values": self.values},
+                          separators=(',', ':')).encode('utf-8')
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, matrix.shape[0], matrix.shape[1], len(meta),
+                                      self.seq, time.time())
+        padding = _padded(len(header) + len(meta)) - len(header) - len(meta)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(header)
+            f.write(meta)
+            f.write(b"\0" * padding)
+            f.write(np.ascontiguousarray(matrix).tobytes())
+        os.replace(temp_path, self.path)
+        self._snapshot_bytes = os.path.getsize(self.path)
+        # Batches left in the old log are older than the new snapshot; start it over
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.log_path, 'wb')
+        self._log_bytes = 0
+        self.snapshots += 1
+
+    def _append(self, devices: np.ndarray, keys: np.ndarray, codes: np.ndarray):
+        self.seq += 1
+        records = np.zeros(len(devices), dtype=RECORD)
+        records["device"] = devices
+        records["key"] = keys
+        records["code"] = codes
+        self._log.write(LOG_HEADER.pack(LOG_MAGIC, len(records), self.seq))
+        self._log.write(records.tobytes())
+        self._log.flush()
+        self._log_bytes += LOG_HEADER.size + records.nbytes
+
+    # ---- restoring ----
+
+    def restore(self, states: Dict[str, Dict[str, Any]],
+                adopt: Callable[[str], Optional[Dict[str, Any]]] = None) -> int:
+        """Load the checkpoint into the given device_state dicts in place; returns devices restored
+
+        Devices in the checkpoint but not in ``states`` are skipped (and kept
+        for the next snapshot) unless ``adopt`` returns a dict for them.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        with self._lock:
+            started = time.perf_counter()
+            with open(self.path, 'rb') as f:
+                magic, devices, keys, meta_bytes, seq, _ = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+                if magic != SNAPSHOT_MAGIC:
+                    raise ValueError(f"{self.path} is not a state checkpoint")
+                meta = json.loads(f.read(meta_bytes))
+            offset = _padded(SNAPSHOT_HEADER.size + meta_bytes)
+            if devices and keys:
+                matrix = np.memmap(self.path, dtype=np.uint8, mode='c', offset=offset, shape=(devices, keys))
+            else:
+                matrix = np.full((devices, keys), MISSING, dtype=np.uint8)
+            replayed, seq, valid_bytes = self._replay_log(matrix, seq)
+
+            self.devices, self.keys, self.values = meta["devices"], meta["keys"], meta["values"]
+            self._device_index = {device_id: i for i, device_id in enumerate(self.devices)}
+            self._codes = {}
+            for key in self.keys:
+                self._codes[key] = {_ABSENT: MISSING}
+                for code, value in enumerate(self.values[key]):
+                    self._codes[key][value] = code
+            self._matrix = matrix
+            self.seq = seq
+            self._snapshot_bytes = os.path.getsize(self.path)
+            # New batches go after the last complete one, not after a torn tail
+            self._log = open(self.log_path, 'ab')
+            self._log.truncate(valid_bytes)
+            self._log_bytes = valid_bytes
+
+            # One lookup per key turns a column of codes into Python values
+            columns = []
+            for key in self.keys:
+                lookup = np.empty(256, dtype=object)
+                lookup[:] = [_ABSENT] * 256
+                for code, value in enumerate(self.values[key]):
+                    lookup[code] = value
+                columns.append(lookup[matrix[:, len(columns)]].tolist())
+            restored = 0
+            for i, device_id in enumerate(self.devices):
+                state = states.get(device_id)
+                if state is None and adopt is not None:
+                    state = adopt(device_id)
+                if state is None:
+                    continue
+                for key, column in zip(self.keys, columns):
+                    value = column[i]
+                    if value is not _ABSENT:
+                        state[key] = value
+                restored += 1
+            self.restored = restored
+            self.restore_seconds = time.perf_counter() - started
+        logger.info(f"💾 Restored {restored} of {len(self.devices)} checkpointed devices from {self.path} "
+                    f"in {self.restore_seconds * 1000:.1f}ms ({replayed} logged changes replayed)")
+        return restored
+
+    def _replay_log(self, matrix: np.ndarray, seq: int):
+        """Apply the log batches newer than the snapshot
+
+        Returns (records applied, last sequence number, bytes of complete batches).
+        """
+        if not os.path.exists(self.log_path):
+            return 0, seq, 0
+        with open(self.log_path, 'rb') as f:
+            data = f.read()
+        batches = []
+        position = 0
+        while position + LOG_HEADER.size <= len(data):
+            magic, count, batch_seq = LOG_HEADER.unpack_from(data, position)
+            end = position + LOG_HEADER.size + count * RECORD.itemsize
+            if magic != LOG_MAGIC or end > len(data):
+                break  # torn tail of a killed run
+            if batch_seq > seq:
+                batches.append(np.frombuffer(data, dtype=RECORD, count=count, offset=position + LOG_HEADER.size))
+                seq = batch_seq
+            position = end
+        if not batches:
+            return 0, seq, position
+        records = np.concatenate(batches)
+        cells = records["device"].astype(np.int64) * matrix.shape[1] + records["key"]
+        # Last write wins: keep each cell's final record
+        _, last = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - last
+        matrix.reshape(-1)[cells[last]] = records["code"][last]
+        return len(records), seq, position
+
+    # ---- background writer ----
+
+    def start(self, get_states: Callable[[], Dict[str, Dict[str, Any]]]):
+        """Checkpoint ``get_states()`` every ``interval`` seconds on a background thread"""
+        self._get_states = get_states
+        self._stop_event.clear()
+
+        def checkpoint_loop():
+            while not self._stop_event.wait(self.interval):
+                try:
+                    self.checkpoint()
+                except Exception as e:
+                    logger.error(f"❌ State checkpoint failed: {e}")
+
+        self._thread = threading.Thread(target=checkpoint_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background writer and write a final checkpoint"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._get_states is not None:
+            try:
+                self.checkpoint()
+            except Exception as e:
+                logger.error(f"❌ Final state checkpoint failed: {e}")
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def format_summary(self) -> str:
+        summary = (f"{len(self.devices)} devices x {len(self.keys)} keys, "
+                   f"snapshot {self._snapshot_bytes / 1024:.1f} kB + log {self._log_bytes / 1024:.1f} kB, "
+                   f"{self.checkpoints} checkpoints ({self.snapshots} snapshots, {self.changes} changes)")
+        if self.checkpoints:
+            summary += (f", write avg {self.write_seconds / self.checkpoints * 1000:.1f}ms "
+                        f"max {self.max_write_seconds * 1000:.1f}ms")
+        if self.restore_seconds is not None:
+            summary += f", restored {self.restored} devices in {self.restore_seconds * 1000:.1f}ms"
+        return summary
+
+
+def print_checkpoint(path: str, device_id: str = None):
+    """Print what a checkpoint holds: value counts per key, or one device's state"""
+    checkpoint = StateCheckpoint(path)
+    states = {}
+    checkpoint.restore(states, adopt=lambda device: states.setdefault(device, {}))
+    if checkpoint._log is not None:
+        checkpoint._log.close()
+    print()
+    print(f"{path}: {len(checkpoint.devices)} devices, {len(checkpoint.keys)} keys, sequence {checkpoint.seq}")
+    if device_id is not None:
+        print(json.dumps({device_id: states.get(device_id)}, indent=2))
+        return
+    for k, key in enumerate(checkpoint.keys):
+        counts = np.bincount(np.asarray(checkpoint._matrix[:, k]), minlength=256)
+        cells = ", ".join(f"{value!r}: {counts[code]}" for code, value in enumerate(checkpoint.values[key]))
+        missing = f", missing: {counts[MISSING]}" if counts[MISSING] else ""
+        print(f"  {key:<16} {cells}{missing}")
+    print()
+
+
+def run_bench(devices: int, ticks: int, change_rate: float, path: str):
+    """Checkpoint a synthetic fleet for a few ticks, then time a cold restore"""
+    keys = ["ventilator", "humidifier", "water_pump", "lights", "heater", "roof", "alarm", "fan"]
+    states = {f"sim-{i}": {key: ("closed" if key == "roof" else False) for key in keys} for i in range(devices)}
+    for suffix in ("", ".log"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    rng = random.Random(1)
+    checkpoint = StateCheckpoint(path)
+    checkpoint.checkpoint(states)
+    first = checkpoint.write_seconds
+    ids = list(states)
+    for _ in range(ticks):
+        for device_id in rng.sample(ids, int(devices * change_rate)):
+            state = states[device_id]
+            key = rng.choice(keys)
+            state[key] = ("open" if state[key] == "closed" else "closed") if key == "roof" else not state[key]
+        checkpoint.checkpoint(states)
+    checkpoint.stop()
+    incremental = (checkpoint.write_seconds - first) / max(1, ticks) * 1000
+
+    json_started = time.perf_counter()
+    as_json = json.dumps(states)
+    json_ms = (time.perf_counter() - json_started) * 1000
+
+    restored = {device_id: {} for device_id in ids}
+    fresh = StateCheckpoint(path)
+    fresh.restore(restored)
+    fresh.stop()
+    if restored != states:
+        raise AssertionError("restored state differs from the checkpointed state")
+    print()
+    print(f"{devices} devices x {len(keys)} keys, {ticks} ticks changing {change_rate:.1%} of devices each")
+    print(f"  snapshot          {checkpoint._snapshot_bytes / 1024:>10.1f} kB (JSON dump {len(as_json) / 1024:.1f} kB)")
+    print(f"  log               {checkpoint._log_bytes / 1024:>10.1f} kB")
+    print(f"  full snapshot     {first * 1000:>10.1f} ms (JSON dump {json_ms:.1f} ms)")
+    print(f"  incremental tick  {incremental:>10.1f} ms")
+    print(f"  restore           {fresh.restore_seconds * 1000:>10.1f} ms")
+    print()
+
+
+def main():
+    """Main entry point"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%H:%M:%S'
+    )
+    parser = argparse.ArgumentParser(description='Inspect or benchmark fleet state checkpoints')
+    parser.add_argument('path', nargs='?', default=None,
+                       help='Checkpoint written with --checkpoint (its .log is read too)')
+    parser.add_argument('--device', default=None,
+                       help='Print one device\'s restored state instead of the value counts')
+    parser.add_argument('--bench', type=int, default=0, metavar='DEVICES',
+                       help='Checkpoint and restore a synthetic fleet of DEVICES devices')
+    parser.add_argument('--ticks', type=int, default=20,
+                       help='With --bench, incremental checkpoints to write (default: 20)')
+    parser.add_argument('--change-rate', type=float, default=0.01,
+                       help='With --bench, fraction of devices changing per tick (default: 0.01)')
+
+    args = parser.parse_args()
+
+    try:
+        if args.bench:
+            run_bench(args.bench, args.ticks, args.change_rate, args.path or "bench.state")
+        elif args.path:
+            print_checkpoint(args.path, args.device)
+        else:
+            parser.error("give a checkpoint path or --bench")
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ {e}")
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
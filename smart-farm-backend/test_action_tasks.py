@@ -0,0 +1,127 @@
+"""
+Tests for action_tasks: coalescing, sealing, preemption and the savedSeconds count.
+
+Run with: python -m pytest test_action_tasks.py
+"""
+
+import unittest
+from unittest import mock
+
+from action_tasks import CANCELLED, COALESCED, DONE, PENDING, Preempted, TaskRegistry
+
+
+class Clock:
+    """Stand-in for time.time that only moves when told to"""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TaskRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('action_tasks.time.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.registry = TaskRegistry(coalesce_window=2.0)
+
+    def test_follower_joins_within_window(self):
+        leader = self.registry.submit("dev-1", "ventilator_on", "a1")
+        self.clock.now += 1.5
+        follower = self.registry.submit("dev-1", "ventilator_on", "a2")
+
+        self.assertEqual(follower.state, COALESCED)
+        self.assertIs(follower.coalesced_into, leader)
+        self.assertEqual(leader.followers, ["a2"])
+        self.assertEqual(leader.state, PENDING)
+        self.assertEqual(self.registry.counts["coalesced"], 1)
+        self.assertEqual(self.registry.seal(leader), ["a1", "a2"])
+
+    def test_follower_outside_window_preempts(self):
+        leader = self.registry.submit("dev-1", "ventilator_on", "a1")
+        self.clock.now += 2.5
+        later = self.registry.submit("dev-1", "ventilator_on", "a2")
+
+        self.assertEqual(later.state, PENDING)
+        self.assertEqual(leader.state, CANCELLED)
+        self.assertEqual(leader.followers, [])
+
+    def test_follower_rejected_after_seal(self):
+        leader = self.registry.submit("dev-1", "ventilator_on", "a1")
+        self.registry.start(leader)
+        self.assertEqual(self.registry.seal(leader), ["a1"])
+        self.clock.now += 0.5
+        late = self.registry.submit("dev-1", "ventilator_on", "a2")
+
+        # Its ack would never be sent, so it becomes a task of its own
+        self.assertEqual(late.state, PENDING)
+        self.assertIsNone(late.coalesced_into)
+        self.assertEqual(leader.followers, [])
+        self.assertEqual(self.registry.counts["coalesced"], 0)
+        self.assertEqual(self.registry.in_flight()["dev-1/ventilator"]["actionId"], "a2")
+
+    def test_other_action_on_same_actuator_preempts(self):
+        first = self.registry.submit("dev-1", "fan_on", "a1")
+        second = self.registry.submit("dev-1", "fan_off", "a2")
+
+        self.assertEqual(second.state, PENDING)
+        self.assertEqual(first.state, CANCELLED)
+        self.assertEqual(first.preempted_by, "a2")
+        self.assertEqual(self.registry.counts["preempted"], 1)
+        with self.assertRaises(Preempted):
+            self.registry.start(first)
+        with first, self.assertRaises(Preempted):
+            first.sleep(10.0)
+
+        # The cancelled task leaves the newer one registered
+        self.registry.finish(first)
+        self.assertEqual(first.state, CANCELLED)
+        self.assertEqual(self.registry.in_flight()["dev-1/fan"]["actionId"], "a2")
+
+    def test_other_device_does_not_coalesce_or_preempt(self):
+        first = self.registry.submit("dev-1", "fan_on", "a1")
+        other = self.registry.submit("dev-2", "fan_on", "a2")
+
+        self.assertEqual(first.state, PENDING)
+        self.assertEqual(other.state, PENDING)
+        self.assertEqual(first.followers, [])
+
+    def test_saved_seconds_counts_each_follower(self):
+        leader = self.registry.submit("dev-1", "irrigation_on", "a1")
+        self.clock.now += 0.5
+        self.registry.submit("dev-1", "irrigation_on", "a2")
+        self.clock.now += 0.5
+        self.registry.submit("dev-1", "irrigation_on", "a3")
+        self.registry.start(leader)
+        self.registry.seal(leader)
+        self.clock.now += 3.0
+        self.registry.finish(leader)
+
+        # Two followers, each spared the leader's 4 s from arrival to finish
+        self.assertEqual(leader.state, DONE)
+        self.assertAlmostEqual(self.registry.counts["savedSeconds"], 8.0)
+        self.assertEqual(self.registry.counts["done"], 1)
+        self.assertEqual(self.registry.in_flight(), {})
+
+    def test_no_saved_seconds_without_followers(self):
+        task = self.registry.submit("dev-1", "irrigation_on", "a1")
+        self.clock.now += 3.0
+        self.registry.finish(task)
+
+        self.assertEqual(self.registry.counts["savedSeconds"], 0.0)
+
+    def test_coalescing_disabled_by_default(self):
+        registry = TaskRegistry()
+        first = registry.submit("dev-1", "fan_on", "a1")
+        second = registry.submit("dev-1", "fan_on", "a2")
+
+        self.assertEqual(second.state, PENDING)
+        self.assertEqual(first.state, CANCELLED)
+        self.assertEqual(registry.counts["coalesced"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+"""
+Tests for mqtt_transport: in-flight publish tracking and broker clusters.
+
+Run with: python -m pytest test_mqtt_transport.py
+"""
+
+import threading
+import time
+import unittest
+from collections import Counter
+from unittest import mock
+
+import paho.mqtt.client as mqtt
+
+from mqtt_transport import BrokerCluster, InflightTracker
+
+
+def message_info(mid: int, rc: int = mqtt.MQTT_ERR_SUCCESS) -> mqtt.MQTTMessageInfo:
+    info = mqtt.MQTTMessageInfo(mid)
+    info.rc = rc
+    return info
+
+
+def puback(tracker: InflightTracker, info: mqtt.MQTTMessageInfo):
+    """What paho does for a PUBACK: on_publish, then mark the message published"""
+    tracker.acked(info.mid)
+    info._set_as_published()
+
+
+class InflightTrackerTest(unittest.TestCase):
+    def test_puback_after_registration(self):
+        tracker = InflightTracker()
+        info = message_info(1)
+        tracker.sent(info, qos=1)
+        self.assertEqual(len(tracker), 1)
+
+        puback(tracker, info)
+        self.assertEqual(len(tracker), 0)
+        self.assertEqual(tracker.wait(time.time() + 1), 0)
+
+    def test_puback_before_registration(self):
+        # on_publish on the network thread can beat client.publish returning the mid
+        tracker = InflightTracker()
+        info = message_info(7)
+        puback(tracker, info)
+        tracker.sent(info, qos=1)
+
+        self.assertEqual(len(tracker), 0)
+        self.assertEqual(tracker._acked_early, {})
+
+    def test_qos0_write_is_not_an_early_puback(self):
+        tracker = InflightTracker()
+        tracker.sent(message_info(3), qos=0)
+        tracker.acked(3)
+        later = message_info(3)
+        tracker.sent(later, qos=1)
+
+        self.assertEqual(len(tracker), 1)
+
+    def test_disconnected_qos1_publish_is_tracked(self):
+        tracker = InflightTracker()
+        info = message_info(5, rc=mqtt.MQTT_ERR_NO_CONN)
+        tracker.sent(info, qos=1)
+        self.assertEqual(len(tracker), 1)
+
+        # Sent on reconnect and acknowledged
+        puback(tracker, info)
+        self.assertEqual(len(tracker), 0)
+        self.assertEqual(tracker._acked_early, {})
+
+    def test_disconnected_qos0_publish_is_ignored(self):
+        # paho drops QoS 0 publishes made while disconnected; no on_publish will come
+        tracker = InflightTracker()
+        tracker.sent(message_info(5, rc=mqtt.MQTT_ERR_NO_CONN), qos=0)
+
+        self.assertEqual(len(tracker), 0)
+        self.assertEqual(tracker._unsent, set())
+
+    def test_paho_queues_qos1_publish_while_disconnected(self):
+        client = mqtt.Client(client_id="inflight-test")
+        info = client.publish("test/topic", "payload", qos=1)
+
+        self.assertEqual(info.rc, mqtt.MQTT_ERR_NO_CONN)
+        self.assertIn(info.mid, client._out_messages)
+
+    def test_wait_polls_disconnected_publish(self):
+        tracker = InflightTracker()
+        info = message_info(9, rc=mqtt.MQTT_ERR_NO_CONN)
+        tracker.sent(info, qos=1)
+
+        self.assertEqual(tracker.wait(time.time() + 0.1), 1)
+        puback(tracker, info)
+        self.assertEqual(tracker.wait(time.time() + 0.1), 0)
+
+    def test_stale_early_puback_expires(self):
+        tracker = InflightTracker()
+        now = 1000.0
+        with mock.patch('mqtt_transport.time.time', lambda: now):
+            tracker.acked(11)  # a PUBACK that no registration ever matches
+            now += tracker.early_ack_ttl + 1
+            reused = message_info(11)
+            tracker.sent(reused, qos=1)
+
+        # The mid came round again: the new publish must still be waited for
+        self.assertEqual(len(tracker), 1)
+        self.assertEqual(tracker._acked_early, {})
+
+
+
+URLS = ["mqtt://broker-a:1883", "mqtt://broker-b:1883", "mqtt://broker-c:1883"]
+DEVICES = [f"sim-{i}" for i in range(3000)]
+
+
+class BrokerClusterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = [1000.0]
+        patcher = mock.patch('mqtt_transport.time.time', lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cluster = BrokerCluster(URLS, failure_threshold=3, retry_after=30.0)
+
+    def test_preference_list_covers_every_endpoint_once(self):
+        for device_id in DEVICES[:50]:
+            order = self.cluster.preference_list(device_id)
+            self.assertEqual(sorted(order), sorted(URLS))
+            self.assertEqual(order, BrokerCluster(URLS).preference_list(device_id))
+
+    def test_devices_spread_evenly(self):
+        counts = Counter(self.cluster.assign(device_id) for device_id in DEVICES)
+
+        self.assertEqual(set(counts), set(URLS))
+        for url in URLS:
+            self.assertAlmostEqual(counts[url] / len(DEVICES), 1 / len(URLS), delta=0.05)
+
+    def test_adding_an_endpoint_only_moves_devices_to_it(self):
+        before = {device_id: self.cluster.assign(device_id) for device_id in DEVICES}
+        grown = BrokerCluster(URLS + ["mqtt://broker-d:1883"])
+        moved = [device_id for device_id in DEVICES if grown.assign(device_id) != before[device_id]]
+
+        self.assertTrue(all(grown.assign(device_id) == "mqtt://broker-d:1883" for device_id in moved))
+        self.assertAlmostEqual(len(moved) / len(DEVICES), 0.25, delta=0.05)
+
+    def test_mixed_schemes_rejected(self):
+        with self.assertRaises(ValueError):
+            BrokerCluster(["mqtt://broker-a:1883", "mqtts://broker-b:8883"])
+        with self.assertRaises(ValueError):
+            BrokerCluster([])
+
+    def test_failover_after_threshold(self):
+        device_id = DEVICES[0]
+        primary, secondary = self.cluster.preference_list(device_id)[:2]
+
+        for _ in range(2):
+            self.assertEqual(self.cluster.record_failure(primary, device_id), primary)
+        self.assertEqual(self.cluster.record_failure(primary, device_id), secondary)
+        self.assertFalse(self.cluster.endpoints[primary].healthy)
+        self.assertEqual(self.cluster.endpoints[secondary].failovers_in, 1)
+        self.assertEqual(self.cluster.assign(device_id), secondary)
+
+    def test_down_endpoint_retried_after_retry_after(self):
+        device_id = DEVICES[0]
+        primary, secondary = self.cluster.preference_list(device_id)[:2]
+        for _ in range(3):
+            self.cluster.record_failure(primary, device_id)
+
+        self.clock[0] += 29.0
+        self.assertEqual(self.cluster.assign(device_id), secondary)
+        self.clock[0] += 2.0
+        self.assertEqual(self.cluster.assign(device_id), primary)
+        self.assertTrue(self.cluster.endpoints[primary].healthy)
+
+    def test_connect_marks_endpoint_up(self):
+        device_id = DEVICES[0]
+        primary = self.cluster.preference_list(device_id)[0]
+        for _ in range(3):
+            self.cluster.record_failure(primary, device_id)
+        self.cluster.record_connect(primary)
+
+        stats = self.cluster.endpoints[primary]
+        self.assertTrue(stats.healthy)
+        self.assertEqual(stats.consecutive_failures, 0)
+        self.assertEqual(stats.connections, 1)
+        self.assertEqual(self.cluster.assign(device_id), primary)
+
+    def test_all_down_falls_back_to_primary(self):
+        device_id = DEVICES[0]
+        for url in URLS:
+            for _ in range(3):
+                self.cluster.record_failure(url, device_id)
+
+        self.assertEqual(self.cluster.assign(device_id), self.cluster.preference_list(device_id)[0])
+
+    def test_publishes_counted_across_threads(self):
+        url = URLS[0]
+
+        def publish():
+            for _ in range(10000):
+                self.cluster.record_publish(url)
+
+        threads = [threading.Thread(target=publish) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Reading the count does not change it
+        self.assertEqual(self.cluster.endpoints[url].messages, 40000)
+        self.assertEqual(self.cluster.summary()[url]["messages"], 40000)
+        self.assertEqual(self.cluster.summary()[url]["messages"], 40000)
+        self.assertEqual(self.cluster.summary()[URLS[1]]["messages"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+"""
+Tests for state_checkpoint: snapshot + change log round trips, replay order and torn tails.
+
+Run with: python -m pytest test_state_checkpoint.py
+"""
+
+import copy
+import os
+import tempfile
+import unittest
+
+from state_checkpoint import StateCheckpoint
+
+
+def fleet_states(devices: int = 6):
+    """Device states that already use every value, so changes go to the log rather than a new snapshot"""
+    return {f"sim-{i}": {"fan": i % 2 == 0, "lights": i % 3 == 0, "roof": "open" if i % 2 else "closed"}
+            for i in range(devices)}
+
+
+class StateCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "fleet.state")
+
+    def open(self) -> StateCheckpoint:
+        checkpoint = StateCheckpoint(self.path)
+        self.addCleanup(checkpoint.stop)
+        return checkpoint
+
+    def restore(self, device_ids) -> dict:
+        states = {device_id: {} for device_id in device_ids}
+        self.open().restore(states)
+        return states
+
+    def test_round_trip(self):
+        states = fleet_states()
+        del states["sim-5"]["lights"]  # a key the device doesn't have stays absent
+        checkpoint = self.open()
+        checkpoint.checkpoint(states)
+        checkpoint.stop()
+
+        self.assertEqual(self.restore(states), states)
+
+    def test_restore_updates_dicts_in_place(self):
+        states = fleet_states()
+        checkpoint = self.open()
+        checkpoint.checkpoint(states)
+        checkpoint.stop()
+
+        live = {device_id: {"fan": None, "extra": 1} for device_id in states}
+        held = live["sim-0"]
+        self.assertEqual(self.open().restore(live), len(states))
+        self.assertIs(live["sim-0"], held)
+        self.assertEqual(held, {**states["sim-0"], "extra": 1})
+
+    def test_last_write_wins_across_batches(self):
+        states = fleet_states()
+        checkpoint = self.open()
+        checkpoint.checkpoint(states)
+        for fan, roof in ((True, "open"), (False, "closed"), (True, "closed")):
+            states["sim-1"]["fan"] = fan
+            states["sim-1"]["roof"] = roof
+            states["sim-2"]["lights"] = not states["sim-2"]["lights"]
+            checkpoint.checkpoint(states)
+        self.assertEqual(checkpoint.snapshots, 1)
+        self.assertGreater(os.path.getsize(checkpoint.log_path), 0)
+        checkpoint.stop()
+
+        self.assertEqual(self.restore(states), states)
+
+    def test_torn_final_batch_ignored_and_truncated(self):
+        states = fleet_states()
+        checkpoint = self.open()
+        checkpoint.checkpoint(states)
+        states["sim-0"]["fan"] = False
+        checkpoint.checkpoint(states)
+        before_last = copy.deepcopy(states)
+        complete_bytes = os.path.getsize(checkpoint.log_path)
+        states["sim-3"]["roof"] = "closed"
+        checkpoint.checkpoint(states)
+        checkpoint.stop()
+
+        # Killed halfway through writing the last batch
+        with open(checkpoint.log_path, 'r+b') as f:
+            f.truncate(os.path.getsize(checkpoint.log_path) - 4)
+
+        reopened = self.open()
+        restored = {device_id: {} for device_id in states}
+        reopened.restore(restored)
+        self.assertEqual(restored, before_last)
+        self.assertEqual(os.path.getsize(reopened.log_path), complete_bytes)
+
+        # New batches follow the last complete one and replay after it
+        restored["sim-4"]["lights"] = True
+        reopened.checkpoint(restored)
+        reopened.stop()
+        self.assertEqual(self.restore(states), restored)
+
+    def test_stale_batches_skipped(self):
+        states = fleet_states()
+        checkpoint = self.open()
+        checkpoint.checkpoint(states)
+        states["sim-0"]["fan"] = False
+        states["sim-1"]["roof"] = "closed"
+        checkpoint.checkpoint(states)
+        with open(checkpoint.log_path, 'rb') as f:
+            stale = f.read()
+
+        # A new device forces a snapshot rewrite; later changes go to a fresh log
+        states["sim-0"]["fan"] = True
+        states["sim-1"]["roof"] = "open"
+        states["sim-9"] = {"fan": False, "lights": True, "roof": "closed"}
+        checkpoint.checkpoint(states)
+        self.assertEqual(checkpoint.snapshots, 2)
+        states["sim-2"]["lights"] = True
+        checkpoint.checkpoint(states)
+        checkpoint.stop()
+        with open(checkpoint.log_path, 'rb') as f:
+            current = f.read()
+
+        # Batches from before the snapshot, e.g. a log written while the snapshot was replaced
+        with open(checkpoint.log_path, 'wb') as f:
+            f.write(stale + current)
+
+        self.assertEqual(self.restore(states), states)
+
+    def test_missing_checkpoint_restores_nothing(self):
+        states = fleet_states()
+        self.assertEqual(self.open().restore(states), 0)
+        self.assertEqual(states, fleet_states())
+
+
+if __name__ == '__main__':
+    unittest.main()
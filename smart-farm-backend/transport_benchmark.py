@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+MQTT Transport Overhead Benchmark
+Compares message throughput and CPU cost of each MQTT transport against a local broker.
+
+Usage:
+    python transport_benchmark.py
+    python transport_benchmark.py --messages 50000 --qos 1 \\
+        --url mqtt://localhost:1883 --url mqtts://localhost:8883 \\
+        --url ws://localhost:8083/mqtt --url wss://localhost:8084/mqtt --insecure
+
+For each broker URL a publisher and a subscriber client are connected over the
+same transport. The publisher sends simulator-shaped ack payloads as fast as
+the client allows and the run ends when the subscriber has received them all.
+CPU is the process CPU time (user + system) of both clients, so the numbers
+compare framing/TLS cost between transports rather than absolute broker speed.
+"""
+
+import json
+import time
+import threading
+import argparse
+import logging
+import sys
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+import paho.mqtt.client as mqtt
+
+import mqtt_transport
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+DEFAULT_URLS = [
+    "mqtt://localhost:1883",
+    "mqtts://localhost:8883",
+    "ws://localhost:8083/mqtt",
+    "wss://localhost:8084/mqtt",
+]
+
+
+def build_sample_payload() -> bytes:
+    """Build a payload shaped like a simulator success acknowledgment"""
+    return json.dumps({
+        "actionId": "action_1738123456789_abc123",
+        "status": "success",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "deviceId": "bench-device",
+        "action": "ventilator_on",
+        "message": "Ventilator On executed successfully",
+        "executionTime": 1.27,
+        "deviceState": {"ventilator": True, "humidifier": False, "water_pump": False, "lights": False}
+    }).encode('utf-8')
+
+
+def connect_client(endpoint: mqtt_transport.BrokerEndpoint, args, client_id: str) -> mqtt.Client:
+    """Create, configure and connect a benchmark client"""
+    client = mqtt_transport.create_mqtt_client(endpoint, client_id=client_id)
+    client.max_inflight_messages_set(args.max_inflight)
+    if args.username:
+        client.username_pw_set(args.username, args.password)
+    if endpoint.use_ssl:
+        client.tls_set_context(mqtt_transport.get_shared_ssl_context(args.ca_file, args.insecure))
+
+    connected = threading.Event()
+    client.on_connect = lambda c, u, f, rc: connected.set() if rc == 0 else None
+    client.connect(endpoint.host, endpoint.port, 60)
+    client.loop_start()
+    if not connected.wait(args.connect_timeout):
+        client.loop_stop()
+        raise TimeoutError(f"no CONNACK within {args.connect_timeout}s")
+    return client
+
+
+def run_transport(broker_url: str, args, payload: bytes) -> Dict[str, Any]:
+    """Benchmark a single transport and return its measurements"""
+    endpoint = mqtt_transport.parse_broker_url(broker_url)
+    topic = f"smartfarm/bench/{endpoint.scheme}/{int(time.time() * 1000)}"
+    received = 0
+    done = threading.Event()
+
+    def on_message(client, userdata, msg):
+        nonlocal received
+        received += 1
+        if received >= args.messages:
+            done.set()
+
+    subscribed = threading.Event()
+    subscriber = connect_client(endpoint, args, f"bench-sub-{endpoint.scheme}")
+    subscriber.on_message = on_message
+    subscriber.on_subscribe = lambda c, u, mid, granted: subscribed.set()
+    subscriber.subscribe(topic, qos=args.qos)
+    subscribed.wait(args.connect_timeout)
+
+    publisher = connect_client(endpoint, args, f"bench-pub-{endpoint.scheme}")
+
+    try:
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+
+        for _ in range(args.messages):
+            publisher.publish(topic, payload, qos=args.qos)
+
+        completed = done.wait(args.timeout)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+    finally:
+        for client in (publisher, subscriber):
+            client.disconnect()
+            client.loop_stop()
+
+    return {
+        "url": broker_url,
+        "transport": endpoint.scheme,
+        "messages": received,
+        "completed": completed,
+        "seconds": round(wall, 3),
+        "messagesPerSec": round(received / wall, 1) if wall > 0 else 0.0,
+        "cpuSeconds": round(cpu, 3),
+        "cpuMicrosPerMessage": round(cpu / received * 1e6, 1) if received else None,
+        "payloadBytes": len(payload)
+    }
+
+
+def print_report(results: List[Dict[str, Any]]):
+    """Print a summary table of all transports"""
+    print()
+    print(f"{'transport':<10} {'msgs':>8} {'seconds':>9} {'msg/s':>10} {'cpu s':>8} {'cpu us/msg':>11}  status")
+    print("-" * 72)
+    for result in results:
+        if "error" in result:
+            print(f"{result['transport']:<10} {'-':>8} {'-':>9} {'-':>10} {'-':>8} {'-':>11}  {result['error']}")
+            continue
+        status = "ok" if result["completed"] else "timeout"
+        print(f"{result['transport']:<10} {result['messages']:>8} {result['seconds']:>9.3f} "
+              f"{result['messagesPerSec']:>10.1f} {result['cpuSeconds']:>8.3f} "
+              f"{result['cpuMicrosPerMessage'] or 0:>11.1f}  {status}")
+    print()
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='MQTT transport overhead benchmark')
+    parser.add_argument('--url', action='append', dest='urls',
+                       help='Broker URL to benchmark; repeat for each transport (default: all four on localhost)')
+    parser.add_argument('--messages', '-m', type=int, default=20000,
+                       help='Messages per transport (default: 20000)')
+    parser.add_argument('--qos', type=int, choices=[0, 1], default=1,
+                       help='Publish QoS (default: 1)')
+    parser.add_argument('--max-inflight', type=int, default=100,
+                       help='Max in-flight QoS 1 messages per client (default: 100)')
+    parser.add_argument('--username', '-n', default=None,
+                       help='MQTT username (default: none)')
+    parser.add_argument('--password', '-p', default=None,
+                       help='MQTT password (default: none)')
+    parser.add_argument('--ca-file', default=mqtt_transport.DEFAULT_CA_FILE,
+                       help='CA certificate for mqtts/wss (default: certs/emqxsl-ca.crt)')
+    parser.add_argument('--insecure', action='store_true',
+                       help='Skip TLS certificate verification (local self-signed brokers)')
+    parser.add_argument('--connect-timeout', type=float, default=5.0,
+                       help='Seconds to wait for each connection (default: 5.0)')
+    parser.add_argument('--timeout', type=float, default=120.0,
+                       help='Max seconds per transport run (default: 120)')
+    parser.add_argument('--json', dest='json_path', default=None,
+                       help='Also write results to this JSON file')
+
+    args = parser.parse_args()
+    payload = build_sample_payload()
+    results = []
+
+    for url in args.urls or DEFAULT_URLS:
+        logger.info(f"📏 Benchmarking {url} ({args.messages} messages, QoS {args.qos})")
+        try:
+            results.append(run_transport(url, args, payload))
+        except Exception as e:
+            logger.warning(f"⚠️ Skipping {url}: {e}")
+            results.append({"url": url, "transport": url.split(':', 1)[0], "error": str(e)})
+
+    print_report(results)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"💾 Results written to {args.json_path}")
+
+    if not any("error" not in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()